@@ -21,8 +21,14 @@ import torch
 from alpamayo_r1.action_space.action_space import ActionSpace
 
 
-class DiscreteTrajectoryTokenizer:
-    """Discrete trajectory tokenizer."""
+class DiscreteTrajectoryTokenizer(torch.nn.Module):
+    """Discrete trajectory tokenizer.
+
+    The bins of the action dimensions are held in non-persistent buffers, so they follow the device
+    of the model the tokenizer is attached to and encoding/decoding does not copy them from the
+    host. The action space is kept out of the module tree, so its buffers do not enter the
+    state_dict of the model either.
+    """
 
     def __init__(
         self,
@@ -33,11 +39,19 @@ class DiscreteTrajectoryTokenizer:
         **kwargs: Any,
     ) -> None:
         """Initializes the tokenizer."""
-        self.action_space: ActionSpace = hyu.instantiate(action_space_cfg)
+        super().__init__()
+        # not registered as a submodule: its persistent buffers would add keys to the checkpoints
+        object.__setattr__(self, "action_space", hyu.instantiate(action_space_cfg))
+        self.action_space: ActionSpace
         assert len(dims_min) == len(dims_max) == self.action_space.get_action_space_dims()[-1]
         self.dims_min = dims_min
         self.dims_max = dims_max
         self.num_bins = num_bins
+        # explicit float32 so that the bins do not depend on the default dtype at construction
+        bins_min = torch.tensor(dims_min, dtype=torch.float32)
+        bins_max = torch.tensor(dims_max, dtype=torch.float32)
+        self.register_buffer("bins_min", bins_min, persistent=False)
+        self.register_buffer("bins_range", bins_max - bins_min, persistent=False)
 
     @property
     def vocab_size(self) -> int:
@@ -70,11 +84,10 @@ class DiscreteTrajectoryTokenizer:
         """
         batch_size = fut_xyz.shape[0]
         action = self.action_space.traj_to_action(hist_xyz, hist_rot, fut_xyz, fut_rot)
-        dims_min = torch.tensor(self.dims_min, device=action.device, dtype=action.dtype)
-        dims_max = torch.tensor(self.dims_max, device=action.device, dtype=action.dtype)
-        action = (action - dims_min) / (dims_max - dims_min)
-        action = (action * (self.num_bins - 1)).round().long()
-        action = action.clamp(0, self.num_bins - 1)
+        bins_min = self.bins_min.to(device=action.device, dtype=action.dtype)
+        bins_range = self.bins_range.to(device=action.device, dtype=action.dtype)
+        action = (action - bins_min) / bins_range * (self.num_bins - 1)
+        action = action.round_().clamp_(0, self.num_bins - 1).long()
         return action.reshape(batch_size, -1)
 
     def decode(
@@ -100,9 +113,8 @@ class DiscreteTrajectoryTokenizer:
             None: The future timestamps are not decoded.
         """
         action = tokens.reshape(-1, *self.action_space.get_action_space_dims()).to(hist_xyz.dtype)
-        dims_min = torch.tensor(self.dims_min, device=action.device, dtype=action.dtype)
-        dims_max = torch.tensor(self.dims_max, device=action.device, dtype=action.dtype)
-        action = action / (self.num_bins - 1)
-        action = action * (dims_max - dims_min) + dims_min
+        bins_min = self.bins_min.to(device=action.device, dtype=action.dtype)
+        bins_range = self.bins_range.to(device=action.device, dtype=action.dtype)
+        action = torch.addcmul(bins_min, action / (self.num_bins - 1), bins_range)
         fut_xyz, fut_rot = self.action_space.action_to_traj(action, hist_xyz, hist_rot)
         return fut_xyz, fut_rot, None
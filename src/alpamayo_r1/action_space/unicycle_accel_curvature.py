@@ -148,7 +148,7 @@ class UnicycleAccelCurvatureActionSpace(ActionSpace):
         # We use 2nd order here as we do not want to penalize the jerk itself directly but only
         # smoothness of the jerk.
         a = solve_xs_eq_y(
-            s=torch.ones_like(dv),
+            s=None,
             y=dv,
             dt=self.dt,
             lam=self.a_lambda,
@@ -14,9 +14,13 @@
 # limitations under the License.
 
 import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable
 
 import einops
 import torch
+import torch.nn.functional as F
 from alpamayo_r1.geometry.rotation import round_2pi_torch, so3_to_yaw_torch
 
 logger = logging.getLogger(__name__)
@@ -29,6 +33,267 @@ def unwrap_angle(phi: torch.Tensor) -> torch.Tensor:
     return torch.cat([phi[..., :1], phi[..., :1] + torch.cumsum(d, dim=-1)], dim=-1)
 
 
+# Below this batch size, or on GPU, the banded Cholesky factorization is slower than the dense
+# one since its loop over the sequence length is bound by the per-op overhead. The systems are
+# still assembled in banded form and only expanded to dense matrices right before factorizing.
+BANDED_SOLVE_MIN_BATCH = 512
+
+# The ridge of the rows that are not positive definite is escalated by 10x up to this many times,
+# starting from at least MIN_ESCALATED_RIDGE. SOLVER_STATS counts the solved, regularized and
+# non-finite rows.
+MAX_RIDGE_ESCALATIONS = 8
+MIN_ESCALATED_RIDGE = 1e-8
+SOLVER_STATS: Counter[str] = Counter()
+
+# coefficients of the rows of the first, second and third order difference matrices
+_DIFF_COEFFS = {1: (-1.0, 1.0), 2: (-1.0, 2.0, -1.0), 3: (-1.0, 3.0, -3.0, 1.0)}
+
+# The smoothing operators and the factors of the systems with constant data weights only depend
+# on (N, weights, lam, dt, dtype, device), which are the same for every call of an action space.
+# They are built once and kept in a LRU cache, callers only ever get read-only views of them.
+# The cache is shared by the threads of a process, e.g. the stages of `RolloutPipeline`.
+OPERATOR_CACHE_SIZE = 64
+_OPERATOR_CACHE: OrderedDict[tuple, torch.Tensor] = OrderedDict()
+_OPERATOR_CACHE_LOCK = threading.Lock()
+
+
+def clear_operator_cache() -> None:
+    """Drop all the cached smoothing operators and Cholesky factors."""
+    with _OPERATOR_CACHE_LOCK:
+        _OPERATOR_CACHE.clear()
+
+
+def _cached_operator(key: tuple, build: Callable[[], torch.Tensor]) -> torch.Tensor:
+    """Get the operator of `key` from the cache, building it with `build` if needed."""
+    with _OPERATOR_CACHE_LOCK:
+        if key in _OPERATOR_CACHE:
+            _OPERATOR_CACHE.move_to_end(key)
+            return _OPERATOR_CACHE[key]
+    # built outside of the lock, a concurrent miss of the same key builds an equal operator
+    operator = build()
+    with _OPERATOR_CACHE_LOCK:
+        operator = _OPERATOR_CACHE.setdefault(key, operator)
+        _OPERATOR_CACHE.move_to_end(key)
+        while len(_OPERATOR_CACHE) > OPERATOR_CACHE_SIZE:
+            _OPERATOR_CACHE.popitem(last=False)
+    return operator
+
+
+def _is_constant_weight(w: float | torch.Tensor | None) -> bool:
+    """Whether a smoothing weight is the same for all the rows, i.e. not a tensor."""
+    return not isinstance(w, torch.Tensor)
+
+
+def banded_to_dense(ab: torch.Tensor) -> torch.Tensor:
+    """Expand a symmetric matrix from lower banded storage to a dense matrix.
+
+    Args:
+        ab: (..., p+1, N) the lower band, ab[..., k, j] = A[..., j+k, j].
+
+    Returns:
+        A: (..., N, N) the dense symmetric matrix.
+    """
+    N = ab.shape[-1]
+    A = torch.diag_embed(ab[..., 0, :])
+    for k in range(1, min(ab.shape[-2], N)):
+        off_diag = ab[..., k, : N - k]
+        A = A + torch.diag_embed(off_diag, offset=-k) + torch.diag_embed(off_diag, offset=k)
+    return A
+
+
+def cholesky_banded(ab: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Cholesky factorization of symmetric positive definite banded matrices.
+
+    Computes A = L L^T column by column, vectorized over the leading dimensions. Row j+k of L only
+    depends on the p columns before j, which are kept in a (p, p+1) window of banded columns.
+
+    Args:
+        ab: (..., p+1, N) the lower band of A, ab[..., k, j] = A[..., j+k, j].
+
+    Returns:
+        lb: (..., p+1, N) the lower band of L, lb[..., k, j] = L[..., j+k, j].
+        info: (...,) int32, 0 on success, otherwise j+1 for the first non-positive pivot j.
+    """
+    *lead, bw, N = ab.shape
+    p = bw - 1
+    # window[..., i, :] holds column j-p+i of L, zeros before the first column
+    window = ab.new_zeros(*lead, p, bw)
+    # rows[k, i], cols[k, i] pick L[j+k, j-p+i] from the window padded with p zero columns
+    i = torch.arange(p, device=ab.device)
+    k = torch.arange(bw, device=ab.device)
+    rows = i.expand(bw, p)
+    cols = (k[:, None] + p - i[None, :]).clamp(max=2 * p)
+    columns = []
+    for j in range(N):
+        # R[..., k, i] = L[j+k, j-p+i]
+        R = F.pad(window, (0, p))[..., rows, cols]
+        column = ab[..., :, j] - (R @ R[..., 0, :, None]).squeeze(-1)
+        column = column / column[..., :1].sqrt()
+        columns.append(column)
+        window = torch.cat([window[..., 1:, :], column[..., None, :]], dim=-2)
+    lb = torch.stack(columns, dim=-1)
+    # rows past the end of the matrix are padding
+    lb = lb.masked_fill(k[:, None] + torch.arange(N, device=ab.device) >= N, 0.0)
+    is_bad = ~(lb[..., 0, :] > 0)
+    info = torch.where(is_bad.any(dim=-1), is_bad.int().argmax(dim=-1) + 1, 0).int()
+    return lb, info
+
+
+def cholesky_solve_banded(rhs: torch.Tensor, lb: torch.Tensor) -> torch.Tensor:
+    """Solve L L^T x = rhs given the banded Cholesky factor L.
+
+    Args:
+        rhs: (..., N) the right hand side.
+        lb: (..., p+1, N) the lower band of L, see `cholesky_banded`.
+
+    Returns:
+        x: (..., N) the solution.
+    """
+    *_, bw, N = lb.shape
+    p = bw - 1
+    diag = lb[..., 0, :]
+    # L_rows[..., j, i] = L[j, j-p+i] = lb[p-i, j-p+i], zero before the first column
+    lb_padded = F.pad(lb, (p, 0))
+    i = torch.arange(p, device=lb.device)
+    L_rows = lb_padded[..., p - i, torch.arange(N, device=lb.device)[:, None] + i]
+
+    # forward substitution L y = rhs
+    y_window = rhs.new_zeros(*rhs.shape[:-1], p)
+    ys = []
+    for j in range(N):
+        y_j = (rhs[..., j] - (L_rows[..., j, :] * y_window).sum(dim=-1)) / diag[..., j]
+        ys.append(y_j)
+        y_window = torch.cat([y_window[..., 1:], y_j[..., None]], dim=-1)
+
+    # backward substitution L^T x = y
+    x_window = rhs.new_zeros(*rhs.shape[:-1], p)
+    xs = []
+    for j in reversed(range(N)):
+        x_j = (ys[j] - (lb[..., 1:, j] * x_window).sum(dim=-1)) / diag[..., j]
+        xs.append(x_j)
+        x_window = torch.cat([x_j[..., None], x_window[..., :-1]], dim=-1)
+    return torch.stack(xs[::-1], dim=-1)
+
+
+def solve_banded_spd_ex(ab: torch.Tensor, rhs: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Solve A x = rhs for symmetric positive definite banded matrices A, without raising.
+
+    Large CPU batches are factorized in banded form, see `BANDED_SOLVE_MIN_BATCH`, the others are
+    expanded to dense matrices for `torch.linalg.cholesky_ex`.
+
+    Args:
+        ab: (..., p+1, N) the lower band of A, ab[..., k, j] = A[..., j+k, j].
+        rhs: (..., N) the right hand side.
+
+    Returns:
+        x: (..., N) the solution, undefined where info is non-zero.
+        info: (...,) int32, 0 on success, otherwise the order of the first leading minor of A
+            that is not positive definite.
+    """
+    ab, rhs = torch.broadcast_tensors(ab, rhs.unsqueeze(-2))
+    rhs = rhs[..., 0, :]
+    batch_size = ab[..., 0, 0].numel()
+    if ab.device.type == "cpu" and batch_size >= BANDED_SOLVE_MIN_BATCH:
+        lb, info = cholesky_banded(ab)
+        return cholesky_solve_banded(rhs, lb), info
+    L, info = torch.linalg.cholesky_ex(banded_to_dense(ab))
+    return torch.cholesky_solve(rhs.unsqueeze(-1), L).squeeze(-1), info
+
+
+def solve_banded_spd(ab: torch.Tensor, rhs: torch.Tensor) -> torch.Tensor:
+    """Solve A x = rhs for symmetric positive definite banded matrices A.
+
+    Args:
+        ab: (..., p+1, N) the lower band of A, ab[..., k, j] = A[..., j+k, j].
+        rhs: (..., N) the right hand side.
+
+    Returns:
+        x: (..., N) the solution.
+
+    Raises:
+        RuntimeError: If A is not positive definite.
+    """
+    x, info = solve_banded_spd_ex(ab, rhs)
+    if info.any():
+        raise RuntimeError(
+            f"solve_banded_spd: The factorization could not be completed because the input is "
+            f"not positive-definite (the leading minor of order {info.max()} is not "
+            f"positive-definite)."
+        )
+    return x
+
+
+def solve_banded_spd_regularized(
+    ab: torch.Tensor,
+    rhs: torch.Tensor,
+    ridge: float,
+    max_escalations: int = MAX_RIDGE_ESCALATIONS,
+) -> torch.Tensor:
+    """Solve (A + ridge * I) x = rhs, escalating the ridge of the rows that are not definite.
+
+    The whole batch is solved once with `ridge`. Only the rows whose factorization failed are
+    solved again, with the ridge multiplied by 10 until they succeed. Rows with non-finite data,
+    e.g. a NaN in `rhs`, factorize fine and keep their non-finite solution without affecting the
+    others. The numbers of regularized and non-finite rows are counted in `SOLVER_STATS`.
+
+    Args:
+        ab: (..., p+1, N) the lower band of A, ab[..., k, j] = A[..., j+k, j].
+        rhs: (..., N) the right hand side.
+        ridge: float, the ridge added to the diagonal of all the rows.
+        max_escalations: int, the maximum number of times the ridge is escalated.
+
+    Returns:
+        x: (..., N) the solution.
+
+    Raises:
+        RuntimeError: If some rows are still not positive definite after `max_escalations`.
+    """
+    x, info = solve_banded_spd_ex(_add_to_diagonal(ab, ridge), rhs)
+    failed = info != 0
+    SOLVER_STATS["rows"] += failed.numel()
+    SOLVER_STATS["nonfinite_rows"] += int((~failed & ~x.isfinite().all(dim=-1)).sum())
+    if not failed.any():
+        return x
+
+    # re-solve the failing rows only
+    ab, rhs = torch.broadcast_tensors(ab, rhs.unsqueeze(-2))
+    N = x.shape[-1]
+    ab, rhs, x = ab.reshape(-1, *ab.shape[-2:]), rhs[..., 0, :].reshape(-1, N), x.reshape(-1, N)
+    rows = failed.flatten().nonzero().squeeze(-1)
+    SOLVER_STATS["regularized_rows"] += rows.numel()
+    for _ in range(max_escalations):
+        ridge = max(ridge, MIN_ESCALATED_RIDGE) * 10
+        logger.debug(f"Resolving the singularity of {rows.numel()} rows using ridge {ridge}")
+        x_rows, info = solve_banded_spd_ex(_add_to_diagonal(ab[rows], ridge), rhs[rows])
+        solved = info == 0
+        x[rows[solved]] = x_rows[solved]
+        rows = rows[~solved]
+        if rows.numel() == 0:
+            return x.reshape(*failed.shape, N)
+    raise RuntimeError(
+        f"solve_banded_spd_regularized: {rows.numel()} rows are not positive-definite with "
+        f"ridge {ridge}."
+    )
+
+
+def cholesky_solve_shared(rhs: torch.Tensor, L: torch.Tensor) -> torch.Tensor:
+    """Solve A x = rhs for a single matrix A = L L^T shared by all the rows of rhs.
+
+    All the rows are solved as the columns of one right hand side matrix, which is a single
+    triangular solve instead of one per row.
+
+    Args:
+        rhs: (..., N) the right hand side.
+        L: (N, N) the dense Cholesky factor of A.
+
+    Returns:
+        x: (..., N) the solution.
+    """
+    *lead, N = rhs.shape
+    x = torch.cholesky_solve(rhs.reshape(-1, N).T.to(L.dtype), L).T
+    return x.reshape(*lead, N)
+
+
 def first_order_D(
     N: int,
     lead_shape: tuple[int, ...],
@@ -112,8 +377,22 @@ def construct_DTD(
         dt: float, the time step.
 
     Returns:
-        DTD: torch.Tensor, the dense matrix D^T s D for multiple orders of smoothing.
+        DTD: torch.Tensor, the dense matrix D^T s D for multiple orders of smoothing. If none of
+            the weights is a tensor, it is a copy of a cached (N, N) matrix.
     """
+    if all(_is_constant_weight(w) for w in (w_smooth1, w_smooth2, w_smooth3)):
+        key = ("DTD", N, w_smooth1, w_smooth2, w_smooth3, lam, dt, dtype, device)
+        DTD = _cached_operator(
+            key,
+            lambda: banded_to_dense(
+                construct_DTD_banded(
+                    N, (), device, dtype, w_smooth1, w_smooth2, w_smooth3, lam=lam, dt=dt
+                )
+            ),
+        )
+        # a copy, so that in-place updates by the caller do not corrupt the cache
+        return DTD.expand(*lead, N, N).clone()
+
     DTD = torch.zeros(*lead, N, N, dtype=dtype, device=device)
     if w_smooth1 is not None:
         lam_1 = lam / dt**2
@@ -158,6 +437,186 @@ def construct_DTD(
     return DTD
 
 
+@torch.amp.autocast(device_type="cuda", enabled=False)
+@torch.no_grad()
+@torch._dynamo.disable()
+def construct_DTD_banded(
+    N: int,
+    lead: tuple[int, ...],
+    device: torch.device = torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+    w_smooth1: float | torch.Tensor | None = None,
+    w_smooth2: float | torch.Tensor | None = None,
+    w_smooth3: float | torch.Tensor | None = None,
+    lam: float = 1e-3,
+    dt: float = 1.0,
+    bandwidth: int = 1,
+) -> torch.Tensor:
+    """Construct D^T s D for multiple orders of smoothing in lower banded storage.
+
+    Same as `construct_DTD`, but the entries of D^T s D are computed in closed form from the
+    difference coefficients, which takes O(N) time and memory instead of O(N^3) and O(N^2).
+
+    Args:
+        N: int, the length of the solving variables.
+        lead: tuple, the shape of the leading dimensions of the output matrix.
+        device: torch.device, the device of the output matrix.
+        dtype: torch.dtype, the dtype of the output matrix.
+        w_smooth1: float | torch.Tensor | None, the weight for the first-order smoothing term.
+        w_smooth2: float | torch.Tensor | None, the weight for the second-order smoothing term.
+        w_smooth3: float | torch.Tensor | None, the weight for the third-order smoothing term.
+        lam: float, the weight for the smoothing term.
+        dt: float, the time step.
+        bandwidth: int, the minimum number of sub-diagonals of the output.
+
+    Returns:
+        DTD: torch.Tensor, (*lead, p+1, N) the lower band of D^T s D, i.e.
+            DTD[..., k, j] = (D^T s D)[..., j+k, j], where p is the highest smoothing order or
+            `bandwidth` if larger. If none of the weights is a tensor, it is a read-only broadcast
+            view of a cached (p+1, N) band.
+    """
+    weights = {1: w_smooth1, 2: w_smooth2, 3: w_smooth3}
+    weights = {order: w for order, w in weights.items() if w is not None}
+    p = max([bandwidth, *weights.keys()])
+    if all(_is_constant_weight(w) for w in weights.values()):
+        key = ("DTD_banded", N, p, w_smooth1, w_smooth2, w_smooth3, lam, dt, dtype, device)
+        DTD = _cached_operator(
+            key,
+            lambda: _build_DTD_banded(N, p, weights, lam, dt, (), device, dtype),
+        )
+        return DTD.expand(*lead, p + 1, N)
+    return _build_DTD_banded(N, p, weights, lam, dt, lead, device, dtype)
+
+
+def _build_DTD_banded(
+    N: int,
+    p: int,
+    weights: dict[int, float | torch.Tensor],
+    lam: float,
+    dt: float,
+    lead: tuple[int, ...],
+    device: torch.device,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Compute the (*lead, p+1, N) band of `construct_DTD_banded` from the weights by order."""
+    DTD = torch.zeros(*lead, p + 1, N, dtype=dtype, device=device)
+    for order, w in weights.items():
+        n_rows = N - order
+        if n_rows <= 0:
+            continue
+        # (D^T s D)[j+k, j] = sum_i s_i D[i, j+k] D[i, j] with D[i, i+a] = coeffs[a]
+        lam_order = lam / dt ** (2 * order)
+        coeffs = _DIFF_COEFFS[order]
+        for k in range(order + 1):
+            for a in range(order + 1 - k):
+                DTD[..., k, a : a + n_rows] += lam_order * coeffs[a] * coeffs[a + k] * w
+    return DTD
+
+
+def _add_to_diagonal(ab: torch.Tensor, diag: float | torch.Tensor) -> torch.Tensor:
+    """Add diag (float or (..., N)) to the diagonal of the banded matrix ab (..., p+1, N)."""
+    if isinstance(diag, torch.Tensor):
+        diag = diag.unsqueeze(-2)
+    main = ab[..., :1, :] + diag
+    return torch.cat([main, ab[..., 1:, :].expand(*main.shape[:-2], -1, -1)], dim=-2)
+
+
+def _eliminate_first_variable(
+    ab: torch.Tensor, rhs: torch.Tensor, x_init: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Fix the first variable of a banded system to x_init.
+
+    Args:
+        ab: (..., p+1, N+1) the lower band of the system over all variables.
+        rhs: (..., N) the right hand side of the rows of the other variables.
+        x_init: (...,) the value of the first variable.
+
+    Returns:
+        ab: (..., p+1, N) the lower band of the system over the other variables.
+        rhs: (..., N) the right hand side with the x_init terms moved to it.
+    """
+    p, N = ab.shape[-2] - 1, rhs.shape[-1]
+    n_coupled = min(p, N)
+    coupling = F.pad(ab[..., 1 : n_coupled + 1, 0], (0, N - n_coupled))  # A[1:, 0]
+    return ab[..., 1:], rhs - coupling * x_init.unsqueeze(-1)
+
+
+def _constant_system_factor(
+    N: int,
+    device: torch.device,
+    dtype: torch.dtype,
+    w_smooth1: float | None,
+    w_smooth2: float | None,
+    w_smooth3: float | None,
+    lam: float,
+    dt: float,
+    diag: float,
+    n_fixed: int = 0,
+) -> torch.Tensor:
+    """Cached Cholesky factor of D^T s D + diag * I when the system does not depend on the data.
+
+    Args:
+        N: int, the number of free variables.
+        device: torch.device, the device of the factor.
+        dtype: torch.dtype, the dtype of the factor.
+        w_smooth1: float | None, the weight for the first-order smoothing term.
+        w_smooth2: float | None, the weight for the second-order smoothing term.
+        w_smooth3: float | None, the weight for the third-order smoothing term.
+        lam: float, the weight for the smoothing term.
+        dt: float, the time step.
+        diag: float, the constant data weight plus the ridge.
+        n_fixed: int, the number of leading variables fixed by constraints, which are smoothed
+            together with the free ones but eliminated from the system.
+
+    Returns:
+        L: (N, N) the dense Cholesky factor, read-only.
+    """
+    device = torch.device(device)
+    key = ("factor", N, n_fixed, w_smooth1, w_smooth2, w_smooth3, lam, dt, diag, dtype, device)
+
+    def build() -> torch.Tensor:
+        DTD = construct_DTD_banded(
+            N + n_fixed,
+            (),
+            device=device,
+            dtype=dtype,
+            w_smooth1=w_smooth1,
+            w_smooth2=w_smooth2,
+            w_smooth3=w_smooth3,
+            lam=lam,
+            dt=dt,
+        )
+        return torch.linalg.cholesky(banded_to_dense(_add_to_diagonal(DTD[..., n_fixed:], diag)))
+
+    return _cached_operator(key, build)
+
+
+def _dxy_theta_normal_equation(
+    g: torch.Tensor, theta: torch.Tensor, w: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Banded normal equation of v_t u_t + v_t+1 u_t+1 = g_t, with u_t = [cos theta_t, sin theta_t].
+
+    Every row pair t of A only touches v_t and v_t+1 with unit vectors, so A^T w A is tridiagonal:
+    its diagonal counts the weighted rows touching v_j and A^T w A[j+1, j] = w_j u_j . u_j+1.
+
+    Args:
+        g: (..., N, 2) the targets.
+        theta: (..., N+1) the headings.
+        w: (..., N) the weights.
+
+    Returns:
+        ATA: (..., 2, N+1) the lower band of A^T w A.
+        rhs: (..., N+1) A^T w g.
+    """
+    diag = F.pad(w, (0, 1)) + F.pad(w, (1, 0))
+    off_diag = F.pad(w * torch.cos(theta[..., 1:] - theta[..., :-1]), (0, 1))
+    ATA = torch.stack([diag, off_diag], dim=-2)
+    wg = w.unsqueeze(-1) * g
+    wg = F.pad(wg, (0, 0, 0, 1)) + F.pad(wg, (0, 0, 1, 0))  # (..., N+1, 2)
+    rhs = torch.cos(theta) * wg[..., 0] + torch.sin(theta) * wg[..., 1]
+    return ATA, rhs
+
+
 @torch.amp.autocast(device_type="cuda", enabled=False)
 @torch.no_grad()
 @torch._dynamo.disable()
@@ -182,7 +641,8 @@ def solve_single_constraint(
     Args:
         x_init: the initial value.
         x_target: the target value.
-        w_data: the weight for the data term.
+        w_data: the weight for the data term, ones if None. The system does not depend on the
+            data then, and its factorization is cached if the smoothing weights are floats.
         w_smooth1: the weight for the first-order smoothing term.
         w_smooth2: the weight for the second-order smoothing term.
         w_smooth3: the weight for the third-order smoothing term.
@@ -197,20 +657,20 @@ def solve_single_constraint(
     *lead, N = x_target.shape
     if N <= 0:
         raise ValueError("x_mid must have a positive last-dimension length N.")
+    is_constant = w_data is None and all(
+        _is_constant_weight(w) for w in (w_smooth1, w_smooth2, w_smooth3)
+    )
     if w_data is None:
         w_data = torch.ones_like(x_target)
     x_init = torch.as_tensor(x_init, dtype=dtype, device=device)
 
     # Solve the normal equation
     # (A^TA + D^TD + ridge * I) x = A^T b
-    A_data = torch.eye(N, dtype=dtype, device=device).expand(*lead, N, N)
-    Aw_data = A_data * w_data.unsqueeze(-1)
-    with torch.amp.autocast(device_type="cuda", enabled=False):
-        ATA = einops.einsum(Aw_data, A_data, "... i j, ... i k -> ... j k")
-        rhs = einops.einsum(Aw_data, x_target, "... i j, ... i -> ... j")
+    # where A is the identity, so A^TA = diag(w_data) and A^T b = w_data * x_target
+    rhs = w_data * x_target
 
     # The dim is N + 1 because we have x_init as the first element
-    DTD = construct_DTD(
+    DTD = construct_DTD_banded(
         N + 1,
         lead,
         device=device,
@@ -221,14 +681,17 @@ def solve_single_constraint(
         lam=lam,
         dt=dt,
     )
-    rhs -= DTD[..., 1:, 0] * x_init.unsqueeze(-1)
-
-    ridge_term = ridge * torch.eye(N, dtype=dtype, device=device).expand(*lead, N, N)
     # strip off the x_init term
-    lhs = ATA + DTD[..., 1:, 1:] + ridge_term
-
-    L = torch.linalg.cholesky(lhs)
-    x = torch.cholesky_solve(rhs.unsqueeze(-1), L).squeeze(-1)  # (..., N)
+    DTD, rhs = _eliminate_first_variable(DTD, rhs, x_init)
+    if is_constant:
+        # the lhs does not depend on the data, reuse its cached factor
+        L = _constant_system_factor(
+            N, device, dtype, w_smooth1, w_smooth2, w_smooth3, lam, dt, 1.0 + ridge, n_fixed=1
+        )
+        x = cholesky_solve_shared(rhs, L)  # (..., N)
+    else:
+        lhs = _add_to_diagonal(DTD, w_data + ridge)
+        x = solve_banded_spd(lhs, rhs)  # (..., N)
 
     x = torch.cat([x_init.unsqueeze(-1), x], dim=-1)  # (..., N+1)
     return x
@@ -238,7 +701,7 @@ def solve_single_constraint(
 @torch.no_grad()
 @torch._dynamo.disable()
 def solve_xs_eq_y(
-    s: torch.Tensor,
+    s: torch.Tensor | None,
     y: torch.Tensor,
     w_data: torch.Tensor | None = None,
     w_smooth1: float | torch.Tensor | None = None,
@@ -253,9 +716,11 @@ def solve_xs_eq_y(
     min_x={x_0, ..., x_N-1} sum_i={0, ..., N-1} w_data_i (x_i * s_i - y_i)**2 + smooth_terms
 
     Args:
-        s (..., N): the slope
+        s (..., N): the slope, ones if None
         y (..., N): the y-value
-        w_data (..., N): the weight for the data term
+        w_data (..., N): the weight for the data term, ones if None. If both s and w_data are
+            None, the system does not depend on the data and its factorization is cached if the
+            smoothing weights are floats.
         w_smooth1: the weight for the first-order smoothing term
         w_smooth2: the weight for the second-order smoothing term
         w_smooth3: the weight for the third-order smoothing term
@@ -268,6 +733,13 @@ def solve_xs_eq_y(
     """
     device, dtype = y.device, y.dtype
     *lead, N = y.shape
+    is_constant = (
+        s is None
+        and w_data is None
+        and all(_is_constant_weight(w) for w in (w_smooth1, w_smooth2, w_smooth3))
+    )
+    if s is None:
+        s = torch.ones_like(y)
     if w_data is None:
         w_data = torch.ones_like(y)
     if w_data.shape != y.shape:
@@ -275,13 +747,18 @@ def solve_xs_eq_y(
 
     # Solve the normal equation
     # (A^TA + D^TD + ridge * I) x = A^T b
-    A_data = torch.diag_embed(s)
-    Aw_data = A_data * w_data.unsqueeze(-1)
-    with torch.amp.autocast(device_type="cuda", enabled=False):
-        ATA = einops.einsum(Aw_data, A_data, "... i j, ... i k -> ... j k")
-        rhs = einops.einsum(Aw_data, y, "... i j, ... i -> ... j")
+    # where A = diag(s), so A^TA = diag(w_data * s^2) and A^T b = w_data * s * y
+    ATA_diag = w_data * s * s
+    rhs = w_data * s * y
+
+    if is_constant:
+        # the lhs does not depend on the data and is positive definite, reuse its cached factor
+        L = _constant_system_factor(
+            N, device, dtype, w_smooth1, w_smooth2, w_smooth3, lam, dt, 1.0 + ridge
+        )
+        return cholesky_solve_shared(rhs, L)  # (..., N)
 
-    DTD = construct_DTD(
+    DTD = construct_DTD_banded(
         N,
         lead,
         device=device,
@@ -294,22 +771,14 @@ def solve_xs_eq_y(
     )
 
     # NOTE: Since there is no terminal constraint, we need to handle the singularity case by
-    # increasing the ridge term.
-    L = None
-    while L is None:
-        try:
-            ridge_term = ridge * torch.eye(N, dtype=dtype, device=device).expand(*lead, N, N)
-            lhs = ATA + DTD + ridge_term
-            # Ensure dtype consistency for torch.compile fake tensor meta pass
-            if rhs.dtype != lhs.dtype:
-                rhs = rhs.to(lhs.dtype)
-            L = torch.linalg.cholesky(lhs)
-        except RuntimeError as e:
-            logger.error(f"Error in cholesky decomposition: {e}", exc_info=True)
-            ridge *= 10
-            logger.warning(f"Resolving singularity using ridge {ridge}")
-
-    return torch.cholesky_solve(rhs.unsqueeze(-1), L).squeeze(-1)  # (..., N)
+    # increasing the ridge term of the rows that are not positive definite.
+    lhs = _add_to_diagonal(DTD, ATA_diag)
+    # Ensure dtype consistency for torch.compile fake tensor meta pass
+    if rhs.dtype != lhs.dtype:
+        rhs = rhs.to(lhs.dtype)
+    x = solve_banded_spd_regularized(lhs, rhs, ridge)
+
+    return x  # (..., N)
 
 
 @torch.no_grad()
@@ -353,21 +822,7 @@ def dxy_theta_to_v_without_v0(
 
     # solve the normal equation
     # (A^TA + D^TD + ridge * I) x = A^T b
-    A_data = torch.zeros(*lead, 2 * N, N + 1, dtype=dtype, device=device)
-    b_data = g.flatten(start_dim=-2)
-    cos_theta = torch.cos(theta)
-    sin_theta = torch.sin(theta)
-    cos_rows = 2 * torch.arange(N, device=device)
-    sin_rows = 2 * torch.arange(N, device=device) + 1
-    cols = torch.arange(N, device=device)
-    A_data[..., cos_rows, cols] = cos_theta[..., :-1]
-    A_data[..., cos_rows, cols + 1] = cos_theta[..., 1:]
-    A_data[..., sin_rows, cols] = sin_theta[..., :-1]
-    A_data[..., sin_rows, cols + 1] = sin_theta[..., 1:]
-    Aw_data = A_data * torch.repeat_interleave(w, 2, dim=-1).unsqueeze(-1)
-    with torch.amp.autocast(device_type="cuda", enabled=False):
-        ATA = einops.einsum(Aw_data, A_data, "... i j, ... i k -> ... j k")
-        rhs = einops.einsum(Aw_data, b_data, "... i j, ... i -> ... j")
+    ATA, rhs = _dxy_theta_normal_equation(g, theta, w)
 
     # The dim is N + 1 because we have x_init as the first element
     # NOTE: for Tikhonov regularization
@@ -376,7 +831,7 @@ def dxy_theta_to_v_without_v0(
     # 3rd order means we want small difference between jerk
     # We use 3rd order here as we do not want to penalize the jerk itself directly but only
     # smoothness of the jerk.
-    DTD = construct_DTD(
+    DTD = construct_DTD_banded(
         N + 1,
         lead,
         device=device,
@@ -388,12 +843,9 @@ def dxy_theta_to_v_without_v0(
         dt=dt,
     )
 
-    ridge_term = v_ridge * torch.eye(N + 1, dtype=dtype, device=device).expand(*lead, N + 1, N + 1)
-    # strip off the x_init term
-    lhs = ATA + DTD + ridge_term
-
-    L = torch.linalg.cholesky(lhs)
-    y = torch.cholesky_solve(rhs.unsqueeze(-1), L).squeeze(-1)  # (..., N+1)
+    lhs = DTD + F.pad(ATA, (0, 0, 0, DTD.shape[-2] - ATA.shape[-2]))
+    lhs = _add_to_diagonal(lhs, v_ridge)
+    y = solve_banded_spd(lhs, rhs)  # (..., N+1)
 
     return y  # (..., N+1)
 
@@ -435,24 +887,7 @@ def dxy_theta_to_v(
 
     # solve the normal equation
     # (A^TA + D^TD + ridge * I) x = A^T b
-    A_data = torch.zeros(*lead, 2 * N, N + 1, dtype=dtype, device=device)
-    b_data = g.flatten(start_dim=-2)
-    cos_theta = torch.cos(theta)
-    sin_theta = torch.sin(theta)
-    cos_rows = 2 * torch.arange(N, device=device)
-    sin_rows = 2 * torch.arange(N, device=device) + 1
-    cols = torch.arange(N, device=device)
-    A_data[..., cos_rows, cols] = cos_theta[..., :-1]
-    A_data[..., cos_rows, cols + 1] = cos_theta[..., 1:]
-    A_data[..., sin_rows, cols] = sin_theta[..., :-1]
-    A_data[..., sin_rows, cols + 1] = sin_theta[..., 1:]
-    Aw_data = A_data * torch.repeat_interleave(w, 2, dim=-1).unsqueeze(-1)
-    with torch.amp.autocast(device_type="cuda", enabled=False):
-        ATA = einops.einsum(Aw_data, A_data, "... i j, ... i k -> ... j k")
-        # rhs is A^T w_data b, but we need to include the x_init terms into the rhs as it is a
-        # constant.
-        rhs = einops.einsum(Aw_data[..., :, 1:], b_data, "... i j, ... i -> ... j")
-    rhs -= ATA[..., 1:, 0] * v0.unsqueeze(-1)
+    ATA, rhs = _dxy_theta_normal_equation(g, theta, w)
 
     # The dim is N + 1 because we have x_init as the first element
     # NOTE: for Tikhonov regularization
@@ -461,7 +896,7 @@ def dxy_theta_to_v(
     # 3rd order means we want small difference between jerk
     # We use 3rd order here as we do not want to penalize the jerk itself directly but only
     # smoothness of the jerk.
-    DTD = construct_DTD(
+    DTD = construct_DTD_banded(
         N + 1,
         lead,
         device=device,
@@ -472,14 +907,13 @@ def dxy_theta_to_v(
         lam=v_lambda,
         dt=dt,
     )
-    rhs -= DTD[..., 1:, 0] * v0.unsqueeze(-1)
-
-    ridge_term = v_ridge * torch.eye(N, dtype=dtype, device=device).expand(*lead, N, N)
-    # strip off the x_init term
-    lhs = ATA[..., 1:, 1:] + DTD[..., 1:, 1:] + ridge_term
+    lhs = DTD + F.pad(ATA, (0, 0, 0, DTD.shape[-2] - ATA.shape[-2]))
 
-    L = torch.linalg.cholesky(lhs)
-    y = torch.cholesky_solve(rhs.unsqueeze(-1), L).squeeze(-1)  # (..., N)
+    # rhs is A^T w_data b, but we need to include the x_init terms into the rhs as it is a
+    # constant. Then strip off the x_init term
+    lhs, rhs = _eliminate_first_variable(lhs, rhs[..., 1:], v0)
+    lhs = _add_to_diagonal(lhs, v_ridge)
+    y = solve_banded_spd(lhs, rhs)  # (..., N)
 
     return torch.cat([v0.unsqueeze(-1), y], dim=-1)  # (..., N+1)
 
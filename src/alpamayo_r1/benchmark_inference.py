@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Latency benchmark of the full chain-of-causation rollout against the trajectory-only mode:
+# the same clip is rolled out with the full reasoning and with capped reasoning budgets
+# (`cot_budget`, 0 skips the decoding altogether), and the latency and minADE of every mode are
+# reported. With --draft-phrases, the full reasoning is also decoded speculatively with an
+# `NGramDrafter` built from the phrases of that YAML file, and its acceptance rate is reported.
+#
+# Usage: python src/alpamayo_r1/benchmark_inference.py --cot-budgets 0 16 --repeats 10
+#        python src/alpamayo_r1/benchmark_inference.py \
+#            --draft-phrases scenario_framework/driving_decisions.yaml
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from alpamayo_r1.models.alpamayo_r1 import AlpamayoR1
+from alpamayo_r1.models.speculative import NGramDrafter
+from alpamayo_r1.load_physical_aiavdataset import load_physical_aiavdataset
+from alpamayo_r1 import helper
+
+
+def benchmark(model, processor, data, repeats, warmup, **rollout_kwargs):
+    """Time the rollouts of a sample and compute the minADE of their last predictions.
+
+    Returns:
+        The latencies in milliseconds and the minADE in meters.
+    """
+    latencies = []
+    for i in range(warmup + repeats):
+        # the rollout consumes the tokenized inputs, so they are rebuilt for every run
+        model_inputs = helper.to_device(helper.create_batch_inputs(processor, [data]), "cuda")
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.autocast("cuda", dtype=torch.bfloat16):
+            pred_xyz, _ = model.sample_trajectories_from_data_with_vlm_rollout(
+                data=model_inputs, **rollout_kwargs
+            )
+        torch.cuda.synchronize()
+        if i >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    gt_xy = data["ego_future_xyz"].cpu()[0, 0, :, :2].T.numpy()
+    pred_xy = pred_xyz.float().cpu().numpy()[0, 0, :, :, :2].transpose(0, 2, 1)
+    min_ade = np.linalg.norm(pred_xy - gt_xy[None, ...], axis=1).mean(-1).min()
+    return np.array(latencies), min_ade
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the trajectory-only fast mode.")
+    parser.add_argument("--model-path", default="nvidia/Alpamayo-R1-10B")
+    parser.add_argument("--clip-id", default="030c760c-ae38-49aa-9ad8-f5650a545d26")
+    parser.add_argument("--t0-us", type=int, default=5_100_000)
+    parser.add_argument("--attn-implementation", default="flash_attention_2")
+    parser.add_argument("--num-traj-samples", type=int, default=1)
+    parser.add_argument("--max-generation-length", type=int, default=256)
+    parser.add_argument(
+        "--cot-budgets",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="reasoning budgets to compare with the full rollout, 0 skips the reasoning",
+    )
+    parser.add_argument(
+        "--draft-phrases",
+        default=None,
+        help="YAML file of phrases, e.g. scenario_framework/driving_decisions.yaml, to also "
+        "benchmark speculative decoding with an NGramDrafter",
+    )
+    parser.add_argument("--num-draft-tokens", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"Loading dataset for clip_id: {args.clip_id}...")
+    data = load_physical_aiavdataset(args.clip_id, t0_us=args.t0_us)
+    model = AlpamayoR1.from_pretrained(
+        args.model_path, dtype=torch.bfloat16, attn_implementation=args.attn_implementation
+    ).to("cuda")
+    model.eval()
+    processor = helper.get_processor(model.tokenizer)
+
+    modes = [("full CoC", {})]
+    modes += [(f"cot_budget={budget}", {"cot_budget": budget}) for budget in args.cot_budgets]
+    drafter = None
+    if args.draft_phrases is not None:
+        drafter = NGramDrafter.from_yaml(
+            model.tokenizer, args.draft_phrases, num_draft_tokens=args.num_draft_tokens
+        )
+        modes.append(("speculative", {"drafter": drafter}))
+    results = {}
+    for name, mode_kwargs in modes:
+        torch.cuda.manual_seed_all(42)
+        results[name] = benchmark(
+            model,
+            processor,
+            data,
+            args.repeats,
+            args.warmup,
+            top_p=0.98,
+            temperature=0.6,
+            num_traj_samples=args.num_traj_samples,
+            max_generation_length=args.max_generation_length,
+            **mode_kwargs,
+        )
+
+    full_mean = results["full CoC"][0].mean()
+    print(f"{'mode':<16}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'speedup':>10}{'minADE m':>10}")
+    for name, (latencies, min_ade) in results.items():
+        print(
+            f"{name:<16}{latencies.mean():>10.1f}{np.percentile(latencies, 50):>10.1f}"
+            f"{np.percentile(latencies, 90):>10.1f}{full_mean / latencies.mean():>9.2f}x"
+            f"{min_ade:>10.3f}"
+        )
+    if drafter is not None:
+        print(f"speculative acceptance rate: {drafter.acceptance_rate:.1%}")
+
+
+if __name__ == "__main__":
+    main()
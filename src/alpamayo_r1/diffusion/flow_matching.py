@@ -13,26 +13,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Literal
+from typing import Callable, Literal
 
 import torch
 from alpamayo_r1.diffusion.base import BaseDiffusion, StepFn
 
+IntMethod = Literal["euler", "heun", "midpoint", "rk4", "multistep", "adaptive"]
+
 
 class FlowMatching(BaseDiffusion):
     """Flow Matching model.
 
+    The sampling ODE dx/dt = v(x, t) is integrated from noise at t=0 to data at t=1 with one of
+    the following methods, where NFE is the number of `step_fn` calls per step:
+
+    - `euler`: first order, 1 NFE.
+    - `heun`, `midpoint`: second order, 2 NFE.
+    - `rk4`: classic fourth order Runge-Kutta, 4 NFE.
+    - `multistep`: second order Adams-Bashforth, 1 NFE. Like DPM-Solver++(2M), it reuses the
+      velocity of the previous step instead of evaluating intermediate points.
+    - `adaptive`: Bogacki-Shampine 3(2) with error control, 3 NFE per accepted step. The number of
+      steps is chosen from `rtol`/`atol`, `num_inference_steps` only sets the initial step size.
+
     References:
     Flow Matching for Generative Modeling
         https://arxiv.org/pdf/2210.02747
     Guided Flows for Generative Modeling and Decision Making
         https://arxiv.org/pdf/2311.13443
+    DPM-Solver++: Fast Solver for Guided Sampling of Diffusion Probabilistic Models
+        https://arxiv.org/abs/2211.01095
     """
 
     def __init__(
         self,
-        int_method: Literal["euler"] = "euler",
+        int_method: IntMethod = "euler",
         num_inference_steps: int = 10,
+        rtol: float = 1e-2,
+        atol: float = 1e-2,
+        max_inference_steps: int = 100,
         *args,
         **kwargs,
     ):
@@ -41,10 +59,16 @@ class FlowMatching(BaseDiffusion):
         Args:
             int_method: The integration method used in inference.
             num_inference_steps: The number of inference steps.
+            rtol: The relative tolerance of the adaptive integration.
+            atol: The absolute tolerance of the adaptive integration.
+            max_inference_steps: The maximum number of steps of the adaptive integration.
         """
         super().__init__(*args, **kwargs)
         self.int_method = int_method
         self.num_inference_steps = num_inference_steps
+        self.rtol = rtol
+        self.atol = atol
+        self.max_inference_steps = max_inference_steps
 
     @torch.no_grad()
     def sample(
@@ -54,7 +78,9 @@ class FlowMatching(BaseDiffusion):
         device: torch.device = torch.device("cpu"),
         return_all_steps: bool = False,
         inference_step: int | None = None,
-        int_method: Literal["euler"] | None = None,
+        int_method: IntMethod | None = None,
+        rtol: float | None = None,
+        atol: float | None = None,
         *args,
         **kwargs,
     ) -> torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
@@ -67,25 +93,45 @@ class FlowMatching(BaseDiffusion):
             return_all_steps: Whether to return all steps.
             inference_step: The number of inference steps. (override self.num_inference_steps)
             int_method: The integration method used in inference. (override self.int_method)
+            rtol: The relative tolerance of the adaptive integration. (override self.rtol)
+            atol: The absolute tolerance of the adaptive integration. (override self.atol)
 
         Returns:
             torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
                 The final sampled tensor [B, *x_dims] if return_all_steps is False,
                 otherwise a tuple of all sampled tensors [B, T, *x_dims] and the time steps [T].
         """
-        int_method = int_method or self.int_method
-        inference_step = inference_step or self.num_inference_steps
+        int_method = self.int_method if int_method is None else int_method
+        inference_step = self.num_inference_steps if inference_step is None else inference_step
+        if inference_step < 1:
+            raise ValueError(f"Invalid number of inference steps: {inference_step}")
+        sample_kwargs = {
+            "batch_size": batch_size,
+            "step_fn": step_fn,
+            "device": device,
+            "return_all_steps": return_all_steps,
+            "inference_step": inference_step,
+        }
         if int_method == "euler":
-            return self._euler(
-                batch_size=batch_size,
-                step_fn=step_fn,
-                device=device,
-                return_all_steps=return_all_steps,
-                inference_step=inference_step,
+            return self._euler(**sample_kwargs)
+        elif int_method in ("heun", "midpoint", "rk4"):
+            return self._integrate(**sample_kwargs, step=getattr(self, f"_{int_method}_step"))
+        elif int_method == "multistep":
+            return self._multistep(**sample_kwargs)
+        elif int_method == "adaptive":
+            return self._adaptive(
+                **sample_kwargs,
+                rtol=self.rtol if rtol is None else rtol,
+                atol=self.atol if atol is None else atol,
             )
         else:
             raise ValueError(f"Invalid integration method: {int_method}")
 
+    def _expand_time(self, t: torch.Tensor, batch_size: int) -> torch.Tensor:
+        """Broadcast a scalar time to [B, 1, ...] matching the dims of x."""
+        n_dim = len(self.x_dims)
+        return t.view(1, *[1] * n_dim).expand(batch_size, *[1] * n_dim)
+
     def _euler(
         self,
         batch_size: int,
@@ -103,6 +149,70 @@ class FlowMatching(BaseDiffusion):
             return_all_steps: Whether to return all steps.
             inference_step: The inference step.
 
+        Returns:
+            torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+                The final sampled tensor [B, *x_dims] if return_all_steps is False,
+                otherwise a tuple of all sampled tensors [B, T, *x_dims] and the time steps [T].
+        """
+        return self._integrate(
+            batch_size=batch_size,
+            step_fn=step_fn,
+            device=device,
+            return_all_steps=return_all_steps,
+            inference_step=inference_step,
+            step=self._euler_step,
+        )
+
+    def _euler_step(
+        self, step_fn: StepFn, x: torch.Tensor, t: torch.Tensor, dt: torch.Tensor
+    ) -> torch.Tensor:
+        """Advance x from t to t + dt with the Euler method."""
+        return x + dt * step_fn(x=x, t=t)
+
+    def _heun_step(
+        self, step_fn: StepFn, x: torch.Tensor, t: torch.Tensor, dt: torch.Tensor
+    ) -> torch.Tensor:
+        """Advance x from t to t + dt with Heun's method (explicit trapezoidal rule)."""
+        v1 = step_fn(x=x, t=t)
+        v2 = step_fn(x=x + dt * v1, t=t + dt)
+        return x + 0.5 * dt * (v1 + v2)
+
+    def _midpoint_step(
+        self, step_fn: StepFn, x: torch.Tensor, t: torch.Tensor, dt: torch.Tensor
+    ) -> torch.Tensor:
+        """Advance x from t to t + dt with the explicit midpoint method."""
+        v1 = step_fn(x=x, t=t)
+        return x + dt * step_fn(x=x + 0.5 * dt * v1, t=t + 0.5 * dt)
+
+    def _rk4_step(
+        self, step_fn: StepFn, x: torch.Tensor, t: torch.Tensor, dt: torch.Tensor
+    ) -> torch.Tensor:
+        """Advance x from t to t + dt with the classic fourth order Runge-Kutta method."""
+        v1 = step_fn(x=x, t=t)
+        v2 = step_fn(x=x + 0.5 * dt * v1, t=t + 0.5 * dt)
+        v3 = step_fn(x=x + 0.5 * dt * v2, t=t + 0.5 * dt)
+        v4 = step_fn(x=x + dt * v3, t=t + dt)
+        return x + dt / 6 * (v1 + 2 * v2 + 2 * v3 + v4)
+
+    def _integrate(
+        self,
+        batch_size: int,
+        step_fn: StepFn,
+        step: Callable[[StepFn, torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor],
+        device: torch.device = torch.device("cpu"),
+        return_all_steps: bool = False,
+        inference_step: int | None = None,
+    ) -> torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+        """Fixed step integration for flow matching with a one-step method.
+
+        Args:
+            batch_size: The batch size.
+            step_fn: The denoising step function.
+            step: The one-step method, mapping (step_fn, x, t, dt) to x at t + dt.
+            device: The device to use.
+            return_all_steps: Whether to return all steps.
+            inference_step: The inference step.
+
         Returns:
             torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
                 The final sampled tensor [B, *x_dims] if return_all_steps is False,
@@ -110,18 +220,138 @@ class FlowMatching(BaseDiffusion):
         """
         x = torch.randn(batch_size, *self.x_dims, device=device)
         time_steps = torch.linspace(0.0, 1.0, inference_step + 1, device=device)
-        n_dim = len(self.x_dims)
         if return_all_steps:
             all_steps = [x]
 
         for i in range(inference_step):
-            dt = time_steps[i + 1] - time_steps[i]
-            dt = dt.view(1, *[1] * n_dim).expand(batch_size, *[1] * n_dim)
-            t_start = time_steps[i].view(1, *[1] * n_dim).expand(batch_size, *[1] * n_dim)
+            dt = self._expand_time(time_steps[i + 1] - time_steps[i], batch_size)
+            t_start = self._expand_time(time_steps[i], batch_size)
+            x = step(step_fn, x, t_start, dt)
+            if return_all_steps:
+                all_steps.append(x)
+        if return_all_steps:
+            return torch.stack(all_steps, dim=1), time_steps
+        return x
+
+    def _multistep(
+        self,
+        batch_size: int,
+        step_fn: StepFn,
+        device: torch.device = torch.device("cpu"),
+        return_all_steps: bool = False,
+        inference_step: int | None = None,
+    ) -> torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+        """Second order Adams-Bashforth integration for flow matching.
+
+        The first step is an Euler step, the following ones extrapolate the velocity linearly
+        from the current and the previous evaluations, so every step costs a single `step_fn`
+        call.
+
+        Args:
+            batch_size: The batch size.
+            step_fn: The denoising step function.
+            device: The device to use.
+            return_all_steps: Whether to return all steps.
+            inference_step: The inference step.
+
+        Returns:
+            torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+                The final sampled tensor [B, *x_dims] if return_all_steps is False,
+                otherwise a tuple of all sampled tensors [B, T, *x_dims] and the time steps [T].
+        """
+        x = torch.randn(batch_size, *self.x_dims, device=device)
+        time_steps = torch.linspace(0.0, 1.0, inference_step + 1, device=device)
+        if return_all_steps:
+            all_steps = [x]
+
+        v_prev, dt_prev = None, None
+        for i in range(inference_step):
+            dt = self._expand_time(time_steps[i + 1] - time_steps[i], batch_size)
+            t_start = self._expand_time(time_steps[i], batch_size)
             v = step_fn(x=x, t=t_start)
-            x = x + dt * v
+            if v_prev is None:
+                x = x + dt * v
+            else:
+                # variable step size Adams-Bashforth 2
+                ratio = dt / dt_prev
+                x = x + dt * ((1 + 0.5 * ratio) * v - 0.5 * ratio * v_prev)
+            v_prev, dt_prev = v, dt
             if return_all_steps:
                 all_steps.append(x)
         if return_all_steps:
             return torch.stack(all_steps, dim=1), time_steps
         return x
+
+    def _adaptive(
+        self,
+        batch_size: int,
+        step_fn: StepFn,
+        device: torch.device = torch.device("cpu"),
+        return_all_steps: bool = False,
+        inference_step: int | None = None,
+        rtol: float = 1e-2,
+        atol: float = 1e-2,
+    ) -> torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+        """Adaptive step integration for flow matching with the Bogacki-Shampine 3(2) pair.
+
+        The step size is shared by the whole batch and controlled by the worst per-sample RMS
+        error, so that `step_fn` always runs on the full batch. The last velocity of an accepted
+        step is reused as the first one of the next step (first same as last).
+
+        Args:
+            batch_size: The batch size.
+            step_fn: The denoising step function.
+            device: The device to use.
+            return_all_steps: Whether to return all steps.
+            inference_step: The number of steps of the initial step size.
+            rtol: The relative tolerance.
+            atol: The absolute tolerance.
+
+        Returns:
+            torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+                The final sampled tensor [B, *x_dims] if return_all_steps is False,
+                otherwise a tuple of all sampled tensors [B, T, *x_dims] and the time steps [T].
+        """
+        x = torch.randn(batch_size, *self.x_dims, device=device)
+        if return_all_steps:
+            all_steps = [x]
+        time_steps = [0.0]
+
+        def velocity(x_t: torch.Tensor, t: float) -> torch.Tensor:
+            return step_fn(x=x_t, t=self._expand_time(torch.tensor(t, device=device), batch_size))
+
+        t, dt = 0.0, 1.0 / inference_step
+        v1 = velocity(x, t)
+        num_steps = 0
+        while t < 1.0:
+            if num_steps >= self.max_inference_steps:
+                raise RuntimeError(
+                    f"Adaptive integration did not reach t=1 in {self.max_inference_steps} steps"
+                )
+            num_steps += 1
+            is_last = dt >= 1.0 - t
+            if is_last:
+                dt = 1.0 - t
+
+            v2 = velocity(x + 0.5 * dt * v1, t + 0.5 * dt)
+            v3 = velocity(x + 0.75 * dt * v2, t + 0.75 * dt)
+            x_next = x + dt * (2 / 9 * v1 + 1 / 3 * v2 + 4 / 9 * v3)
+            v4 = velocity(x_next, t + dt)
+            # difference between the third and the embedded second order solutions
+            error = dt * (-5 / 72 * v1 + 1 / 12 * v2 + 1 / 9 * v3 - 1 / 8 * v4)
+            scale = atol + rtol * torch.maximum(x.abs(), x_next.abs())
+            error_norm = (error / scale).pow(2).flatten(1).mean(dim=1).sqrt().max().item()
+
+            if error_norm <= 1.0:
+                t = 1.0 if is_last else t + dt
+                x, v1 = x_next, v4
+                time_steps.append(t)
+                if return_all_steps:
+                    all_steps.append(x)
+            # standard step size controller for a third order method
+            factor = 5.0 if error_norm == 0.0 else 0.9 * error_norm ** (-1 / 3)
+            dt = dt * min(5.0, max(0.2, factor))
+
+        if return_all_steps:
+            return torch.stack(all_steps, dim=1), torch.tensor(time_steps, device=device)
+        return x
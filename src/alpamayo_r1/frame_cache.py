@@ -0,0 +1,163 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent on-disk cache of decoded camera frames and sampled egomotion."""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class FrameCache:
+    """Size-bounded on-disk cache of decoded data, keyed by (clip_id, feature, timestamp).
+
+    Every entry is a single-record structured numpy array saved as a `.npy` file under
+    `cache_dir/clip_id/feature/timestamp.npy`, which is read back memory-mapped. Entries are
+    written atomically, so several threads or processes can share a cache directory. When the
+    cache grows beyond `max_bytes`, the least recently used entries of this process are evicted,
+    and entries found on disk at startup are ordered by their modification time.
+
+    Example:
+        >>> frame_cache = FrameCache("~/.cache/alpamayo_r1/frames", max_bytes=20 * 2**30)
+        >>> data = load_physical_aiavdataset(clip_id, t0_us, frame_cache=frame_cache)
+        >>> frame_cache.hits, frame_cache.misses
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike, max_bytes: int = 50 * 2**30):
+        """Initialize the FrameCache.
+
+        Args:
+            cache_dir: The directory of the cache, created if it does not exist.
+            max_bytes: The maximum total size of the cached entries in bytes.
+        """
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # path -> size in bytes, from the least to the most recently used
+        self._entries: OrderedDict[Path, int] = OrderedDict()
+        self._total_bytes = 0
+        self._scan()
+
+    def _scan(self) -> None:
+        """Index the entries already on disk, from the oldest to the newest."""
+        entries = []
+        for path in self.cache_dir.glob("*/*/*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._entries[path] = size
+            self._total_bytes += size
+
+    @property
+    def total_bytes(self) -> int:
+        """The total size of the cached entries in bytes."""
+        return self._total_bytes
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit/miss/eviction counters and the size of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+        }
+
+    def _path(self, clip_id: str, feature: str, timestamp: int) -> Path:
+        return self.cache_dir / clip_id / feature / f"{int(timestamp)}.npy"
+
+    def get(self, clip_id: str, feature: str, timestamp: int) -> np.ndarray | None:
+        """Get the memory-mapped record of an entry, or None if it is not cached.
+
+        Args:
+            clip_id: The clip ID.
+            feature: The name of the feature, e.g. a camera name or "egomotion".
+            timestamp: The requested timestamp in microseconds.
+
+        Returns:
+            The single-record structured array passed to `put`, memory-mapped read-only.
+        """
+        path = self._path(clip_id, feature, timestamp)
+        try:
+            record = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            tracked = path in self._entries
+            if tracked:
+                self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if not tracked:
+            # written by another process after the scan, counted from now on
+            try:
+                self._add(path, path.stat().st_size)
+            except FileNotFoundError:
+                pass
+        return record
+
+    def put(self, clip_id: str, feature: str, timestamp: int, record: np.ndarray) -> None:
+        """Store the record of an entry and evict the least recently used ones if needed.
+
+        Args:
+            clip_id: The clip ID.
+            feature: The name of the feature, e.g. a camera name or "egomotion".
+            timestamp: The requested timestamp in microseconds.
+            record: A single-record structured array.
+        """
+        path = self._path(clip_id, feature, timestamp)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, record)
+        os.replace(tmp_path, path)
+        self._add(path, path.stat().st_size)
+
+    def _add(self, path: Path, size: int) -> None:
+        """Track an entry as the most recently used one and evict the least recently used ones."""
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_path)
+            self.evictions += len(evicted)
+        for old_path in evicted:
+            try:
+                old_path.unlink()
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logger.debug(f"Evicted {len(evicted)} entries from the frame cache")
@@ -68,6 +68,29 @@ def euler_2_so3(euler_angles: np.ndarray, degrees: bool = True, seq: str = "xyz"
     )
 
 
+def quat_to_so3_torch(quat: torch.Tensor) -> torch.Tensor:
+    """Converts quaternions to so3 rotation matrices, with the same convention as scipy.
+
+    Args:
+        quat (torch.Tensor): [..., 4] quaternions in scalar-last (x, y, z, w) order, normalized
+            before the conversion
+
+    Returns:
+        torch.Tensor: [..., 3, 3] rotation matrices
+    """
+    x, y, z, w = (quat / torch.linalg.vector_norm(quat, dim=-1, keepdim=True)).unbind(-1)
+    xx, yy, zz, ww = x * x, y * y, z * z, w * w
+    xy, zw, xz, yw, yz, xw = x * y, z * w, x * z, y * w, y * z, x * w
+    return torch.stack(
+        [
+            torch.stack([xx - yy - zz + ww, 2 * (xy - zw), 2 * (xz + yw)], dim=-1),
+            torch.stack([2 * (xy + zw), -xx + yy - zz + ww, 2 * (yz - xw)], dim=-1),
+            torch.stack([2 * (xz - yw), 2 * (yz + xw), -xx - yy + zz + ww], dim=-1),
+        ],
+        dim=-2,
+    )
+
+
 def angle_wrap(
     radians: TensorOrNDArray,
 ) -> TensorOrNDArray:
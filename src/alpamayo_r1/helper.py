@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from transformers import AutoProcessor, AutoTokenizer
+from transformers import AutoProcessor, AutoTokenizer, BatchFeature
 
 from typing import Any
 
 import torch
 import collections.abc
+import functools
+
+from alpamayo_r1.image_processor import TensorImageProcessor
 
 MIN_PIXELS = 163840
 MAX_PIXELS = 196608
@@ -79,21 +82,212 @@ def get_processor(tokenizer: AutoTokenizer) -> AutoProcessor:
     return processor
 
 
+class PromptTemplate:
+    """The tokenized prompt of `create_message`, with slots for the image tokens of its frames.
+
+    The chat template is rendered and tokenized once, split at the image tokens of the frames.
+    Since the image tokens are special tokens, the tokenizer never merges them with the text
+    around them, so splicing runs of image tokens between the pre-tokenized static spans (the
+    system prompt, the `<|traj_history|>` slots and the instruction) gives the same input_ids as
+    tokenizing the whole expanded prompt.
+
+    Example:
+        >>> template = get_prompt_template(processor, num_images=16)
+        >>> inputs = template.batch_encode([num_image_tokens] * batch_size)
+    """
+
+    def __init__(self, processor: AutoProcessor, num_images: int):
+        """Render and tokenize the static spans of the prompt.
+
+        Args:
+            processor: The processor returned by `get_processor`.
+            num_images: The number of frames of the prompt, e.g. N_cameras * num_frames.
+        """
+        self.num_images = num_images
+        self.image_token_id = processor.tokenizer.convert_tokens_to_ids(processor.image_token)
+        self.pad_token_id = processor.tokenizer.pad_token_id
+        # the images are not loaded when the template is only rendered to text
+        message = create_message(torch.zeros(num_images, 3, 1, 1, dtype=torch.uint8))
+        text = processor.apply_chat_template(
+            message,
+            tokenize=False,
+            add_generation_prompt=False,
+            continue_final_message=True,
+        )
+        spans = text.split(processor.image_token)
+        assert len(spans) == num_images + 1, f"{len(spans)=}, expected {num_images + 1}"
+        self.spans = [
+            processor.tokenizer(span, add_special_tokens=False)["input_ids"] for span in spans
+        ]
+
+    def encode(self, num_image_tokens: int | list[int]) -> list[int]:
+        """Get the input_ids of the prompt.
+
+        Args:
+            num_image_tokens: The number of image tokens of every frame, or of each frame.
+
+        Returns:
+            The input_ids of the prompt.
+        """
+        if isinstance(num_image_tokens, int):
+            num_image_tokens = [num_image_tokens] * self.num_images
+        input_ids = list(self.spans[0])
+        for num_tokens, span in zip(num_image_tokens, self.spans[1:], strict=True):
+            input_ids += [self.image_token_id] * num_tokens
+            input_ids += span
+        return input_ids
+
+    def batch_encode(self, num_image_tokens: list[int | list[int]]) -> dict[str, torch.Tensor]:
+        """Get the left-padded input_ids and attention_mask of a batch of prompts.
+
+        Args:
+            num_image_tokens: The number of image tokens of the frames of each prompt, see `encode`.
+
+        Returns:
+            A dictionary with the (B, L) input_ids and attention_mask, padded on the left as with
+            the processor.
+        """
+        return _left_pad([self.encode(row) for row in num_image_tokens], self.pad_token_id)
+
+
+def _left_pad(rows: list[list[int]], pad_token_id: int) -> dict[str, torch.Tensor]:
+    """Collate token rows into left-padded (B, L) input_ids and attention_mask."""
+    max_len = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+    for i, row in enumerate(rows):
+        input_ids[i, max_len - len(row) :] = torch.tensor(row, dtype=torch.long)
+        attention_mask[i, max_len - len(row) :] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+@functools.lru_cache(maxsize=8)
+def _get_prompt_template(
+    processor: AutoProcessor, tokenizer: AutoTokenizer, num_images: int
+) -> PromptTemplate:
+    del tokenizer  # only part of the key, so that replacing the tokenizer rebuilds the template
+    return PromptTemplate(processor, num_images)
+
+
+def get_prompt_template(processor: AutoProcessor, num_images: int) -> PromptTemplate:
+    """Get the prompt template of a processor, tokenized once per tokenizer and number of frames."""
+    return _get_prompt_template(processor, processor.tokenizer, num_images)
+
+
+def create_batch_inputs(
+    processor: AutoProcessor,
+    samples: list[dict[str, Any]],
+    image_processor: TensorImageProcessor | None = None,
+    device: str | torch.device | None = None,
+) -> dict[str, Any]:
+    """Tokenize and collate several loaded clips into one left-padded batch of model inputs.
+
+    Args:
+        processor: The processor returned by `get_processor`.
+        samples: Outputs of `load_physical_aiavdataset`, one per clip.
+        image_processor: Optional `TensorImageProcessor` computing the pixel values with torch ops
+            on the device of the frames, instead of the CPU image pipeline of the processor.
+        device: The device to move the frames to before `image_processor`, e.g. "cuda".
+
+    Returns:
+        The `data` dict expected by `AlpamayoR1.sample_trajectories_from_data_with_vlm_rollout`
+        with batch size len(samples).
+    """
+    messages = [create_message(sample["image_frames"].flatten(0, 1)) for sample in samples]
+    # left padding keeps the generated tokens aligned across the rows of the batch
+    if image_processor is None:
+        inputs = processor.apply_chat_template(
+            messages,
+            tokenize=True,
+            add_generation_prompt=False,
+            continue_final_message=True,
+            return_dict=True,
+            return_tensors="pt",
+            padding=True,
+            padding_side="left",
+        )
+    else:
+        image_inputs = _process_images(image_processor, samples, device)
+        # same input_ids as the processor, without rendering and tokenizing the prompt again.
+        # The samples may have different numbers of frames, e.g. of cameras.
+        num_images = [
+            sample["image_frames"].shape[0] * sample["image_frames"].shape[1] for sample in samples
+        ]
+        num_image_tokens = (
+            image_inputs["image_grid_thw"].prod(dim=-1) // image_processor.image_token_merge_length
+        )
+        rows = [
+            get_prompt_template(processor, n).encode(tokens.tolist())
+            for n, tokens in zip(num_images, num_image_tokens.split(num_images), strict=True)
+        ]
+        inputs = BatchFeature(
+            data={**_left_pad(rows, processor.tokenizer.pad_token_id), **image_inputs}
+        )
+    return {
+        "tokenized_data": inputs,
+        "ego_history_xyz": torch.cat([sample["ego_history_xyz"] for sample in samples], dim=0),
+        "ego_history_rot": torch.cat([sample["ego_history_rot"] for sample in samples], dim=0),
+    }
+
+
+def _process_images(
+    image_processor: TensorImageProcessor,
+    samples: list[dict[str, Any]],
+    device: str | torch.device | None,
+) -> dict[str, torch.Tensor]:
+    """Preprocess the frames of the samples with one `image_processor` call per frame size.
+
+    The frames of every sample are moved to `device` on their own, so that the copies of pinned
+    frames stay asynchronous, and are only concatenated there.
+    """
+    frames = [
+        sample["image_frames"].flatten(0, 1).to(device, non_blocking=True) for sample in samples
+    ]
+    # TensorImageProcessor preprocesses frames of a single size at a time
+    groups: dict[tuple[int, int], list[int]] = {}
+    for i, sample_frames in enumerate(frames):
+        groups.setdefault(tuple(sample_frames.shape[-2:]), []).append(i)
+    if len(groups) == 1:
+        return image_processor(torch.cat(frames))
+    pixel_values, image_grid_thw = [None] * len(samples), [None] * len(samples)
+    for indices in groups.values():
+        num_images = [frames[i].shape[0] for i in indices]
+        group_inputs = image_processor(torch.cat([frames[i] for i in indices]))
+        # all the images of a group have the same number of patches
+        num_patches = group_inputs["pixel_values"].shape[0] // sum(num_images)
+        values = group_inputs["pixel_values"].split([n * num_patches for n in num_images])
+        grids_thw = group_inputs["image_grid_thw"].split(num_images)
+        for i, sample_values, grid_thw in zip(indices, values, grids_thw, strict=True):
+            pixel_values[i], image_grid_thw[i] = sample_values, grid_thw
+    return {"pixel_values": torch.cat(pixel_values), "image_grid_thw": torch.cat(image_grid_thw)}
+
+
 def to_device(
     data: Any,
     device: str | torch.device | None = None,
     dtype: torch.dtype | None = None,
+    non_blocking: bool = False,
 ) -> Any:
-    """Recursively cast data into the specified device, dtype."""
+    """Recursively cast data into the specified device, dtype.
+
+    With `non_blocking=True`, the copies of tensors in pinned memory, e.g. the frames loaded with
+    `pin_memory=True`, are asynchronous with respect to the host.
+    """
     if isinstance(data, torch.Tensor):
         data = data.to(
             device=device,
             dtype=dtype,
+            non_blocking=non_blocking,
         )
         return data
     elif isinstance(data, collections.abc.Mapping):
-        return {key: to_device(data[key], device=device, dtype=dtype) for key in data}
+        return {
+            key: to_device(data[key], device=device, dtype=dtype, non_blocking=non_blocking)
+            for key in data
+        }
     elif isinstance(data, collections.abc.Sequence) and not isinstance(data, (str, bytes)):
-        return [to_device(elem, device=device, dtype=dtype) for elem in data]
+        return [
+            to_device(elem, device=device, dtype=dtype, non_blocking=non_blocking) for elem in data
+        ]
     else:
         return data
@@ -0,0 +1,155 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tensor-native replacement of the image preprocessing of the Qwen3-VL processor."""
+
+from typing import Any
+
+import torch
+import torch.nn.functional as F
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+
+class TensorImageProcessor:
+    """Computes the `pixel_values` and `image_grid_thw` of the Qwen3-VL processor from uint8 frames.
+
+    The frames are resized, normalized and patchified with batched torch ops on their own device,
+    e.g. straight from the pinned frame buffer copied to the GPU, instead of image by image on the
+    CPU. The resize is the antialiased bicubic resize of the HF processor, rounded to uint8 levels
+    in the same way, so the outputs match the processor up to the rounding of its uint8 resize.
+
+    Example:
+        >>> image_processor = TensorImageProcessor.from_processor(processor)
+        >>> model_inputs = helper.create_batch_inputs(processor, samples, image_processor)
+    """
+
+    def __init__(
+        self,
+        min_pixels: int,
+        max_pixels: int,
+        patch_size: int = 16,
+        temporal_patch_size: int = 2,
+        merge_size: int = 2,
+        image_mean: tuple[float, float, float] = (0.5, 0.5, 0.5),
+        image_std: tuple[float, float, float] = (0.5, 0.5, 0.5),
+    ):
+        """Initialize the TensorImageProcessor.
+
+        Args:
+            min_pixels: The minimum number of pixels of the resized images.
+            max_pixels: The maximum number of pixels of the resized images.
+            patch_size: The spatial patch size of the vision encoder.
+            temporal_patch_size: The temporal patch size of the vision encoder, images are repeated
+                to fill it.
+            merge_size: The number of patches merged along each side by the vision encoder.
+            image_mean: The per-channel mean subtracted from the images rescaled to [0, 1].
+            image_std: The per-channel std dividing the images rescaled to [0, 1].
+        """
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.patch_size = patch_size
+        self.temporal_patch_size = temporal_patch_size
+        self.merge_size = merge_size
+        self.image_mean = tuple(image_mean)
+        self.image_std = tuple(image_std)
+
+    @classmethod
+    def from_processor(cls, processor: Any) -> "TensorImageProcessor":
+        """Create the preprocessor matching the image processor of a Qwen3-VL processor.
+
+        Args:
+            processor: The processor returned by `helper.get_processor`.
+
+        Returns:
+            The TensorImageProcessor with the same sizes, patching and normalization.
+        """
+        image_processor = processor.image_processor
+        return cls(
+            min_pixels=image_processor.size["shortest_edge"],
+            max_pixels=image_processor.size["longest_edge"],
+            patch_size=image_processor.patch_size,
+            temporal_patch_size=image_processor.temporal_patch_size,
+            merge_size=image_processor.merge_size,
+            image_mean=image_processor.image_mean,
+            image_std=image_processor.image_std,
+        )
+
+    @property
+    def image_token_merge_length(self) -> int:
+        """The number of patches per image token."""
+        return self.merge_size**2
+
+    def __call__(self, frames: torch.Tensor) -> dict[str, torch.Tensor]:
+        """Preprocess a batch of frames of the same size.
+
+        Args:
+            frames: (N, 3, H, W) uint8 frames, on any device.
+
+        Returns:
+            A dictionary with the following keys:
+                - pixel_values: torch.Tensor of shape (N * grid_h * grid_w, 3 * temporal_patch_size
+                    * patch_size * patch_size), float32 on the device of the frames
+                - image_grid_thw: torch.Tensor of shape (N, 3), the (1, grid_h, grid_w) grid of
+                    every image
+        """
+        assert frames.ndim == 4, f"{frames.ndim=}, expected (N, C, H, W)"
+        num_images, channels, height, width = frames.shape
+        resized_height, resized_width = smart_resize(
+            height,
+            width,
+            factor=self.patch_size * self.merge_size,
+            min_pixels=self.min_pixels,
+            max_pixels=self.max_pixels,
+        )
+
+        images = frames.float()
+        if (resized_height, resized_width) != (height, width):
+            images = F.interpolate(
+                images,
+                size=(resized_height, resized_width),
+                mode="bicubic",
+                align_corners=False,
+                antialias=True,
+            )
+            # the HF processor resizes uint8 images to uint8 images
+            images = images.clamp_(0, 255).round_()
+
+        # rescale to [0, 1] and normalize in one step
+        mean = torch.tensor(self.image_mean, device=images.device) * 255
+        std = torch.tensor(self.image_std, device=images.device) * 255
+        images = images.sub_(mean[:, None, None]).div_(std[:, None, None])
+
+        # every image is repeated to fill a temporal patch
+        grid_h, grid_w = resized_height // self.patch_size, resized_width // self.patch_size
+        patches = images[:, None].expand(-1, self.temporal_patch_size, -1, -1, -1)
+        patches = patches.reshape(
+            num_images,
+            self.temporal_patch_size,
+            channels,
+            grid_h // self.merge_size,
+            self.merge_size,
+            self.patch_size,
+            grid_w // self.merge_size,
+            self.merge_size,
+            self.patch_size,
+        )
+        # (N, grid_h / merge, grid_w / merge, merge, merge, C, temporal, patch, patch)
+        patches = patches.permute(0, 3, 6, 4, 7, 2, 1, 5, 8)
+        pixel_values = patches.reshape(
+            num_images * grid_h * grid_w,
+            channels * self.temporal_patch_size * self.patch_size * self.patch_size,
+        )
+        image_grid_thw = torch.tensor([[1, grid_h, grid_w]] * num_images)
+        return {"pixel_values": pixel_values, "image_grid_thw": image_grid_thw}
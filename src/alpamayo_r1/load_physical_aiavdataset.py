@@ -15,14 +15,195 @@
 
 """Load data from physical_ai_av.PhysicalAIAVDatasetInterface for model inference."""
 
+from collections import deque
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from typing import Any
 
 import numpy as np
 import physical_ai_av
-import scipy.spatial.transform as spt
 import torch
 from einops import rearrange
 
+from alpamayo_r1.frame_cache import FrameCache
+from alpamayo_r1.geometry.rotation import quat_to_so3_torch
+
+
+CAMERA_NAME_TO_INDEX = {
+    "camera_cross_left_120fov": 0,
+    "camera_front_wide_120fov": 1,
+    "camera_cross_right_120fov": 2,
+    "camera_rear_left_70fov": 3,
+    "camera_rear_tele_30fov": 4,
+    "camera_rear_right_70fov": 5,
+    "camera_front_tele_30fov": 6,
+}
+
+
+def _sample_egomotion(
+    avdi: physical_ai_av.PhysicalAIAVDatasetInterface,
+    clip_id: str,
+    timestamps: np.ndarray,
+    maybe_stream: bool,
+    frame_cache: FrameCache | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sample the egomotion poses of a clip, only loading the egomotion on cache misses.
+
+    Returns:
+        xyz: (T, 3) the translations at the timestamps
+        quat: (T, 4) the rotations at the timestamps as quaternions
+    """
+    xyz = np.zeros((len(timestamps), 3))
+    quat = np.zeros((len(timestamps), 4))
+    missing = []
+    for i, timestamp in enumerate(timestamps):
+        record = None if frame_cache is None else frame_cache.get(clip_id, "egomotion", timestamp)
+        if record is None:
+            missing.append(i)
+        else:
+            xyz[i], quat[i] = record["translation"][0], record["quat"][0]
+    if not missing:
+        return xyz, quat
+
+    # Load egomotion data
+    egomotion = avdi.get_clip_feature(
+        clip_id,
+        avdi.features.LABELS.EGOMOTION,
+        maybe_stream=maybe_stream,
+    )
+    ego = egomotion(timestamps[missing])
+    xyz[missing] = ego.pose.translation
+    quat[missing] = ego.pose.rotation.as_quat()
+    if frame_cache is not None:
+        for i in missing:
+            record = np.zeros(1, dtype=[("translation", np.float64, 3), ("quat", np.float64, 4)])
+            record["translation"], record["quat"] = xyz[i], quat[i]
+            frame_cache.put(clip_id, "egomotion", timestamps[i], record)
+    return xyz, quat
+
+
+def _trajectory_timestamps(
+    t0_us: int, num_history_steps: int, num_future_steps: int, time_step: float
+) -> np.ndarray:
+    """Returns the (num_history_steps + num_future_steps,) history and future timestamps of t0."""
+    # History: [..., t0-0.2s, t0-0.1s, t0] (num_history_steps points ending at t0)
+    # Future: [t0+0.1s, t0+0.2s, ..., t0+6.4s] (num_future_steps points after t0)
+    history_offsets_us = np.arange(
+        -(num_history_steps - 1) * time_step * 1_000_000,
+        time_step * 1_000_000 / 2,
+        time_step * 1_000_000,
+    ).astype(np.int64)
+    future_offsets_us = np.arange(
+        time_step * 1_000_000,
+        (num_future_steps + 0.5) * time_step * 1_000_000,
+        time_step * 1_000_000,
+    ).astype(np.int64)
+    return t0_us + np.concatenate([history_offsets_us, future_offsets_us])
+
+
+def _image_timestamps(t0_us: int, num_frames: int, time_step: float) -> np.ndarray:
+    """Returns the (num_frames,) image timestamps of t0."""
+    # Image timestamps: if num_frames=4, load at [t0-0.3s, t0-0.2s, t0-0.1s, t0]
+    return np.array(
+        [t0_us - (num_frames - 1 - i) * int(time_step * 1_000_000) for i in range(num_frames)],
+        dtype=np.int64,
+    )
+
+
+def _to_local_trajectories(
+    ego_xyz: np.ndarray, ego_quat: np.ndarray, num_history_steps: int
+) -> dict[str, torch.Tensor]:
+    """Split the poses of B t0s into history and future trajectories in the ego frame at each t0.
+
+    Args:
+        ego_xyz: (B, num_history_steps + num_future_steps, 3) the translations.
+        ego_quat: (B, num_history_steps + num_future_steps, 4) the rotations as quaternions.
+        num_history_steps: The number of history steps, the last one is t0.
+
+    Returns:
+        The ego_history_xyz/rot and ego_future_xyz/rot entries of `load_physical_aiavdataset`,
+        with shapes (B, 1, T, 3) and (B, 1, T, 3, 3).
+    """
+    # Transform to local frame (relative to t0 pose)
+    # The model expects trajectories in the ego frame at t0.
+    # Transformation: xyz_local = R_t0^{-1} @ (xyz_world - xyz_t0), computed in float64
+    xyz = torch.from_numpy(ego_xyz)[:, None]  # (B, 1, T, 3)
+    rot = quat_to_so3_torch(torch.from_numpy(ego_quat))[:, None]  # (B, 1, T, 3, 3)
+    t0_xyz = xyz[:, :, num_history_steps - 1 : num_history_steps]  # Position at t0
+    t0_rot = rot[:, :, num_history_steps - 1]  # Orientation at t0, (B, 1, 3, 3)
+
+    # row vectors: R_t0^{-1} @ x = x @ R_t0
+    xyz_local = (xyz - t0_xyz) @ t0_rot
+    rot_local = t0_rot.transpose(-1, -2).unsqueeze(-3) @ rot
+
+    # (B, n_traj_group=1, T, ...), only the float32 outputs are copied out
+    return {
+        "ego_history_xyz": xyz_local[:, :, :num_history_steps].float(),
+        "ego_history_rot": rot_local[:, :, :num_history_steps].float(),
+        "ego_future_xyz": xyz_local[:, :, num_history_steps:].float(),
+        "ego_future_rot": rot_local[:, :, num_history_steps:].float(),
+    }
+
+
+def _load_camera(
+    avdi: physical_ai_av.PhysicalAIAVDatasetInterface,
+    clip_id: str,
+    cam_feature: str,
+    image_timestamps: np.ndarray,
+    maybe_stream: bool,
+    frame_cache: FrameCache | None = None,
+) -> tuple[torch.Tensor, int, torch.Tensor]:
+    """Decode the frames of one camera at the given timestamps, only decoding cache misses.
+
+    Returns:
+        frames: torch.Tensor of shape (num_frames, 3, H, W)
+        cam_idx: the index of the camera
+        timestamps: torch.Tensor of shape (num_frames,), the timestamps of the decoded frames
+    """
+    # Extract camera name from feature path
+    if isinstance(cam_feature, str):
+        cam_name = cam_feature.split("/")[-1] if "/" in cam_feature else cam_feature
+        cam_name = cam_name.lower()
+    else:
+        raise ValueError(f"Unexpected camera feature type: {type(cam_feature)}")
+    cam_idx = CAMERA_NAME_TO_INDEX.get(cam_name, 0)
+
+    frames = [None] * len(image_timestamps)
+    frame_timestamps = np.zeros(len(image_timestamps), dtype=np.int64)
+    missing = []
+    for i, timestamp in enumerate(image_timestamps):
+        record = None if frame_cache is None else frame_cache.get(clip_id, cam_name, timestamp)
+        if record is None:
+            missing.append(i)
+        else:
+            frames[i], frame_timestamps[i] = record["frame"][0], record["timestamp"][0]
+
+    if missing:
+        camera = avdi.get_clip_feature(
+            clip_id,
+            cam_feature,
+            maybe_stream=maybe_stream,
+        )
+        # decoded: (len(missing), H, W, 3) uint8
+        decoded, decoded_timestamps = camera.decode_images_from_timestamps(
+            image_timestamps[missing]
+        )
+        for j, i in enumerate(missing):
+            frames[i], frame_timestamps[i] = decoded[j], decoded_timestamps[j]
+            if frame_cache is not None:
+                record = np.zeros(
+                    1, dtype=[("timestamp", np.int64), ("frame", decoded.dtype, decoded.shape[1:])]
+                )
+                record["timestamp"], record["frame"] = decoded_timestamps[j], decoded[j]
+                frame_cache.put(clip_id, cam_name, image_timestamps[i], record)
+    # frames: (num_frames, H, W, 3) uint8
+    frames = decoded if len(missing) == len(frames) else np.stack(frames)
+
+    # Convert to (num_frames, 3, H, W) for model input
+    frames_tensor = torch.from_numpy(frames)
+    frames_tensor = rearrange(frames_tensor, "t h w c -> t c h w")
+    return frames_tensor, cam_idx, torch.from_numpy(frame_timestamps.astype(np.int64))
+
 
 def load_physical_aiavdataset(
     clip_id: str,
@@ -34,6 +215,9 @@ def load_physical_aiavdataset(
     time_step: float = 0.1,
     camera_features: list | None = None,
     num_frames: int = 4,
+    executor: Executor | None = None,
+    frame_cache: FrameCache | None = None,
+    pin_memory: bool = False,
 ) -> dict[str, Any]:
     """Load data from physical_ai_av for model inference.
 
@@ -53,6 +237,12 @@ def load_physical_aiavdataset(
             [CAMERA_FRONT_WIDE_120FOV, CAMERA_FRONT_TELE_30FOV,
              CAMERA_CROSS_LEFT_120FOV, CAMERA_CROSS_RIGHT_120FOV].
         num_frames: Number of frames per camera to load (default: 4).
+        executor: Optional executor, e.g. a `ThreadPoolExecutor`, to load the egomotion and
+            decode the cameras concurrently. If None, they are loaded one after the other.
+        frame_cache: Optional on-disk cache of the decoded frames and sampled egomotion. Only the
+            frames and poses that are not cached yet are decoded.
+        pin_memory: Whether to decode the frames into page-locked memory, so that they can be
+            copied to the GPU asynchronously, e.g. with `helper.to_device(..., non_blocking=True)`.
 
     Returns:
         A dictionary with the following keys:
@@ -67,6 +257,85 @@ def load_physical_aiavdataset(
             - t0_us: The t0 timestamp used
             - clip_id: The clip ID
     """
+    batch = next(
+        iter_physical_aiavdataset_t0s(
+            clip_id,
+            [t0_us],
+            avdi=avdi,
+            maybe_stream=maybe_stream,
+            num_history_steps=num_history_steps,
+            num_future_steps=num_future_steps,
+            time_step=time_step,
+            camera_features=camera_features,
+            num_frames=num_frames,
+            executor=executor,
+            frame_cache=frame_cache,
+            pin_memory=pin_memory,
+        )
+    )
+    return {
+        "image_frames": batch["image_frames"][0],  # (N_cameras, num_frames, 3, H, W)
+        "camera_indices": batch["camera_indices"],  # (N_cameras,)
+        "ego_history_xyz": batch["ego_history_xyz"],  # (1, 1, num_history_steps, 3)
+        "ego_history_rot": batch["ego_history_rot"],  # (1, 1, num_history_steps, 3, 3)
+        "ego_future_xyz": batch["ego_future_xyz"],  # (1, 1, num_future_steps, 3)
+        "ego_future_rot": batch["ego_future_rot"],  # (1, 1, num_future_steps, 3, 3)
+        "relative_timestamps": batch["relative_timestamps"][0],  # (N_cameras, num_frames)
+        "absolute_timestamps": batch["absolute_timestamps"][0],  # (N_cameras, num_frames)
+        "t0_us": t0_us,
+        "clip_id": clip_id,
+    }
+
+
+def iter_physical_aiavdataset_t0s(
+    clip_id: str,
+    t0s_us: Sequence[int],
+    batch_size: int | None = None,
+    avdi: physical_ai_av.PhysicalAIAVDatasetInterface | None = None,
+    maybe_stream: bool = True,
+    num_history_steps: int = 16,
+    num_future_steps: int = 64,
+    time_step: float = 0.1,
+    camera_features: list | None = None,
+    num_frames: int = 4,
+    executor: Executor | None = None,
+    frame_cache: FrameCache | None = None,
+    pin_memory: bool = False,
+) -> Iterator[dict[str, Any]]:
+    """Load the samples of several t0s of one clip as stacked batches.
+
+    The egomotion of the clip is loaded once and evaluated over the union of the timestamps of
+    all the t0s. The frames shared by the t0s of a batch, and by consecutive batches, are decoded
+    only once. Only the frames of the current batch are kept in memory.
+
+    Args:
+        clip_id: The clip ID to load data from.
+        t0s_us: The t0 timestamps (in microseconds) of the samples, e.g. a sliding window.
+        batch_size: The maximum number of t0s per batch. If None, all t0s are loaded as one batch.
+        avdi: See `load_physical_aiavdataset`.
+        maybe_stream: See `load_physical_aiavdataset`.
+        num_history_steps: See `load_physical_aiavdataset`.
+        num_future_steps: See `load_physical_aiavdataset`.
+        time_step: See `load_physical_aiavdataset`.
+        camera_features: See `load_physical_aiavdataset`.
+        num_frames: See `load_physical_aiavdataset`.
+        executor: See `load_physical_aiavdataset`.
+        frame_cache: See `load_physical_aiavdataset`.
+        pin_memory: See `load_physical_aiavdataset`.
+
+    Yields:
+        The entries of `load_physical_aiavdataset`, stacked over the B t0s of the batch:
+            - image_frames: torch.Tensor of shape (B, N_cameras, num_frames, 3, H, W)
+            - camera_indices: torch.Tensor of shape (N_cameras,)
+            - ego_history_xyz: torch.Tensor of shape (B, 1, num_history_steps, 3)
+            - ego_history_rot: torch.Tensor of shape (B, 1, num_history_steps, 3, 3)
+            - ego_future_xyz: torch.Tensor of shape (B, 1, num_future_steps, 3)
+            - ego_future_rot: torch.Tensor of shape (B, 1, num_future_steps, 3, 3)
+            - relative_timestamps: torch.Tensor of shape (B, N_cameras, num_frames)
+            - absolute_timestamps: torch.Tensor of shape (B, N_cameras, num_frames)
+            - t0_us: torch.Tensor of shape (B,)
+            - clip_id: The clip ID
+    """
     if avdi is None:
         avdi = physical_ai_av.PhysicalAIAVDatasetInterface()
 
@@ -78,142 +347,189 @@ def load_physical_aiavdataset(
             avdi.features.CAMERA.CAMERA_FRONT_TELE_30FOV,
         ]
 
-    camera_name_to_index = {
-        "camera_cross_left_120fov": 0,
-        "camera_front_wide_120fov": 1,
-        "camera_cross_right_120fov": 2,
-        "camera_rear_left_70fov": 3,
-        "camera_rear_tele_30fov": 4,
-        "camera_rear_right_70fov": 5,
-        "camera_front_tele_30fov": 6,
-    }
-
-    # Load egomotion data
-    egomotion = avdi.get_clip_feature(
-        clip_id,
-        avdi.features.LABELS.EGOMOTION,
-        maybe_stream=maybe_stream,
-    )
-
-    assert t0_us > num_history_steps * time_step * 1_000_000, (
-        "t0_us must be greater than the history time range"
-    )
-
-    # Compute timestamps for trajectory sampling
-    # History: [..., t0-0.2s, t0-0.1s, t0] (num_history_steps points ending at t0)
-    # Future: [t0+0.1s, t0+0.2s, ..., t0+6.4s] (num_future_steps points after t0)
-    history_offsets_us = np.arange(
-        -(num_history_steps - 1) * time_step * 1_000_000,
-        time_step * 1_000_000 / 2,
-        time_step * 1_000_000,
-    ).astype(np.int64)
-    history_timestamps = t0_us + history_offsets_us
-
-    future_offsets_us = np.arange(
-        time_step * 1_000_000,
-        (num_future_steps + 0.5) * time_step * 1_000_000,
-        time_step * 1_000_000,
-    ).astype(np.int64)
-    future_timestamps = t0_us + future_offsets_us
-
-    # Get egomotion at history and future timestamps
-    ego_history = egomotion(history_timestamps)
-    ego_history_xyz = ego_history.pose.translation  # (num_history_steps, 3)
-    ego_history_quat = ego_history.pose.rotation.as_quat()  # (num_history_steps, 4)
-
-    ego_future = egomotion(future_timestamps)
-    ego_future_xyz = ego_future.pose.translation  # (num_future_steps, 3)
-    ego_future_quat = ego_future.pose.rotation.as_quat()  # (num_future_steps, 4)
-
-    # Transform to local frame (relative to t0 pose)
-    # The model expects trajectories in the ego frame at t0.
-    # Transformation: xyz_local = R_t0^{-1} @ (xyz_world - xyz_t0)
-    t0_xyz = ego_history_xyz[-1].copy()  # Position at t0
-    t0_quat = ego_history_quat[-1].copy()  # Orientation at t0
-    t0_rot = spt.Rotation.from_quat(t0_quat)
-    t0_rot_inv = t0_rot.inv()
-
-    # Transform history positions to local frame
-    ego_history_xyz_local = t0_rot_inv.apply(ego_history_xyz - t0_xyz)
-
-    # Transform future positions to local frame
-    ego_future_xyz_local = t0_rot_inv.apply(ego_future_xyz - t0_xyz)
-
-    # Transform rotations to local frame
-    ego_history_rot_local = (t0_rot_inv * spt.Rotation.from_quat(ego_history_quat)).as_matrix()
-    ego_future_rot_local = (t0_rot_inv * spt.Rotation.from_quat(ego_future_quat)).as_matrix()
-
-    # Convert to torch tensors with batch dimensions: (B=1, n_traj_group=1, T, ...)
-    ego_history_xyz_tensor = (
-        torch.from_numpy(ego_history_xyz_local).float().unsqueeze(0).unsqueeze(0)
-    )
-    ego_history_rot_tensor = (
-        torch.from_numpy(ego_history_rot_local).float().unsqueeze(0).unsqueeze(0)
-    )
-    ego_future_xyz_tensor = torch.from_numpy(ego_future_xyz_local).float().unsqueeze(0).unsqueeze(0)
-    ego_future_rot_tensor = torch.from_numpy(ego_future_rot_local).float().unsqueeze(0).unsqueeze(0)
-
-    # Load camera images
-    image_frames_list = []
-    camera_indices_list = []
-    timestamps_list = []
-
-    # Image timestamps: if num_frames=4, load at [t0-0.3s, t0-0.2s, t0-0.1s, t0]
-    image_timestamps = np.array(
-        [t0_us - (num_frames - 1 - i) * int(time_step * 1_000_000) for i in range(num_frames)],
-        dtype=np.int64,
-    )
-
-    for cam_feature in camera_features:
-        camera = avdi.get_clip_feature(
-            clip_id,
-            cam_feature,
-            maybe_stream=maybe_stream,
+    t0s_us = [int(t0_us) for t0_us in t0s_us]
+    for t0_us in t0s_us:
+        assert t0_us > num_history_steps * time_step * 1_000_000, (
+            "t0_us must be greater than the history time range"
         )
+    batch_size = batch_size or len(t0s_us)
 
-        # frames: (num_frames, H, W, 3) uint8
-        frames, frame_timestamps = camera.decode_images_from_timestamps(image_timestamps)
-
-        # Convert to (num_frames, 3, H, W) for model input
-        frames_tensor = torch.from_numpy(frames)
-        frames_tensor = rearrange(frames_tensor, "t h w c -> t c h w")
-
-        # Extract camera name from feature path
-        if isinstance(cam_feature, str):
-            cam_name = cam_feature.split("/")[-1] if "/" in cam_feature else cam_feature
-            cam_name = cam_name.lower()
+    # Sample the egomotion once over the union of the trajectory timestamps
+    trajectory_timestamps = np.stack(
+        [
+            _trajectory_timestamps(t0_us, num_history_steps, num_future_steps, time_step)
+            for t0_us in t0s_us
+        ]
+    )  # (len(t0s_us), num_history_steps + num_future_steps)
+    ego_timestamps = np.unique(trajectory_timestamps)
+    ego_args = (avdi, clip_id, ego_timestamps, maybe_stream, frame_cache)
+    ego_future = None if executor is None else executor.submit(_sample_egomotion, *ego_args)
+
+    # (camera, requested timestamp) -> (frame (3, H, W), frame timestamp), of the previous batch
+    decoded: dict[tuple[int, int], tuple[torch.Tensor, int]] = {}
+    camera_indices = None
+    ego_poses = None
+    for start in range(0, len(t0s_us), batch_size):
+        batch_t0s = t0s_us[start : start + batch_size]
+        image_timestamps = [_image_timestamps(t0_us, num_frames, time_step) for t0_us in batch_t0s]
+        needed = np.unique(np.concatenate(image_timestamps))
+
+        # Decode the frames that the previous batch did not decode already
+        missing = {}
+        for c in range(len(camera_features)):
+            timestamps = [ts for ts in needed.tolist() if (c, ts) not in decoded]
+            if timestamps:
+                missing[c] = np.array(timestamps, dtype=np.int64)
+        camera_args = {
+            c: (avdi, clip_id, camera_features[c], timestamps, maybe_stream, frame_cache)
+            for c, timestamps in missing.items()
+        }
+        if executor is None:
+            cameras = {c: _load_camera(*args) for c, args in camera_args.items()}
         else:
-            raise ValueError(f"Unexpected camera feature type: {type(cam_feature)}")
-        cam_idx = camera_name_to_index.get(cam_name, 0)
-
-        image_frames_list.append(frames_tensor)
-        camera_indices_list.append(cam_idx)
-        timestamps_list.append(torch.from_numpy(frame_timestamps.astype(np.int64)))
-
-    # Stack and sort by camera index for consistent ordering
-    image_frames = torch.stack(image_frames_list, dim=0)  # (N_cameras, num_frames, 3, H, W)
-    camera_indices = torch.tensor(camera_indices_list, dtype=torch.int64)  # (N_cameras,)
-    all_timestamps = torch.stack(timestamps_list, dim=0)  # (N_cameras, num_frames)
-
-    # Sort by camera index to ensure consistent ordering [0, 1, 2, 6] instead of arbitrary order
-    sort_order = torch.argsort(camera_indices)
-    image_frames = image_frames[sort_order]
-    camera_indices = camera_indices[sort_order]
-    all_timestamps = all_timestamps[sort_order]
+            futures = {c: executor.submit(_load_camera, *args) for c, args in camera_args.items()}
+            cameras = {c: future.result() for c, future in futures.items()}
+        if ego_poses is None:
+            ego_poses = _sample_egomotion(*ego_args) if ego_future is None else ego_future.result()
+
+        if camera_indices is None:
+            # every camera is decoded for the first batch
+            camera_indices = torch.tensor(
+                [cameras[c][1] for c in range(len(camera_features))], dtype=torch.int64
+            )  # (N_cameras,)
+        for c, (frames, _, frame_timestamps) in cameras.items():
+            for ts, frame, frame_ts in zip(missing[c].tolist(), frames, frame_timestamps.tolist()):
+                decoded[(c, ts)] = (frame, frame_ts)
+        # only keep the frames of this batch, the next t0s only overlap with its latest frames
+        decoded = {
+            (c, ts): decoded[(c, ts)] for c in range(len(camera_features)) for ts in needed.tolist()
+        }
+
+        # Sort by camera index to ensure consistent ordering [0, 1, 2, 6] instead of arbitrary order
+        sort_order = torch.argsort(camera_indices).tolist()
+        # Write the frames once into the final (B, N_cameras, num_frames, 3, H, W) layout, in the
+        # sorted camera order, converting them from the (H, W, 3) decoder layout on the way
+        frame_shape = decoded[(sort_order[0], int(image_timestamps[0][0]))][0].shape
+        image_frames = torch.empty(
+            (len(batch_t0s), len(sort_order), num_frames, *frame_shape),
+            dtype=torch.uint8,
+            pin_memory=pin_memory,
+        )
+        for b, image_ts in enumerate(image_timestamps):
+            for i, c in enumerate(sort_order):
+                for t, ts in enumerate(image_ts.tolist()):
+                    image_frames[b, i, t] = decoded[(c, ts)][0]
+        all_timestamps = torch.tensor(
+            [
+                [[decoded[(c, ts)][1] for ts in image_ts.tolist()] for c in sort_order]
+                for image_ts in image_timestamps
+            ],
+            dtype=torch.int64,
+        )  # (B, N_cameras, num_frames)
+        # Compute relative timestamps in seconds, relative to the first frame of each t0
+        camera_tmin = all_timestamps.flatten(1).min(dim=1).values[:, None, None]
+        relative_timestamps = (all_timestamps - camera_tmin).float() * 1e-6
+
+        # pose_idx: (B, num_history_steps + num_future_steps)
+        batch_timestamps = trajectory_timestamps[start : start + batch_size]
+        pose_idx = np.searchsorted(ego_timestamps, batch_timestamps)
+        ego_trajectories = _to_local_trajectories(
+            ego_poses[0][pose_idx], ego_poses[1][pose_idx], num_history_steps
+        )
 
-    # Compute relative timestamps in seconds
-    camera_tmin = all_timestamps.min()
-    relative_timestamps = (all_timestamps - camera_tmin).float() * 1e-6  # (N_cameras, num_frames)
+        yield {
+            "image_frames": image_frames,  # (B, N_cameras, num_frames, 3, H, W)
+            "camera_indices": camera_indices[sort_order],  # (N_cameras,)
+            "ego_history_xyz": ego_trajectories["ego_history_xyz"],  # (B, 1, num_history_steps, 3)
+            # (B, 1, num_history_steps, 3, 3)
+            "ego_history_rot": ego_trajectories["ego_history_rot"],
+            "ego_future_xyz": ego_trajectories["ego_future_xyz"],  # (B, 1, num_future_steps, 3)
+            "ego_future_rot": ego_trajectories["ego_future_rot"],  # (B, 1, num_future_steps, 3, 3)
+            "relative_timestamps": relative_timestamps,  # (B, N_cameras, num_frames)
+            "absolute_timestamps": all_timestamps,  # (B, N_cameras, num_frames)
+            "t0_us": torch.tensor(batch_t0s, dtype=torch.int64),  # (B,)
+            "clip_id": clip_id,
+        }
+
+
+class PhysicalAIAVDataset(torch.utils.data.IterableDataset):
+    """Iterable dataset of `load_physical_aiavdataset` samples with bounded prefetching.
+
+    Up to `prefetch` samples are loaded ahead of the consumer on background threads, and the
+    egomotion and cameras of each sample are decoded concurrently on `num_decode_threads` threads,
+    so that video decoding overlaps with the rollouts on the GPU. Samples are yielded in order.
+
+    With a `DataLoader`, use `batch_size=None` (or a list-returning `collate_fn` together with
+    `helper.create_batch_inputs`). The samples are split between the `DataLoader` workers, each of
+    which creates its own dataset interface unless one is given.
+
+    Example:
+        >>> dataset = PhysicalAIAVDataset([(clip_id, 5_100_000) for clip_id in clip_ids])
+        >>> for data in torch.utils.data.DataLoader(dataset, batch_size=None):
+        ...     model_inputs = helper.create_batch_inputs(processor, [data])
+    """
 
-    return {
-        "image_frames": image_frames,  # (N_cameras, num_frames, 3, H, W)
-        "camera_indices": camera_indices,  # (N_cameras,)
-        "ego_history_xyz": ego_history_xyz_tensor,  # (1, 1, num_history_steps, 3)
-        "ego_history_rot": ego_history_rot_tensor,  # (1, 1, num_history_steps, 3, 3)
-        "ego_future_xyz": ego_future_xyz_tensor,  # (1, 1, num_future_steps, 3)
-        "ego_future_rot": ego_future_rot_tensor,  # (1, 1, num_future_steps, 3, 3)
-        "relative_timestamps": relative_timestamps,  # (N_cameras, num_frames)
-        "absolute_timestamps": all_timestamps,  # (N_cameras, num_frames)
-        "t0_us": t0_us,
-        "clip_id": clip_id,
-    }
+    def __init__(
+        self,
+        samples: Sequence[tuple[str, int]],
+        avdi: physical_ai_av.PhysicalAIAVDatasetInterface | None = None,
+        prefetch: int = 2,
+        num_decode_threads: int = 5,
+        **load_kwargs: Any,
+    ):
+        """Initialize the PhysicalAIAVDataset.
+
+        Args:
+            samples: The (clip_id, t0_us) pairs to load.
+            avdi: Optional pre-initialized PhysicalAIAVDatasetInterface. If None, one is created
+                per iterating process.
+            prefetch: The maximum number of samples loaded ahead of the consumer.
+            num_decode_threads: The number of threads decoding the egomotion and cameras.
+            **load_kwargs: Further keyword arguments of `load_physical_aiavdataset`.
+        """
+        super().__init__()
+        if prefetch < 1:
+            raise ValueError(f"prefetch must be positive, got {prefetch}")
+        self.samples = list(samples)
+        self.avdi = avdi
+        self.prefetch = prefetch
+        self.num_decode_threads = num_decode_threads
+        self.load_kwargs = load_kwargs
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        samples = self.samples
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            samples = samples[worker_info.id :: worker_info.num_workers]
+        avdi = self.avdi or physical_ai_av.PhysicalAIAVDatasetInterface()
+
+        # samples and their cameras run on separate pools, so that the prefetched samples waiting
+        # for their cameras never hold the threads the cameras need
+        with (
+            ThreadPoolExecutor(self.prefetch, thread_name_prefix="prefetch") as sample_pool,
+            ThreadPoolExecutor(self.num_decode_threads, thread_name_prefix="decode") as pool,
+        ):
+            pending: deque[Future] = deque()
+            try:
+                for clip_id, t0_us in samples:
+                    pending.append(
+                        sample_pool.submit(
+                            load_physical_aiavdataset,
+                            clip_id,
+                            t0_us,
+                            avdi=avdi,
+                            executor=pool,
+                            **self.load_kwargs,
+                        )
+                    )
+                    if len(pending) > self.prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # do not decode the prefetched samples if the iteration stops early
+                for future in pending:
+                    future.cancel()
@@ -22,13 +22,25 @@ import hydra.utils as hyu
 import numpy as np
 import torch
 from transformers import AutoConfig, AutoModel, StoppingCriteriaList
-from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
+from transformers.cache_utils import Cache, DynamicCache
+from transformers.generation.logits_process import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
 
 from alpamayo_r1.action_space import ActionSpace
 from alpamayo_r1.models.base_model import ReasoningVLA
 from alpamayo_r1.config import AlpamayoR1Config
-from alpamayo_r1.diffusion.base import BaseDiffusion
+from alpamayo_r1.diffusion.base import BaseDiffusion, StepFn
+from alpamayo_r1.models.captured_step import CapturedDenoisingStep, CaptureMode
+from alpamayo_r1.models.kv_cache import PaddedBatchCache, SharedPrefixCache
+from alpamayo_r1.models.prefix_expert import PrefixCachedExpert, PrefixMask
+from alpamayo_r1.models.speculative import NGramDrafter
 from alpamayo_r1.models.token_utils import (
+    TEXT_TOKENS,
     StopAfterEOS,
     extract_text_tokens,
     replace_padding_after_eos,
@@ -70,6 +82,105 @@ class ExpertLogitsProcessor(LogitsProcessor):
         return scores
 
 
+class CoTBudgetLogitsProcessor(LogitsProcessor):
+    """Forces <traj_future_start> once the reasoning reaches a budget of generated tokens."""
+
+    def __init__(self, eos_token_id: int, budget: int, prompt_length: int):
+        """Initialize the CoTBudgetLogitsProcessor.
+
+        Args:
+            eos_token_id: The ID of the <traj_future_start> token.
+            budget: The maximum number of reasoning tokens before <traj_future_start>.
+            prompt_length: The length of the (padded) prompt passed to `generate`.
+        """
+        super().__init__()
+        self.eos_token_id = eos_token_id
+        self.budget = budget
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        """Only keep the logit of <traj_future_start> once the budget is reached.
+
+        Rows that already generated <traj_future_start> are also forced, which does not matter
+        since their tokens after it are replaced by padding.
+
+        Args:
+            input_ids: The input IDs of shape [B, prompt_length + num_generated].
+            scores: The scores of shape [B, vocab_size].
+
+        Returns:
+            torch.FloatTensor: The modified scores tensor.
+        """
+        if input_ids.shape[1] - self.prompt_length >= self.budget:
+            eos_scores = scores[:, self.eos_token_id].clone()
+            scores.fill_(float("-inf"))
+            scores[:, self.eos_token_id] = eos_scores
+        return scores
+
+
+class RolloutHandoff:
+    """The state handed from the VLM stage of a rollout to its diffusion stage.
+
+    It holds the KV cache of the reasoning traces together with the valid prefix keys and the
+    positions of the diffusion tokens of every trace, which are derived from the rope deltas and
+    the <traj_future_start> offsets of the VLM stage.
+    """
+
+    def __init__(
+        self,
+        prompt_cache: Cache,
+        prefix_mask: PrefixMask,
+        position_ids: torch.Tensor,
+        hist_xyz: torch.Tensor,
+        hist_rot: torch.Tensor,
+        sequences: torch.Tensor | None,
+        num_traj_samples: int,
+        cache_repeats: int = 1,
+    ):
+        """Initialize the RolloutHandoff.
+
+        Args:
+            prompt_cache: The KV cache of the b_star / cache_repeats rows, where b_star = B *
+                num_traj_samples is the number of reasoning traces.
+            prefix_mask: The valid keys of every row of the cache.
+            position_ids: The positions of the diffusion tokens of every row of the cache, of
+                shape (3, b_star / cache_repeats, n_tokens).
+            hist_xyz: The last history xyz of every trace, of shape (b_star, Th, 3).
+            hist_rot: The last history rotations of every trace, of shape (b_star, Th, 3, 3).
+            sequences: The prompts and generated tokens, padded after the EOS, of shape
+                (b_star, L), or None without reasoning.
+            num_traj_samples: The number of reasoning traces per clip.
+            cache_repeats: The number of consecutive traces sharing a row of the cache, e.g. the
+                num_traj_samples traces of a clip when the reasoning is skipped.
+        """
+        self.prompt_cache = prompt_cache
+        self.prefix_mask = prefix_mask
+        self.position_ids = position_ids
+        self.hist_xyz = hist_xyz
+        self.hist_rot = hist_rot
+        self.sequences = sequences
+        self.num_traj_samples = num_traj_samples
+        self.cache_repeats = cache_repeats
+
+    def tensors(self) -> list[torch.Tensor]:
+        """Returns the tensors of the handoff, e.g. to hand them over to another CUDA stream."""
+        tensors = [
+            self.prefix_mask.start,
+            self.prefix_mask.end,
+            self.position_ids,
+            self.hist_xyz,
+            self.hist_rot,
+        ]
+        if self.sequences is not None:
+            tensors.append(self.sequences)
+        if self.prompt_cache is not None:
+            for layer in self.prompt_cache.layers:
+                for keys, values in getattr(layer, "shared", []):
+                    tensors += [keys, values]
+                tensors += [layer.keys, layer.values]
+        return tensors
+
+
 class AlpamayoR1(ReasoningVLA):
     """Expert model for reasoning VLA."""
 
@@ -117,8 +228,123 @@ class AlpamayoR1(ReasoningVLA):
             self.action_in_proj = self.action_in_proj.to(dtype=expert_dtype)
             self.action_out_proj = self.action_out_proj.to(dtype=expert_dtype)
 
+        # denoising step captured by the `capture_mode` of the rollout, kept across rollouts
+        self._captured_step: CapturedDenoisingStep | None = None
+
         self.post_init()
 
+    def _denoise(
+        self, expert_fn: PrefixCachedExpert, x: torch.Tensor, t: torch.Tensor
+    ) -> torch.Tensor:
+        """Denoising step that consumes noisy action and timestep.
+
+        Args:
+            expert_fn: The expert loaded with the prompt cache.
+            x: The noisy action of shape (B*, *action_dim).
+            t: The timestep, broadcastable to x leading dims.
+
+        Returns:
+            The predicted vector field of shape (B*, *action_dim).
+        """
+        b_star = x.shape[0]
+        n_diffusion_tokens = self.action_space.get_action_space_dims()[0]
+        # Project noisy action to expert token embeddings for the n future tokens
+        # Expect shape (b*, n_token_per_traj, hidden_size)
+        future_token_embeds = self.action_in_proj(x, t)
+        if future_token_embeds.dim() == 2:
+            future_token_embeds = future_token_embeds.view(b_star, n_diffusion_tokens, -1)
+
+        # Run expert against the cached prefill, only on the future tokens
+        last_hidden = expert_fn(future_token_embeds)  # (b*, Tf, hidden_size)
+        pred = self.action_out_proj(last_hidden).view(
+            -1, *self.action_space.get_action_space_dims()
+        )  # (b*, Tf, C_action) -> noise/vector field
+        return pred
+
+    def _prepare_denoising_step(
+        self,
+        prompt_cache: Cache,
+        prefix_mask: PrefixMask,
+        position_ids: torch.Tensor,
+        num_traj_sets: int = 1,
+        capture_mode: CaptureMode | None = None,
+    ) -> StepFn:
+        """Define the denoising step of reasoning traces, which consumes noisy action and timestep.
+
+        The expert attends to the prompt cache read-only and keeps its own copy of the prefix, so
+        the cache can be released once the step is prepared. The trajectory sets of every
+        reasoning trace share its cache row since the diffusion rows are ordered (b nj ns).
+
+        Args:
+            prompt_cache: The KV cache of the b_star reasoning traces.
+            prefix_mask: The valid keys of every row of the cache.
+            position_ids: The positions of the diffusion tokens, of shape (3, b_star, n_tokens).
+            num_traj_sets: The number of trajectory sets, i.e. of diffusion samples per trace.
+            capture_mode: See `sample_trajectories_from_data_with_vlm_rollout`.
+
+        Returns:
+            The denoising step of the b_star * num_traj_sets diffusion rows.
+        """
+        expert_kwargs = {
+            "num_groups": num_traj_sets,
+            "is_causal": not self.config.expert_non_causal_attention,
+        }
+        if capture_mode is None:
+            expert_fn = PrefixCachedExpert.from_cache(
+                self.expert, prompt_cache, prefix_mask, position_ids, **expert_kwargs
+            )
+
+            def step_fn(x: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
+                return self._denoise(expert_fn, x, t)
+
+            return step_fn
+
+        if self._captured_step is None or self._captured_step.mode != capture_mode:
+            self._captured_step = CapturedDenoisingStep(
+                self._denoise, self.action_space.get_action_space_dims(), mode=capture_mode
+            )
+        return self._captured_step.prepare(
+            self.expert, prompt_cache, prefix_mask, position_ids, **expert_kwargs
+        )
+
+    def _sample_actions(
+        self,
+        step_fn: StepFn,
+        hist_xyz: torch.Tensor,
+        hist_rot: torch.Tensor,
+        num_traj_sets: int = 1,
+        diffusion_kwargs: dict[str, Any] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Sample the trajectories of reasoning traces with a prepared denoising step.
+
+        Args:
+            step_fn: The denoising step returned by `_prepare_denoising_step`.
+            hist_xyz: The last history xyz of every trace, of shape (b_star, Th, 3).
+            hist_rot: The last history rotations of every trace, of shape (b_star, Th, 3, 3).
+            num_traj_sets: The number of trajectory sets, i.e. of diffusion samples per trace.
+            diffusion_kwargs: Extra keyword arguments for `self.diffusion.sample`.
+
+        Returns:
+            pred_xyz: The predicted xyz, of shape (b_star * num_traj_sets, Tf, 3), ordered
+                (b_star, num_traj_sets).
+            pred_rot: The predicted rotations, of shape (b_star * num_traj_sets, Tf, 3, 3).
+        """
+        if diffusion_kwargs is None:
+            diffusion_kwargs = {}
+        # Diffusion sampling in action space with multiple samples per trace
+        sampled_action = self.diffusion.sample(
+            batch_size=hist_xyz.shape[0] * num_traj_sets,
+            step_fn=step_fn,
+            device=hist_xyz.device,
+            return_all_steps=False,
+            **diffusion_kwargs,
+        )
+
+        # Repeat history to align with num_traj_sets
+        hist_xyz_rep = hist_xyz.repeat_interleave(num_traj_sets, dim=0)
+        hist_rot_rep = hist_rot.repeat_interleave(num_traj_sets, dim=0)
+        return self.action_space.action_to_traj(sampled_action, hist_xyz_rep, hist_rot_rep)
+
     def sample_trajectories_from_data_with_vlm_rollout(
         self,
         data: dict[str, Any],
@@ -133,28 +359,84 @@ class AlpamayoR1(ReasoningVLA):
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Sample trajectories from the data with VLM rollout.
 
+        Prompts from several clips can be batched along B; they must be left-padded (see
+        `helper.create_batch_inputs`) so that the generated tokens are aligned across rows.
+        The rollout runs `rollout_vlm` and then `sample_trajectories_from_handoff`, which
+        `RolloutPipeline` overlaps across batches.
+
         Args:
-            data: The input data.
+            data: The input data. `tokenized_data` holds the (left-padded) processor outputs and
+                `ego_history_xyz`/`ego_history_rot` are of shape (B, 1, T, ...).
             top_p: The top-p value for sampling.
             top_k: The top-k value for sampling.
             temperature: The temperature for sampling.
-            num_traj_samples: The number of trajectory samples.
-            num_traj_sets: The number of trajectory sets.
+            num_traj_samples: The number of trajectory samples, i.e. of reasoning traces per clip.
+            num_traj_sets: The number of trajectory sets, i.e. of diffusion samples per reasoning
+                trace. The sets are denoised in one batch against the same prompt cache.
+            diffusion_kwargs: Extra keyword arguments for `self.diffusion.sample`.
             *args: Variable length argument list.
-            **kwargs: Arbitrary keyword arguments.
+            **kwargs: Arbitrary keyword arguments. Supported keys are `max_generation_length`,
+                `return_extra`, `share_prompt_cache`, `capture_mode`, `cot_budget` and `drafter`.
+                `share_prompt_cache` prefills the prompt once per clip and shares its KV cache
+                across the num_traj_samples rollouts. `capture_mode` ("cuda_graph" or
+                "compile") captures the denoising step per shape bucket and replays it, see
+                `CapturedDenoisingStep`. `cot_budget` forces <traj_future_start> after at most
+                that many reasoning tokens; with 0, the trajectory-only mode, the prompt is
+                prefilled together with <traj_future_start> and the expert runs on the prefill
+                cache without any decoding, and the returned texts are empty. `drafter` (e.g. an
+                `NGramDrafter`) enables speculative decoding: the VLM verifies the tokens it
+                proposes, several per forward pass, see `_generate_reasoning_speculative`.
 
         Returns:
             pred_xyz: The predicted xyz.
             pred_rot: The predicted rotation.
             logprob: The log probability.
         """
-        n_samples_total = num_traj_samples * num_traj_sets
+        handoff = self.rollout_vlm(
+            data,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            num_traj_samples=num_traj_samples,
+            **kwargs,
+        )
+        return self.sample_trajectories_from_handoff(
+            handoff, num_traj_sets=num_traj_sets, diffusion_kwargs=diffusion_kwargs, **kwargs
+        )
+
+    def rollout_vlm(
+        self,
+        data: dict[str, Any],
+        top_p: float = 0.98,
+        top_k: int | None = None,
+        temperature: float = 0.6,
+        num_traj_samples: int = 6,
+        **kwargs: Any,
+    ) -> RolloutHandoff:
+        """Run the VLM stage of the rollout: prefill and autoregressive reasoning generation.
+
+        Args:
+            data: See `sample_trajectories_from_data_with_vlm_rollout`.
+            top_p: The top-p value for sampling.
+            top_k: The top-k value for sampling.
+            temperature: The temperature for sampling.
+            num_traj_samples: The number of trajectory samples, i.e. of reasoning traces per clip.
+            **kwargs: `max_generation_length`, `share_prompt_cache`, `cot_budget` and `drafter`,
+                see `sample_trajectories_from_data_with_vlm_rollout`. Other keys are ignored.
+
+        Returns:
+            The handoff to `sample_trajectories_from_handoff`.
+        """
         ego_history_xyz = data["ego_history_xyz"]
         ego_history_rot = data["ego_history_rot"]
         B, n_traj_group, _, _ = ego_history_xyz.shape
         assert n_traj_group == 1, "Only one trajectory group is supported for inference."
         tokenized_data = data["tokenized_data"]
         input_ids = tokenized_data.pop("input_ids")
+        # [B, L], zeros mark the left padding of batched prompts
+        prompt_attention_mask = tokenized_data.get("attention_mask")
+        if prompt_attention_mask is None:
+            prompt_attention_mask = torch.ones_like(input_ids)
         traj_data_vlm = {
             "ego_history_xyz": ego_history_xyz,
             "ego_history_rot": ego_history_rot,
@@ -162,7 +444,135 @@ class AlpamayoR1(ReasoningVLA):
         input_ids = self.fuse_traj_tokens(input_ids, traj_data_vlm)
         device = input_ids.device
 
-        # 1) run autoregressive generation for the VLM
+        eos_token_id = self.tokenizer.convert_tokens_to_ids(to_special_token("traj_future_start"))
+        cot_budget = kwargs.get("cot_budget")
+        if cot_budget == 0:
+            # trajectory-only mode: prefill the prompt followed by <traj_future_start>, without
+            # decoding, and let all the samples of a clip share its cache row
+            sequences = torch.cat([input_ids, torch.full_like(input_ids[:, :1], eos_token_id)], 1)
+            prompt_cache = DynamicCache()
+            with torch.no_grad():
+                # the base model skips the LM head, no token is sampled from the prefill
+                self.vlm.model(
+                    input_ids=sequences,
+                    attention_mask=torch.cat(
+                        [prompt_attention_mask, torch.ones_like(prompt_attention_mask[:, :1])], 1
+                    ),
+                    past_key_values=prompt_cache,
+                    use_cache=True,
+                    **{k: v for k, v in tokenized_data.items() if k != "attention_mask"},
+                )
+            rope_deltas = self.vlm.model.rope_deltas
+            cache_repeats = num_traj_samples
+        elif kwargs.get("drafter") is not None:
+            # 1) run autoregressive generation for the VLM, verifying the drafted tokens
+            sequences, prompt_cache, rope_deltas = self._generate_reasoning_speculative(
+                input_ids,
+                prompt_attention_mask,
+                tokenized_data,
+                eos_token_id,
+                top_p=top_p,
+                top_k=top_k,
+                temperature=temperature,
+                num_traj_samples=num_traj_samples,
+                **kwargs,
+            )
+            cache_repeats = 1
+        else:
+            # 1) run autoregressive generation for the VLM
+            sequences, prompt_cache, rope_deltas = self._generate_reasoning(
+                input_ids,
+                prompt_attention_mask,
+                tokenized_data,
+                eos_token_id,
+                top_p=top_p,
+                top_k=top_k,
+                temperature=temperature,
+                num_traj_samples=num_traj_samples,
+                **kwargs,
+            )
+            cache_repeats = 1
+        prefill_seq_len = prompt_cache.get_seq_length()
+
+        # find <traj_future_start> token position for each sequence, use last token if not found
+        b_star = sequences.shape[0]
+        traj_future_start_mask = sequences == eos_token_id
+        # [b_star], True if sequence has <traj_future_start>
+        has_traj_future_start = traj_future_start_mask.any(dim=1)
+        if not has_traj_future_start.all():
+            missing = torch.nonzero(~has_traj_future_start).flatten().tolist()
+            logger.warning(
+                f"No <traj_future_start> token found in the generated sequences {missing}"
+            )
+        # [b_star], first occurrence position
+        traj_future_start_positions = traj_future_start_mask.int().argmax(dim=1)
+        last_token_positions = torch.full((b_star,), sequences.shape[1] - 1, device=device)
+        valid_token_pos_id = torch.where(
+            has_traj_future_start, traj_future_start_positions, last_token_positions
+        )
+        # note that sequences already include the input_ids,
+        # so no need to add the input_ids length
+        offset = valid_token_pos_id + 1
+
+        # modify the position ids to remove padding tokens
+        n_diffusion_tokens = self.action_space.get_action_space_dims()[0]
+        delta = rope_deltas.to(device) + offset[:, None]  # [b_star, 1]
+        position_ids = torch.arange(n_diffusion_tokens, device=device) + delta
+        position_ids = einops.repeat(position_ids, "b l -> 3 b l")
+
+        # modify the attention_masks to remove padding tokens, i.e. the left padding of batched
+        # prompts and the padding after <traj_future_start>, which leaves a contiguous range of
+        # valid prefix keys per row
+        prompt_start = (prompt_attention_mask != 0).int().argmax(dim=1).to(device)
+        prefix_mask = PrefixMask(
+            start=prompt_start.repeat_interleave(b_star // B),
+            end=offset,
+            length=prefill_seq_len,
+        )
+
+        return RolloutHandoff(
+            prompt_cache=prompt_cache,
+            prefix_mask=prefix_mask,
+            position_ids=position_ids,
+            hist_xyz=ego_history_xyz[:, -1].repeat_interleave(num_traj_samples, dim=0),
+            hist_rot=ego_history_rot[:, -1].repeat_interleave(num_traj_samples, dim=0),
+            sequences=None if cot_budget == 0 else sequences,
+            num_traj_samples=num_traj_samples,
+            cache_repeats=cache_repeats,
+        )
+
+    def _generate_reasoning(
+        self,
+        input_ids: torch.Tensor,
+        prompt_attention_mask: torch.Tensor,
+        tokenized_data: dict[str, Any],
+        eos_token_id: int,
+        top_p: float = 0.98,
+        top_k: int | None = None,
+        temperature: float = 0.6,
+        num_traj_samples: int = 6,
+        **kwargs: Any,
+    ) -> tuple[torch.Tensor, Cache, torch.Tensor]:
+        """Generate num_traj_samples reasoning traces per prompt until <traj_future_start>.
+
+        Args:
+            input_ids: The prompts with the history trajectory tokens, of shape (B, L).
+            prompt_attention_mask: The attention mask of the prompts, of shape (B, L).
+            tokenized_data: The other processor outputs, e.g. the pixel values.
+            eos_token_id: The ID of the <traj_future_start> token.
+            top_p: The top-p value for sampling.
+            top_k: The top-k value for sampling.
+            temperature: The temperature for sampling.
+            num_traj_samples: The number of reasoning traces per prompt.
+            **kwargs: `max_generation_length`, `share_prompt_cache` and `cot_budget`, see
+                `sample_trajectories_from_data_with_vlm_rollout`.
+
+        Returns:
+            sequences: The prompts and generated tokens, padded after the first EOS, of shape
+                (b_star, L + num_generated).
+            prompt_cache: The KV cache of the b_star sequences.
+            rope_deltas: The rope deltas of the b_star sequences, of shape (b_star, 1).
+        """
         max_generation_length = kwargs.get(
             "max_generation_length", self.config.tokens_per_future_traj
         )
@@ -179,7 +589,6 @@ class AlpamayoR1(ReasoningVLA):
 
         # use custom stopping criteria to stop after EOS token + one more token,
         # because the KV cache is updated after the next token is generated
-        eos_token_id = self.tokenizer.convert_tokens_to_ids(to_special_token("traj_future_start"))
         stopping_criteria = StoppingCriteriaList([StopAfterEOS(eos_token_id=eos_token_id)])
         logits_processor = LogitsProcessorList(
             [
@@ -189,140 +598,339 @@ class AlpamayoR1(ReasoningVLA):
                 )
             ]
         )
+        cot_budget = kwargs.get("cot_budget")
+        if cot_budget is not None:
+            # the EOS follows at most cot_budget reasoning tokens, plus the token after it
+            logits_processor.append(
+                CoTBudgetLogitsProcessor(eos_token_id, cot_budget, input_ids.shape[1])
+            )
+            generation_config.max_new_tokens = min(max_generation_length, cot_budget + 2)
+        generate_kwargs = tokenized_data
+        if kwargs.get("share_prompt_cache", False):
+            # prefill the multimodal prompt once per clip and fork the KV cache for every sample
+            # instead of letting `generate` copy the prompt num_traj_samples times before prefill.
+            # The last prompt token is left to `generate`, which samples from its logits.
+            shared_cache = SharedPrefixCache()
+            with torch.no_grad():
+                self.vlm(
+                    input_ids=input_ids[:, :-1],
+                    attention_mask=prompt_attention_mask[:, :-1],
+                    past_key_values=shared_cache,
+                    use_cache=True,
+                    logits_to_keep=1,
+                    **{k: v for k, v in tokenized_data.items() if k != "attention_mask"},
+                )
+            shared_cache.fork(num_traj_samples)
+            generate_kwargs = {
+                "attention_mask": prompt_attention_mask,
+                "past_key_values": shared_cache,
+            }
         vlm_outputs = self.vlm.generate(
             input_ids=input_ids,
             generation_config=generation_config,
             stopping_criteria=stopping_criteria,
             logits_processor=logits_processor,
-            **tokenized_data,
+            **generate_kwargs,
+        )
+        # rope_deltas are computed at prefill, i.e. once per clip with a shared prompt cache
+        rope_deltas = self.vlm.model.rope_deltas
+        rope_deltas = rope_deltas.repeat_interleave(
+            vlm_outputs.sequences.shape[0] // rope_deltas.shape[0], dim=0
         )
-        vlm_outputs.rope_deltas = self.vlm.model.rope_deltas
 
         # manually replace padding after EOS token
-        vlm_outputs.sequences = replace_padding_after_eos(
+        sequences = replace_padding_after_eos(
             token_ids=vlm_outputs.sequences,
             eos_token_id=eos_token_id,
             pad_token_id=self.tokenizer.pad_token_id,
         )
-        prompt_cache = vlm_outputs.past_key_values
-        prefill_seq_len = prompt_cache.get_seq_length()
+        return sequences, vlm_outputs.past_key_values, rope_deltas
+
+    def _sampling_logits_processor(
+        self, top_p: float = 0.98, top_k: int | None = None, temperature: float = 0.6
+    ) -> LogitsProcessorList:
+        """Returns the expert mask, then the warpers `generate` applies for these parameters."""
+        processors = [
+            ExpertLogitsProcessor(
+                traj_token_offset=self.config.traj_token_start_idx,
+                traj_vocab_size=self.config.traj_vocab_size,
+            )
+        ]
+        if temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        if top_k:
+            processors.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p))
+        return LogitsProcessorList(processors)
+
+    def _generate_reasoning_speculative(
+        self,
+        input_ids: torch.Tensor,
+        prompt_attention_mask: torch.Tensor,
+        tokenized_data: dict[str, Any],
+        eos_token_id: int,
+        top_p: float = 0.98,
+        top_k: int | None = None,
+        temperature: float = 0.6,
+        num_traj_samples: int = 6,
+        **kwargs: Any,
+    ) -> tuple[torch.Tensor, Cache, torch.Tensor]:
+        """Generate the reasoning traces like `_generate_reasoning`, verifying drafted tokens.
+
+        Every decoding step feeds the last sampled token of every trace followed by the tokens
+        proposed by `kwargs["drafter"]`, and samples a token at each of these positions from the
+        logits processed like in `generate`, i.e. with the trajectory tokens masked out. The drafts
+        are accepted up to the first one that differs from the token sampled before it, so the
+        traces follow the same distribution as without drafting, and the token sampled after the
+        last accepted draft is the next token of the trace.
+
+        Traces accept different numbers of drafts, so the keys of the rejected drafts are masked
+        out in the middle of the cache rows, with the positions of every row following its kept
+        tokens. Once every trace is done, the kept tokens are gathered after the prompts, which
+        leaves the cache, sequences and rope deltas of `generate`. The prompts are prefilled once
+        per clip.
 
-        # find <traj_future_start> token position for each sequence, use last token if not found
-        b_star = vlm_outputs.sequences.shape[0]
-        traj_future_start_mask = vlm_outputs.sequences == eos_token_id
-        # [b_star], True if sequence has <traj_future_start>
-        has_traj_future_start = traj_future_start_mask.any(dim=1)
-        for i in range(b_star):
-            if not has_traj_future_start[i]:
-                logger.warning(
-                    f"No <traj_future_start> token found in the generated sequences for sequence {i}"
-                )
-        # [b_star], first occurrence position
-        traj_future_start_positions = traj_future_start_mask.int().argmax(dim=1)
-        last_token_positions = torch.full(
-            (b_star,), vlm_outputs.sequences.shape[1] - 1, device=device
-        )
-        valid_token_pos_id = torch.where(
-            has_traj_future_start, traj_future_start_positions, last_token_positions
-        )
-        # note that vlm_outputs.sequences already include the input_ids,
-        # so no need to add the input_ids length
-        offset = valid_token_pos_id + 1
+        Args:
+            input_ids: The prompts with the history trajectory tokens, of shape (B, L).
+            prompt_attention_mask: The attention mask of the prompts, of shape (B, L).
+            tokenized_data: The other processor outputs, e.g. the pixel values.
+            eos_token_id: The ID of the <traj_future_start> token.
+            top_p: The top-p value for sampling.
+            top_k: The top-k value for sampling.
+            temperature: The temperature for sampling.
+            num_traj_samples: The number of reasoning traces per prompt.
+            **kwargs: `drafter` and `max_generation_length`, see
+                `sample_trajectories_from_data_with_vlm_rollout`.
 
-        # modify the position ids to remove padding tokens
-        n_diffusion_tokens = self.action_space.get_action_space_dims()[0]
-        position_ids = torch.arange(n_diffusion_tokens, device=device)
-        position_ids = einops.repeat(position_ids, "l -> 3 b l", b=b_star).clone()
-        delta = vlm_outputs.rope_deltas + offset[:, None]
-        position_ids += delta.to(position_ids.device)
-
-        # modify the attention_masks to remove padding tokens
-        attention_mask = torch.zeros(
-            (b_star, 1, n_diffusion_tokens, prompt_cache.get_seq_length() + n_diffusion_tokens),
-            dtype=torch.float32,
-            device=device,
+        Returns:
+            See `_generate_reasoning`.
+        """
+        if kwargs.get("cot_budget") is not None:
+            raise ValueError("cot_budget is not supported with speculative decoding")
+        drafter: NGramDrafter = kwargs["drafter"]
+        max_generation_length = kwargs.get(
+            "max_generation_length", self.config.tokens_per_future_traj
         )
-        for i in range(b_star):
-            attention_mask[i, :, :, offset[i] : -n_diffusion_tokens] = torch.finfo(
-                attention_mask.dtype
-            ).min
-
-        forward_kwargs = {}
-        if self.config.expert_non_causal_attention:
-            forward_kwargs["is_causal"] = False
-
-        # 2) Define denoising step that consumes noisy action and timestep
-        def step_fn(
-            x: torch.Tensor,
-            t: torch.Tensor,
-        ) -> torch.Tensor:
-            # x: (B*, *action_dim)
-            # t: broadcastable to x leading dims
-            b_star = x.shape[0]
-            # Project noisy action to expert token embeddings for the n future tokens
-            # Expect shape (b*, n_token_per_traj, hidden_size)
-            future_token_embeds = self.action_in_proj(x, t)
-            if future_token_embeds.dim() == 2:
-                future_token_embeds = future_token_embeds.view(b_star, n_diffusion_tokens, -1)
-
-            # Run expert with cached prefill, only on the future tokens
-            expert_out_base = self.expert(
-                inputs_embeds=future_token_embeds,
-                position_ids=position_ids,
-                past_key_values=prompt_cache,
-                attention_mask=attention_mask,
+        logits_processor = self._sampling_logits_processor(top_p, top_k, temperature)
+        device = input_ids.device
+        prompt_length = input_ids.shape[1]
+
+        cache = PaddedBatchCache()
+        with torch.no_grad():
+            outputs = self.vlm(
+                input_ids=input_ids,
+                attention_mask=prompt_attention_mask,
+                past_key_values=cache,
                 use_cache=True,
-                **forward_kwargs,
+                logits_to_keep=1,
+                **{k: v for k, v in tokenized_data.items() if k != "attention_mask"},
             )
-            # crop the prompt cache to remove the newly added tokens
-            prompt_cache.crop(prefill_seq_len)
-            last_hidden = expert_out_base.last_hidden_state  # (b*, Tf, hidden_size)
-            last_hidden = last_hidden[:, -n_diffusion_tokens:]
-            pred = self.action_out_proj(last_hidden).view(
-                -1, *self.action_space.get_action_space_dims()
-            )  # (b*, Tf, C_action) -> noise/vector field
-            return pred
-
-        # 3) Diffusion sampling in action space with multiple samples per input
-        total_batch = B * n_samples_total
-        if diffusion_kwargs is None:
-            diffusion_kwargs = {}
-
-        sampled_action = self.diffusion.sample(
-            batch_size=total_batch,
-            step_fn=step_fn,
+        # every reasoning trace of a clip starts from the clip's prompt
+        cache.batch_repeat_interleave(num_traj_samples)
+        rope_deltas = self.vlm.model.rope_deltas.to(device)
+        rope_deltas = rope_deltas.repeat_interleave(num_traj_samples, dim=0)
+        # [R, L'], zeros mark the left padding and the keys of the rejected drafts
+        attention_mask = prompt_attention_mask.repeat_interleave(num_traj_samples, dim=0)
+        num_rows = attention_mask.shape[0]
+        logits = outputs.logits[:, -1].float().repeat_interleave(num_traj_samples, dim=0)
+        del outputs
+
+        # [R, max_generation_length], the generated tokens, right-padded
+        tokens = torch.full(
+            (num_rows, max_generation_length),
+            self.tokenizer.pad_token_id,
+            dtype=input_ids.dtype,
             device=device,
-            return_all_steps=False,
-            **diffusion_kwargs,
         )
+        tokens[:, 0] = self._sample_tokens(logits_processor, input_ids, logits)
+        # [R], the number of generated tokens, all but the last of which are in the KV cache
+        num_generated = torch.ones(num_rows, dtype=torch.long, device=device)
+        # [R], whether the EOS token of a row is in the KV cache
+        eos_fed = torch.zeros(num_rows, dtype=torch.bool, device=device)
+        num_accepted_total = torch.zeros((), dtype=torch.long, device=device)
+        drafted = [0] * num_rows
+        drafter.start(num_rows)
+        while True:
+            # a row is done once its EOS is in the KV cache, as `StopAfterEOS` decides, or once
+            # it generated max_generation_length tokens, the last of which is not fed
+            done = eos_fed | (num_generated >= max_generation_length)
+            done_list, counts = done.tolist(), num_generated.tolist()
+            if all(done_list):
+                break
+            host_tokens = tokens.tolist()
+            drafts = []
+            for row in range(num_rows):
+                drafter.extend(row, host_tokens[row][drafted[row] : counts[row]])
+                drafted[row] = counts[row]
+                last_token = host_tokens[row][counts[row] - 1]
+                if done_list[row] or last_token == eos_token_id:
+                    drafts.append([])
+                    continue
+                # the tokens after the drafts and the sampled token fit max_generation_length
+                drafts.append(drafter.propose(row, max_generation_length - 1 - counts[row]))
+            num_drafts = [len(draft) for draft in drafts]
+            drafter.num_proposed += sum(num_drafts)
+            width = max(num_drafts)
+            draft_tokens = torch.tensor(
+                [draft + [self.tokenizer.pad_token_id] * (width - len(draft)) for draft in drafts],
+                dtype=tokens.dtype,
+                device=device,
+            )
+            draft_lengths = torch.tensor(num_drafts, device=device)
 
-        # Repeat history to align with num_traj_samples
-        hist_xyz_rep = einops.repeat(
-            ego_history_xyz[:, -1], "b ... -> (b n) ...", n=n_samples_total
+            step_tokens = torch.cat([tokens.gather(1, num_generated[:, None] - 1), draft_tokens], 1)
+            slots = torch.arange(width + 1, device=device)
+            length = attention_mask.shape[1]
+            attention_mask = torch.cat(
+                [attention_mask, ((slots <= draft_lengths[:, None]) & ~done[:, None]).long()], 1
+            )
+            # the kept tokens of a row are at the positions following its prompt
+            position_ids = prompt_length + rope_deltas + (num_generated - 1)[:, None] + slots
+            with torch.no_grad():
+                outputs = self.vlm(
+                    input_ids=step_tokens,
+                    attention_mask=attention_mask,
+                    position_ids=einops.repeat(position_ids, "b l -> 3 b l"),
+                    cache_position=length + slots,
+                    past_key_values=cache,
+                    use_cache=True,
+                )
+            sampled = self._sample_tokens(
+                logits_processor,
+                step_tokens.reshape(-1, 1),
+                outputs.logits.float().flatten(0, 1),
+            ).view(num_rows, width + 1)
+            del outputs
+
+            # accept the drafts up to the first one differing from the token sampled before it
+            matches = (draft_tokens == sampled[:, :-1]) & (slots[:-1] < draft_lengths[:, None])
+            num_accepted = matches.long().cumprod(dim=1).sum(dim=1)
+            num_accepted_total += num_accepted.sum()
+            # the fed token and the accepted drafts stay in the KV cache
+            kept = (slots <= num_accepted[:, None]) & ~done[:, None]
+            attention_mask[:, length:] = kept.long()
+            eos_fed |= ((step_tokens == eos_token_id) & kept).any(dim=1)
+            next_tokens = torch.where(
+                slots < num_accepted[:, None],
+                torch.cat([draft_tokens, sampled[:, -1:]], 1),
+                sampled.gather(1, num_accepted[:, None]),
+            )
+            rows, kept_slots = kept.nonzero(as_tuple=True)
+            tokens[rows, num_generated[rows] + kept_slots] = next_tokens[rows, kept_slots]
+            num_generated += kept.sum(dim=1)
+
+            # drop the trailing slots that no row kept
+            num_kept = int(kept.sum(dim=1).max())
+            if num_kept < width + 1:
+                cache.crop(length + num_kept)
+                attention_mask = attention_mask[:, : length + num_kept]
+        drafter.num_accepted += int(num_accepted_total)
+
+        # gather the kept generated tokens of every row right after its prompt, like `generate`
+        rejected = attention_mask[:, prompt_length:] == 0
+        num_generated_max = int(num_generated.max())
+        generated_indices = torch.sort(rejected.int(), dim=1, stable=True).indices
+        cache.gather_tokens(
+            torch.cat(
+                [
+                    torch.arange(prompt_length, device=device).expand(num_rows, -1),
+                    prompt_length + generated_indices[:, : num_generated_max - 1],
+                ],
+                dim=1,
+            )
         )
-        hist_rot_rep = einops.repeat(
-            ego_history_rot[:, -1], "b ... -> (b n) ...", n=n_samples_total
+        sequences = torch.cat(
+            [
+                input_ids.repeat_interleave(num_traj_samples, dim=0),
+                tokens[:, :num_generated_max],
+            ],
+            dim=1,
+        )
+        # manually replace padding after EOS token
+        sequences = replace_padding_after_eos(
+            token_ids=sequences,
+            eos_token_id=eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
         )
+        return sequences, cache, rope_deltas
+
+    @staticmethod
+    def _sample_tokens(
+        logits_processor: LogitsProcessorList, input_ids: torch.Tensor, logits: torch.Tensor
+    ) -> torch.Tensor:
+        """Sample a token from every row of logits, processed like in `generate`."""
+        scores = logits_processor(input_ids, logits)
+        probs = torch.nn.functional.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+    def sample_trajectories_from_handoff(
+        self,
+        handoff: RolloutHandoff,
+        num_traj_sets: int = 1,
+        diffusion_kwargs: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> tuple[torch.Tensor, torch.Tensor] | tuple[torch.Tensor, torch.Tensor, dict]:
+        """Run the diffusion stage of the rollout from the handoff of `rollout_vlm`.
+
+        The prompt cache of the handoff is released once the expert copied it.
+
+        Args:
+            handoff: The handoff returned by `rollout_vlm`.
+            num_traj_sets: The number of trajectory sets, i.e. of diffusion samples per reasoning
+                trace.
+            diffusion_kwargs: Extra keyword arguments for `self.diffusion.sample`.
+            **kwargs: `return_extra` and `capture_mode`, see
+                `sample_trajectories_from_data_with_vlm_rollout`. Other keys are ignored.
 
-        pred_xyz, pred_rot = self.action_space.action_to_traj(
-            sampled_action, hist_xyz_rep, hist_rot_rep
+        Returns:
+            See `sample_trajectories_from_data_with_vlm_rollout`.
+        """
+        num_traj_samples = handoff.num_traj_samples
+        num_clips = handoff.hist_xyz.shape[0] // num_traj_samples
+
+        # 2) Define denoising step that consumes noisy action and timestep, the diffusion rows
+        # (b nj ns) of the traces sharing a cache row are consecutive
+        step_fn = self._prepare_denoising_step(
+            handoff.prompt_cache,
+            handoff.prefix_mask,
+            handoff.position_ids,
+            num_traj_sets=num_traj_sets * handoff.cache_repeats,
+            capture_mode=kwargs.get("capture_mode"),
+        )
+        # the expert keeps its own copy of the prefix
+        handoff.prompt_cache = None
+
+        # 3) Diffusion sampling in action space with multiple samples per input
+        pred_xyz, pred_rot = self._sample_actions(
+            step_fn,
+            handoff.hist_xyz,
+            handoff.hist_rot,
+            num_traj_sets=num_traj_sets,
+            diffusion_kwargs=diffusion_kwargs,
         )
 
-        # 4) Reshape to (B, num_traj_samples, n_traj, ...)
+        # 4) Reshape to (B, num_traj_sets, num_traj_samples, ...)
         pred_xyz = einops.rearrange(
-            pred_xyz, "(b ns nj) ... -> b ns nj ...", ns=num_traj_sets, nj=num_traj_samples
+            pred_xyz, "(b nj ns) ... -> b ns nj ...", ns=num_traj_sets, nj=num_traj_samples
         )
         pred_rot = einops.rearrange(
-            pred_rot, "(b ns nj) ... -> b ns nj ...", ns=num_traj_sets, nj=num_traj_samples
+            pred_rot, "(b nj ns) ... -> b ns nj ...", ns=num_traj_sets, nj=num_traj_samples
         )
 
         # return the text tokens generated by the VLM
         if kwargs.get("return_extra", False):
-            extra = extract_text_tokens(self.tokenizer, vlm_outputs.sequences)
-            # rearrange text tokens to shape [B, ns, nj] to match trajectory shape
+            if handoff.sequences is None:
+                # no reasoning to decode in trajectory-only mode
+                extra = {key: [""] * handoff.hist_xyz.shape[0] for key in TEXT_TOKENS}
+            else:
+                extra = extract_text_tokens(self.tokenizer, handoff.sequences)
+            # rearrange text tokens to shape [B, ns, nj] to match trajectory shape,
+            # all the trajectory sets share the reasoning traces
             for text_tokens in extra.keys():
-                extra[text_tokens] = np.array(extra[text_tokens]).reshape(
-                    [input_ids.shape[0], num_traj_sets, num_traj_samples]
+                extra[text_tokens] = np.broadcast_to(
+                    np.array(extra[text_tokens]).reshape([num_clips, 1, num_traj_samples]),
+                    [num_clips, num_traj_sets, num_traj_samples],
                 )
             return pred_xyz, pred_rot, extra
         return pred_xyz, pred_rot
@@ -15,7 +15,9 @@
 
 """Base Reasoning VLA model implementation for Alpamayo R1 release."""
 
+import hashlib
 import logging
+from collections import OrderedDict
 from typing import Any
 
 import einops
@@ -88,8 +90,98 @@ def replace_pad_token(input_ids: torch.Tensor, new_ids: torch.Tensor, pad_idx: i
     return input_ids.masked_scatter(mask, new_ids)
 
 
+class HistoryTokenCache:
+    """LRU cache of the history trajectory tokens, keyed by the bytes of each history.
+
+    Encoding a history runs the full trajectory tokenizer, e.g. `traj_to_action` and its
+    regularized least-squares solves for the discrete tokenizer, although re-running the same
+    scenes with other sampling parameters or prompts always yields the same tokens. Each history
+    row is hashed and only the rows that were not seen before are encoded.
+
+    Hashing reads the histories on the host, so this adds a device-to-host copy of the (small)
+    history tensors per rollout. It is disabled unless assigned to `model.hist_token_cache`.
+
+    Example:
+        >>> model.hist_token_cache = HistoryTokenCache(max_size=4096)
+        >>> model.sample_trajectories_from_data_with_vlm_rollout(data)  # misses
+        >>> model.sample_trajectories_from_data_with_vlm_rollout(data, temperature=0.8)  # hits
+    """
+
+    def __init__(self, max_size: int = 1024):
+        """Initialize the HistoryTokenCache.
+
+        Args:
+            max_size: The maximum number of cached history rows.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, bytes], torch.Tensor] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        """Drop all the cached tokens and reset the counters."""
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _row_keys(hist_xyz: torch.Tensor, hist_rot: torch.Tensor) -> list[tuple[str, bytes]]:
+        """Hash every row of the histories, keyed together with their shapes, dtype and device."""
+        rows = torch.cat([hist_xyz.flatten(1), hist_rot.flatten(1).to(hist_xyz.dtype)], dim=1)
+        meta = f"{tuple(hist_xyz.shape[1:])}{tuple(hist_rot.shape[1:])}{rows.dtype}{rows.device}"
+        rows = rows.cpu().view(torch.uint8).numpy()
+        return [(meta, hashlib.blake2b(row.tobytes(), digest_size=16).digest()) for row in rows]
+
+    def encode(
+        self, tokenizer: Any, hist_xyz: torch.Tensor, hist_rot: torch.Tensor
+    ) -> torch.Tensor:
+        """Encode the histories with the tokenizer, reusing the tokens of the cached rows.
+
+        Args:
+            tokenizer: Trajectory tokenizer with encode method
+            hist_xyz: [N, T, 3] history locations
+            hist_rot: [N, T, 3, 3] history rotations
+
+        Returns:
+            torch.Tensor: [N, tokens_per_history_traj] the tokens of every history
+        """
+        keys = self._row_keys(hist_xyz, hist_rot)
+        rows = [self._entries.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        for i, row in enumerate(rows):
+            if row is not None:
+                self._entries.move_to_end(keys[i])
+
+        if missing:
+            idx = torch.tensor(missing, device=hist_xyz.device)
+            tokens = _encode_history(tokenizer, hist_xyz[idx], hist_rot[idx])
+            for i, row in zip(missing, tokens):
+                rows[i] = row
+                self._entries[keys[i]] = row
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return torch.stack(rows)
+
+
+def _encode_history(tokenizer: Any, hist_xyz: torch.Tensor, hist_rot: torch.Tensor) -> torch.Tensor:
+    """Encode [N, T, ...] histories into [N, tokens_per_history_traj] tokens."""
+    return tokenizer.encode(
+        hist_xyz=hist_xyz[:, :1],
+        hist_rot=hist_rot[:, :1],
+        fut_xyz=hist_xyz,  # note hist_xyz is passed to fut_xyz as it's encoding history.
+        fut_rot=hist_rot,
+    )
+
+
 def tokenize_history_trajectory(
-    tokenizer: Any, traj_data: dict[str, Any], start_idx: int = 0
+    tokenizer: Any,
+    traj_data: dict[str, Any],
+    start_idx: int = 0,
+    cache: HistoryTokenCache | None = None,
 ) -> torch.Tensor:
     """Tokenize the history trajectory with prefix shape of (B, n_traj, ...).
 
@@ -97,6 +189,7 @@ def tokenize_history_trajectory(
         tokenizer: Trajectory tokenizer with encode method
         traj_data: dict containing "ego_history_xyz" and "ego_history_rot"
         start_idx: start of token index of the history trajectory tokens
+        cache: optional cache of the tokens of previously seen histories
 
     Returns:
         torch.Tensor: [B, n_traj * tokens_per_history_traj]
@@ -108,15 +201,11 @@ def tokenize_history_trajectory(
     hist_xyz = traj_data["ego_history_xyz"].flatten(start_dim=0, end_dim=1)
     hist_rot = traj_data["ego_history_rot"].flatten(start_dim=0, end_dim=1)
 
-    hist_idx = (
-        tokenizer.encode(
-            hist_xyz=hist_xyz[:, :1],
-            hist_rot=hist_rot[:, :1],
-            fut_xyz=hist_xyz,  # note hist_xyz is passed to fut_xyz as it's encoding history.
-            fut_rot=hist_rot,
-        )
-        + start_idx
-    )  # [B*n_traj, tokens_per_history_traj]
+    if cache is None:
+        hist_idx = _encode_history(tokenizer, hist_xyz, hist_rot)
+    else:
+        hist_idx = cache.encode(tokenizer, hist_xyz, hist_rot)
+    hist_idx = hist_idx + start_idx  # [B*n_traj, tokens_per_history_traj]
     hist_idx = einops.rearrange(hist_idx, "(b n_traj) n -> b (n_traj n)", b=B)
 
     return hist_idx
@@ -188,7 +277,10 @@ class TrajectoryFusionMixin:
         attrs = self._validate_mixin_requirements(require_future=has_future)
 
         hist_idx = tokenize_history_trajectory(
-            attrs["hist_traj_tokenizer"], traj_data, attrs["hist_token_start_idx"]
+            attrs["hist_traj_tokenizer"],
+            traj_data,
+            attrs["hist_token_start_idx"],
+            cache=getattr(self, "hist_token_cache", None),
         )
         input_ids = replace_pad_token(
             input_ids, hist_idx, attrs["config"].traj_token_ids["history"]
@@ -310,6 +402,8 @@ class ReasoningVLA(PreTrainedModel, TrajectoryFusionMixin):
 
         # Initialize trajectory tokenizers
         self._initialize_trajectory_tokenizers(config, pretrained_modules)
+        # Opt-in cache of the history tokens, see `HistoryTokenCache`
+        self.hist_token_cache: HistoryTokenCache | None = None
 
         # Build tokenizer
         self.tokenizer = self._build_tokenizer(config)
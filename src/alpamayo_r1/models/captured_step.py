@@ -0,0 +1,240 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Denoising steps captured with CUDA graphs or torch.compile."""
+
+import logging
+import math
+from collections import OrderedDict
+from typing import Any, Callable, Literal
+
+import torch
+from transformers.cache_utils import Cache
+
+from alpamayo_r1.diffusion.base import StepFn
+from alpamayo_r1.models.prefix_expert import PrefixCachedExpert, PrefixMask
+
+logger = logging.getLogger(__name__)
+
+CaptureMode = Literal["cuda_graph", "compile"]
+# (expert_fn, x, t) -> the vector field of x at t
+DenoiseFn = Callable[[PrefixCachedExpert, torch.Tensor, torch.Tensor], torch.Tensor]
+
+
+class _CapturedBucket:
+    """Static buffers and the captured denoising step of one shape bucket."""
+
+    def __init__(
+        self,
+        denoise_fn: DenoiseFn,
+        expert_fn: PrefixCachedExpert,
+        x_dims: list[int],
+        mode: CaptureMode,
+        compiled_fn: DenoiseFn | None = None,
+        graph_pool: Any = None,
+        num_warmup_steps: int = 2,
+    ):
+        self.denoise_fn = denoise_fn
+        self.expert_fn = expert_fn
+        self.mode = mode
+        self.compiled_fn = compiled_fn
+        self.graph_pool = graph_pool
+        self.num_warmup_steps = num_warmup_steps
+        self.graph: torch.cuda.CUDAGraph | None = None
+        self.x_dims = x_dims
+        self.static_x: torch.Tensor | None = None
+        self.static_t: torch.Tensor | None = None
+        self.static_out: torch.Tensor | None = None
+
+    def _allocate(self, x: torch.Tensor, t: torch.Tensor) -> None:
+        """Allocate the static inputs with the dtypes the integrator uses."""
+        batch_size = self.expert_fn.batch_size * self.expert_fn.num_groups
+        device = self.expert_fn.keys[0].device
+        self.static_x = torch.zeros((batch_size, *self.x_dims), dtype=x.dtype, device=device)
+        self.static_t = torch.zeros(
+            (batch_size, *[1] * len(self.x_dims)), dtype=t.dtype, device=device
+        )
+        self.graph = None
+
+    def _capture(self) -> None:
+        """Warm up on a side stream and capture one denoising step into a CUDA graph."""
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.num_warmup_steps):
+                self.denoise_fn(self.expert_fn, self.static_x, self.static_t)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph, pool=self.graph_pool):
+            self.static_out = self.denoise_fn(self.expert_fn, self.static_x, self.static_t)
+
+    def __call__(self, x: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
+        """Run the denoising step on the first x.shape[0] rows of the bucket."""
+        n = x.shape[0]
+        if self.static_x is None or (self.static_x.dtype, self.static_t.dtype) != (
+            x.dtype,
+            t.dtype,
+        ):
+            self._allocate(x, t)
+        self.static_x[:n].copy_(x)
+        self.static_t[:n].copy_(t)
+        if self.mode == "cuda_graph":
+            if self.graph is None:
+                self._capture()
+            self.graph.replay()
+            # the next replay overwrites the output, the integrators may keep it around
+            return self.static_out[:n].clone()
+        return self.compiled_fn(self.expert_fn, self.static_x, self.static_t)[:n]
+
+
+class CapturedDenoisingStep:
+    """Denoising step of the expert that is captured once per shape bucket and then replayed.
+
+    Every step of the denoising loop runs the same kernels on the same shapes, so at small batch
+    sizes it is bound by the kernel launches rather than by the compute. In `cuda_graph` mode the
+    step is captured into a CUDA graph and replayed, in `compile` mode it is compiled with
+    `torch.compile` (which also runs on CPU).
+
+    Prompts are padded to shape buckets so that the captured steps are reused across rollouts:
+    the number of prompt rows is rounded up to a power of two and the prefix length to a multiple
+    of `prefix_bucket_size`. Each bucket owns the `PrefixCachedExpert` buffers the step reads,
+    the prompts of a rollout are copied into them before sampling. Only the `max_buckets` most
+    recently used buckets are kept alive.
+
+    Example:
+        >>> captured_step = CapturedDenoisingStep(denoise_fn, x_dims, mode="cuda_graph")
+        >>> step_fn = captured_step.prepare(expert, prompt_cache, prefix_mask, position_ids)
+        >>> diffusion.sample(batch_size=b_star, step_fn=step_fn, device=device)
+    """
+
+    def __init__(
+        self,
+        denoise_fn: DenoiseFn,
+        x_dims: list[int],
+        mode: CaptureMode = "cuda_graph",
+        prefix_bucket_size: int = 512,
+        max_buckets: int = 2,
+        compile_kwargs: dict[str, Any] | None = None,
+    ):
+        """Initialize the CapturedDenoisingStep.
+
+        Args:
+            denoise_fn: The denoising step, mapping (expert_fn, x, t) to the vector field.
+            x_dims: The dimensions of the diffusion samples.
+            mode: `cuda_graph` to replay CUDA graphs, `compile` to use `torch.compile`.
+                `cuda_graph` falls back to `compile` on CPU.
+            prefix_bucket_size: The prefix lengths are rounded up to a multiple of this.
+            max_buckets: The maximum number of buckets kept alive.
+            compile_kwargs: Keyword arguments for `torch.compile`.
+        """
+        if mode not in ("cuda_graph", "compile"):
+            raise ValueError(f"Invalid capture mode: {mode}")
+        self.denoise_fn = denoise_fn
+        self.x_dims = list(x_dims)
+        self.mode = mode
+        self.prefix_bucket_size = prefix_bucket_size
+        self.max_buckets = max_buckets
+        self.compile_kwargs = compile_kwargs or {}
+        self._compiled_fn: DenoiseFn | None = None
+        self._graph_pool = None
+        self._buckets: OrderedDict[tuple, _CapturedBucket] = OrderedDict()
+
+    def bucket_shape(self, batch_size: int, prefix_len: int) -> tuple[int, int]:
+        """Returns the bucketed number of prompt rows and prefix length."""
+        batch_bucket = 1 << math.ceil(math.log2(batch_size))
+        prefix_bucket = math.ceil(prefix_len / self.prefix_bucket_size) * self.prefix_bucket_size
+        return batch_bucket, prefix_bucket
+
+    def _get_bucket(
+        self,
+        expert: torch.nn.Module,
+        batch_size: int,
+        prefix_len: int,
+        n_tokens: int,
+        num_groups: int,
+        is_causal: bool,
+    ) -> _CapturedBucket:
+        """Get the bucket of the given shapes, creating it if needed."""
+        mode = self.mode
+        if mode == "cuda_graph" and expert.device.type != "cuda":
+            logger.warning("CUDA graphs need a CUDA device, falling back to torch.compile")
+            mode = "compile"
+        key = (*self.bucket_shape(batch_size, prefix_len), n_tokens, num_groups, is_causal, mode)
+        if key in self._buckets:
+            self._buckets.move_to_end(key)
+            return self._buckets[key]
+
+        while len(self._buckets) >= self.max_buckets:
+            self._buckets.popitem(last=False)
+        if mode == "compile" and self._compiled_fn is None:
+            self._compiled_fn = torch.compile(self.denoise_fn, dynamic=False, **self.compile_kwargs)
+        if mode == "cuda_graph" and self._graph_pool is None:
+            self._graph_pool = torch.cuda.graph_pool_handle()
+        expert_fn = PrefixCachedExpert(
+            expert,
+            batch_size=key[0],
+            prefix_len=key[1],
+            n_tokens=n_tokens,
+            num_groups=num_groups,
+            is_causal=is_causal,
+        )
+        bucket = _CapturedBucket(
+            self.denoise_fn,
+            expert_fn,
+            self.x_dims,
+            mode,
+            compiled_fn=self._compiled_fn,
+            graph_pool=self._graph_pool,
+        )
+        self._buckets[key] = bucket
+        return bucket
+
+    def prepare(
+        self,
+        expert: torch.nn.Module,
+        prefix_cache: Cache,
+        prefix_mask: PrefixMask,
+        position_ids: torch.Tensor,
+        num_groups: int = 1,
+        is_causal: bool = False,
+    ) -> StepFn:
+        """Load the prompts into the bucket they fit in and return its step function.
+
+        Args:
+            expert: The expert text model, a `Qwen3VLTextModel`.
+            prefix_cache: See `PrefixCachedExpert.load`.
+            prefix_mask: See `PrefixCachedExpert.load`.
+            position_ids: See `PrefixCachedExpert.load`.
+            num_groups: The number of consecutive expert rows that share a prompt row.
+            is_causal: Whether the expert tokens attend causally to each other.
+
+        Returns:
+            The step function of the bucket. It is only valid until the next call to `prepare`.
+        """
+        bucket = self._get_bucket(
+            expert,
+            batch_size=prefix_mask.start.shape[0],
+            prefix_len=prefix_mask.length,
+            n_tokens=position_ids.shape[-1],
+            num_groups=num_groups,
+            is_causal=is_causal,
+        )
+        bucket.expert_fn.load(prefix_cache, prefix_mask, position_ids)
+
+        def step_fn(x: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
+            return bucket(x, t)
+
+        return step_fn
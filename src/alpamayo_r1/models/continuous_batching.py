@@ -0,0 +1,436 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Continuous batching of the reasoning rollouts of requests with heterogeneous lengths."""
+
+import collections
+import logging
+from typing import Any
+
+import einops
+import numpy as np
+import torch
+from transformers.cache_utils import DynamicCache
+from alpamayo_r1.models.alpamayo_r1 import AlpamayoR1
+from alpamayo_r1.models.captured_step import CaptureMode
+from alpamayo_r1.models.kv_cache import PaddedBatchCache
+from alpamayo_r1.models.prefix_expert import PrefixMask
+from alpamayo_r1.models.token_utils import (
+    StopAfterEOS,
+    extract_text_tokens,
+    replace_padding_after_eos,
+    to_special_token,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ContinuousBatchRequest:
+    """A request submitted to a `ContinuousBatchScheduler`, filled in as its rows retire."""
+
+    def __init__(self, data: dict[str, Any], num_traj_samples: int):
+        """Initialize the ContinuousBatchRequest.
+
+        Args:
+            data: The model inputs of the request, see `create_batch_inputs` in `helper`.
+            num_traj_samples: The number of reasoning traces per clip.
+        """
+        self.data = data
+        self.num_clips = data["ego_history_xyz"].shape[0]
+        self.num_rows = self.num_clips * num_traj_samples
+        self.num_pending = self.num_rows
+        # per row: (pred_xyz, pred_rot, generated tokens)
+        self.row_results: list[tuple[torch.Tensor, torch.Tensor, torch.Tensor] | None] = [
+            None
+        ] * self.num_rows
+        # (pred_xyz, pred_rot, extra) once every row retired
+        self.result: tuple[torch.Tensor, torch.Tensor, dict[str, np.ndarray]] | None = None
+
+    @property
+    def done(self) -> bool:
+        """Whether every row of the request retired."""
+        return self.result is not None
+
+
+class ContinuousBatchScheduler:
+    """Decodes the reasoning traces of many requests as one batch whose rows join and leave.
+
+    A static batch decodes until its longest reasoning trace is done, so the rows that emit
+    <traj_future_start> early idle, and new requests wait for the whole batch. Here every decoding
+    step feeds one token to all the running rows. A row retires right after its EOS is in the KV
+    cache, as `StopAfterEOS` decides for `generate`, and its trajectories are sampled by the
+    diffusion expert from its cache row. The freed rows are refilled by prefilling the waiting
+    requests, whose caches join the running batch left-padded to the common length.
+
+    The rows of a request are sampled like the rollout of
+    `sample_trajectories_from_data_with_vlm_rollout`, with the same positions and valid prefix
+    keys per row, so each request resolves to the outputs of that rollout with `return_extra`.
+
+    Example:
+        >>> scheduler = ContinuousBatchScheduler(model, max_rows=32, num_traj_samples=1)
+        >>> requests = [scheduler.submit(data) for data in model_inputs]  # one per request
+        >>> scheduler.run_until_idle()
+        >>> pred_xyz, pred_rot, extra = requests[0].result
+    """
+
+    def __init__(
+        self,
+        model: AlpamayoR1,
+        max_rows: int = 32,
+        top_p: float = 0.98,
+        top_k: int | None = None,
+        temperature: float = 0.6,
+        num_traj_samples: int = 6,
+        num_traj_sets: int = 1,
+        max_generation_length: int | None = None,
+        diffusion_kwargs: dict[str, Any] | None = None,
+        capture_mode: CaptureMode | None = None,
+    ):
+        """Initialize the ContinuousBatchScheduler.
+
+        Args:
+            model: The AlpamayoR1 model.
+            max_rows: The maximum number of reasoning traces decoded together. A request is only
+                admitted when all its clips * num_traj_samples rows fit, unless nothing runs.
+            top_p: The top-p value for sampling.
+            top_k: The top-k value for sampling.
+            temperature: The temperature for sampling.
+            num_traj_samples: The number of reasoning traces per clip.
+            num_traj_sets: The number of trajectory sets sampled per reasoning trace.
+            max_generation_length: The maximum number of generated tokens per reasoning trace,
+                `config.tokens_per_future_traj` by default.
+            diffusion_kwargs: Extra keyword arguments for `model.diffusion.sample`.
+            capture_mode: See `sample_trajectories_from_data_with_vlm_rollout`.
+        """
+        if max_rows < 1:
+            raise ValueError(f"max_rows must be positive, got {max_rows}")
+        self.model = model
+        self.max_rows = max_rows
+        self.num_traj_samples = num_traj_samples
+        self.num_traj_sets = num_traj_sets
+        self.max_generation_length = max_generation_length or model.config.tokens_per_future_traj
+        self.diffusion_kwargs = diffusion_kwargs
+        self.capture_mode = capture_mode
+        self.eos_token_id = model.tokenizer.convert_tokens_to_ids(
+            to_special_token("traj_future_start")
+        )
+        self.pad_token_id = model.tokenizer.pad_token_id
+        self.logits_processor = model._sampling_logits_processor(top_p, top_k, temperature)
+        self.num_steps = 0
+        self.num_completed = 0
+        self._waiting: collections.deque[ContinuousBatchRequest] = collections.deque()
+        self._reset_rows()
+
+    def _reset_rows(self) -> None:
+        """Drop the running rows."""
+        self._cache = PaddedBatchCache()
+        self._stop = StopAfterEOS(eos_token_id=self.eos_token_id)
+        # (request, row of the request) of every running row
+        self._rows: list[tuple[ContinuousBatchRequest, int]] = []
+        # [R, L], zeros mark the left padding of every row
+        self._attention_mask: torch.Tensor | None = None
+        # [R, 1], the position of the token at index i of a row is i + its rope delta
+        self._rope_deltas: torch.Tensor | None = None
+        # [R, max_generation_length], the generated tokens, right-padded
+        self._tokens: torch.Tensor | None = None
+        # [R], the number of generated tokens
+        self._num_generated: torch.Tensor | None = None
+        # [R], whether the EOS token of a row is in the KV cache
+        self._eos_fed: torch.Tensor | None = None
+
+    @property
+    def num_running(self) -> int:
+        """The number of reasoning traces being decoded."""
+        return len(self._rows)
+
+    @property
+    def num_waiting(self) -> int:
+        """The number of requests waiting for free rows."""
+        return len(self._waiting)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of decoding steps, of completed requests and of rows and requests."""
+        return {
+            "steps": self.num_steps,
+            "completed": self.num_completed,
+            "running_rows": self.num_running,
+            "waiting": self.num_waiting,
+            "max_rows": self.max_rows,
+        }
+
+    def submit(self, data: dict[str, Any]) -> ContinuousBatchRequest:
+        """Queue a request, admitted at the next step with enough free rows.
+
+        Args:
+            data: The model inputs of one or more clips on the device of the model, see
+                `sample_trajectories_from_data_with_vlm_rollout`. They are not modified.
+
+        Returns:
+            The request, whose `result` is set by the `step` that completes it.
+        """
+        request = ContinuousBatchRequest(data, self.num_traj_samples)
+        self._waiting.append(request)
+        return request
+
+    def clear(self) -> list[ContinuousBatchRequest]:
+        """Drop the waiting and running requests, e.g. after a failed step.
+
+        Returns:
+            The dropped requests.
+        """
+        dropped = list(self._waiting)
+        for request, _ in self._rows:
+            if request not in dropped:
+                dropped.append(request)
+        self._waiting.clear()
+        self._reset_rows()
+        return dropped
+
+    @torch.no_grad()
+    def step(self) -> list[ContinuousBatchRequest]:
+        """Admit the waiting requests that fit, decode one token and retire the finished rows.
+
+        Returns:
+            The requests completed during the step.
+        """
+        self._admit()
+        completed = self._retire()
+        if self._rows:
+            self._decode()
+            completed += self._retire()
+        self.num_steps += 1
+        self.num_completed += len(completed)
+        return completed
+
+    def run_until_idle(self) -> list[ContinuousBatchRequest]:
+        """Step until every submitted request is completed.
+
+        Returns:
+            The completed requests, in the order of completion.
+        """
+        completed = []
+        while self._rows or self._waiting:
+            completed += self.step()
+        return completed
+
+    def _admit(self) -> None:
+        """Prefill the waiting requests while their rows fit."""
+        while self._waiting:
+            request = self._waiting[0]
+            if self._rows and self.num_running + request.num_rows > self.max_rows:
+                break
+            self._waiting.popleft()
+            self._prefill(request)
+
+    def _prefill(self, request: ContinuousBatchRequest) -> None:
+        """Prefill the prompts of a request, sample the first tokens and add its rows."""
+        model, data = self.model, request.data
+        tokenized_data = dict(data["tokenized_data"])
+        input_ids = tokenized_data.pop("input_ids")
+        if tokenized_data.get("attention_mask") is None:
+            tokenized_data["attention_mask"] = torch.ones_like(input_ids)
+        traj_data_vlm = {
+            "ego_history_xyz": data["ego_history_xyz"],
+            "ego_history_rot": data["ego_history_rot"],
+        }
+        input_ids = model.fuse_traj_tokens(input_ids, traj_data_vlm)
+        cache = DynamicCache()
+        outputs = model.vlm(
+            input_ids=input_ids,
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=1,
+            **tokenized_data,
+        )
+        # every reasoning trace of a clip starts from the clip's prompt
+        num_samples = self.num_traj_samples
+        cache.batch_repeat_interleave(num_samples)
+        attention_mask = tokenized_data["attention_mask"].repeat_interleave(num_samples, dim=0)
+        rope_deltas = model.vlm.model.rope_deltas.repeat_interleave(num_samples, dim=0)
+        logits = outputs.logits[:, -1].float().repeat_interleave(num_samples, dim=0)
+        first_tokens = self._sample(input_ids.new_empty((logits.shape[0], 0)), logits)
+
+        if self._rows:
+            padding, new_padding = self._cache.append_rows(cache)
+            self._attention_mask = torch.cat(
+                [
+                    torch.nn.functional.pad(self._attention_mask, (padding, 0)),
+                    torch.nn.functional.pad(attention_mask, (new_padding, 0)),
+                ]
+            )
+            # padding shifts the indices, not the positions, of the tokens of a row
+            self._rope_deltas = torch.cat(
+                [self._rope_deltas - padding, rope_deltas.to(self._rope_deltas) - new_padding]
+            )
+        else:
+            self._cache = PaddedBatchCache()
+            self._cache.append_rows(cache)
+            self._attention_mask = attention_mask
+            self._rope_deltas = rope_deltas.to(input_ids.device)
+        del cache, outputs
+
+        tokens = torch.full(
+            (request.num_rows, self.max_generation_length),
+            self.pad_token_id,
+            dtype=input_ids.dtype,
+            device=input_ids.device,
+        )
+        tokens[:, 0] = first_tokens
+        num_generated = torch.ones(request.num_rows, dtype=torch.long, device=input_ids.device)
+        eos_fed = torch.zeros(request.num_rows, dtype=torch.bool, device=input_ids.device)
+        self._tokens = tokens if self._tokens is None else torch.cat([self._tokens, tokens])
+        self._num_generated = (
+            num_generated
+            if self._num_generated is None
+            else torch.cat([self._num_generated, num_generated])
+        )
+        self._eos_fed = eos_fed if self._eos_fed is None else torch.cat([self._eos_fed, eos_fed])
+        self._stop.add_rows(first_tokens[:, None])
+        self._rows.extend((request, row) for row in range(request.num_rows))
+
+    def _sample(self, input_ids: torch.Tensor, logits: torch.Tensor) -> torch.Tensor:
+        """Sample the next token of every row from its logits, as `generate` does."""
+        return self.model._sample_tokens(self.logits_processor, input_ids, logits)
+
+    def _decode(self) -> None:
+        """Feed the last generated token of every running row and sample the next one."""
+        num_rows, length = self._attention_mask.shape
+        last_tokens = self._tokens.gather(1, self._num_generated[:, None] - 1)
+        self._attention_mask = torch.nn.functional.pad(self._attention_mask, (0, 1), value=1)
+        position_ids = einops.repeat(length + self._rope_deltas, "b l -> 3 b l")
+        outputs = self.model.vlm(
+            input_ids=last_tokens,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            cache_position=torch.tensor([length], device=last_tokens.device),
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        next_tokens = self._sample(self._tokens, outputs.logits[:, -1].float())
+        # the rows whose EOS was fed now are done, their next token is discarded
+        self._eos_fed = self._stop.update(next_tokens[:, None])
+        # the rows that generated max_generation_length tokens retired before this step
+        rows = torch.arange(num_rows, device=next_tokens.device)
+        self._tokens[rows, self._num_generated] = next_tokens
+        self._num_generated += 1
+
+    def _retire(self) -> list[ContinuousBatchRequest]:
+        """Sample the trajectories of the finished rows and remove them from the batch.
+
+        A row is finished once its EOS is in the KV cache or once it generated
+        `max_generation_length` tokens, the last of which is not fed.
+
+        Returns:
+            The requests completed by the retired rows.
+        """
+        finished = self._eos_fed | (self._num_generated >= self.max_generation_length)
+        if not finished.any():
+            return []
+        model = self.model
+        retired = finished.nonzero().flatten()
+        length = self._attention_mask.shape[1]
+        # the diffusion tokens follow the EOS, or the last generated token without EOS
+        offset = torch.where(self._eos_fed[retired], length, length + 1)
+        prefix_mask = PrefixMask(
+            start=(self._attention_mask[retired] != 0).int().argmax(dim=1),
+            end=offset,
+            length=length,
+        )
+        n_diffusion_tokens = model.action_space.get_action_space_dims()[0]
+        delta = self._rope_deltas[retired] + offset[:, None]
+        position_ids = torch.arange(n_diffusion_tokens, device=delta.device) + delta
+        position_ids = einops.repeat(position_ids, "b l -> 3 b l")
+
+        rows = [self._rows[i] for i in retired.tolist()]
+        clips = [row // self.num_traj_samples for _, row in rows]
+        hist_xyz = torch.stack(
+            [request.data["ego_history_xyz"][clip, -1] for (request, _), clip in zip(rows, clips)]
+        )
+        hist_rot = torch.stack(
+            [request.data["ego_history_rot"][clip, -1] for (request, _), clip in zip(rows, clips)]
+        )
+        step_fn = model._prepare_denoising_step(
+            self._cache.select_rows(retired),
+            prefix_mask,
+            position_ids,
+            num_traj_sets=self.num_traj_sets,
+            capture_mode=self.capture_mode,
+        )
+        pred_xyz, pred_rot = model._sample_actions(
+            step_fn,
+            hist_xyz,
+            hist_rot,
+            num_traj_sets=self.num_traj_sets,
+            diffusion_kwargs=self.diffusion_kwargs,
+        )
+        pred_xyz = einops.rearrange(pred_xyz, "(b ns) ... -> b ns ...", ns=self.num_traj_sets)
+        pred_rot = einops.rearrange(pred_rot, "(b ns) ... -> b ns ...", ns=self.num_traj_sets)
+        tokens = replace_padding_after_eos(
+            token_ids=self._tokens[retired],
+            eos_token_id=self.eos_token_id,
+            pad_token_id=self.pad_token_id,
+        )
+        has_eos = (tokens == self.eos_token_id).any(dim=1)
+        if not has_eos.all():
+            logger.warning(f"No <traj_future_start> token found in {int((~has_eos).sum())} rows")
+
+        completed = []
+        for i, (request, row) in enumerate(rows):
+            request.row_results[row] = (pred_xyz[i], pred_rot[i], tokens[i])
+            request.num_pending -= 1
+            if request.num_pending == 0:
+                self._complete(request)
+                completed.append(request)
+        self._select_rows((~finished).nonzero().flatten())
+        return completed
+
+    def _select_rows(self, indices: torch.Tensor) -> None:
+        """Only keep the running rows at `indices` and drop the padding they all share."""
+        if indices.numel() == 0:
+            self._reset_rows()
+            return
+        self._cache.batch_select_indices(indices)
+        self._stop.batch_select_indices(indices)
+        self._rows = [self._rows[i] for i in indices.tolist()]
+        self._attention_mask = self._attention_mask[indices]
+        self._rope_deltas = self._rope_deltas[indices]
+        self._tokens = self._tokens[indices]
+        self._num_generated = self._num_generated[indices]
+        self._eos_fed = self._eos_fed[indices]
+
+        num_padding = int((self._attention_mask != 0).int().argmax(dim=1).min())
+        if num_padding > 0:
+            self._cache.trim_left(num_padding)
+            self._attention_mask = self._attention_mask[:, num_padding:]
+            self._rope_deltas = self._rope_deltas + num_padding
+
+    def _complete(self, request: ContinuousBatchRequest) -> None:
+        """Assemble the results of the rows of a request like the rollout does."""
+        pred_xyz, pred_rot, tokens = (torch.stack(r) for r in zip(*request.row_results))
+        request.row_results = []
+        pred_xyz = einops.rearrange(
+            pred_xyz, "(b nj) ns ... -> b ns nj ...", nj=self.num_traj_samples
+        )
+        pred_rot = einops.rearrange(
+            pred_rot, "(b nj) ns ... -> b ns nj ...", nj=self.num_traj_samples
+        )
+        extra = extract_text_tokens(self.model.tokenizer, tokens)
+        # all the trajectory sets share the reasoning traces
+        shape = [request.num_clips, self.num_traj_sets, self.num_traj_samples]
+        for text_tokens in extra.keys():
+            extra[text_tokens] = np.broadcast_to(
+                np.array(extra[text_tokens]).reshape([request.num_clips, 1, shape[2]]), shape
+            )
+        request.result = (pred_xyz, pred_rot, extra)
@@ -13,13 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+
 import einops
 import numpy as np
 import torch
+from alpamayo_r1.geometry.rotation import rot_2d_to_3d, rotation_matrix_torch
+
 
+class DeltaTrajectoryTokenizer(torch.nn.Module):
+    """Delta trajectory tokenizers.
 
-class DeltaTrajectoryTokenizer:
-    """Delta trajectory tokenizers."""
+    The bins of the xyz deltas are held in non-persistent buffers, so they follow the device of the
+    model the tokenizer is attached to and encoding/decoding does not copy them from the host.
+    """
 
     def __init__(
         self,
@@ -32,18 +39,37 @@ class DeltaTrajectoryTokenizer:
         load_weights: bool = False,
     ):
         """Initializes the tokenizer."""
+        super().__init__()
         self.ego_xyz_min = ego_xyz_min
         self.ego_xyz_max = ego_xyz_max
         self.num_bins = num_bins
         self._predict_yaw = predict_yaw
         self.ego_yaw_min = ego_yaw_min
         self.ego_yaw_max = ego_yaw_max
+        # explicit float32 so that the bins do not depend on the default dtype at construction
+        xyz_min = torch.tensor(ego_xyz_min, dtype=torch.float32)
+        xyz_max = torch.tensor(ego_xyz_max, dtype=torch.float32)
+        self.register_buffer("xyz_bins_min", xyz_min, persistent=False)
+        self.register_buffer("xyz_bins_range", xyz_max - xyz_min, persistent=False)
 
     @property
     def vocab_size(self) -> int:
         """Tokens are integers from the set {0, 1, ..., vocab_size - 1}"""
         return self.num_bins
 
+    def _quantize_xyz(self, xyz: torch.Tensor) -> torch.LongTensor:
+        """Quantize the xyz deltas to their bin indices."""
+        bins_min = self.xyz_bins_min.to(device=xyz.device, dtype=xyz.dtype)
+        bins_range = self.xyz_bins_range.to(device=xyz.device, dtype=xyz.dtype)
+        xyz = (xyz - bins_min) / bins_range * (self.num_bins - 1)
+        return xyz.round_().clamp_(0, self.num_bins - 1).long()
+
+    def _dequantize_xyz(self, xyz: torch.Tensor) -> torch.Tensor:
+        """Map the bin indices of the xyz deltas (as floats) back to the deltas."""
+        bins_min = self.xyz_bins_min.to(device=xyz.device, dtype=xyz.dtype)
+        bins_range = self.xyz_bins_range.to(device=xyz.device, dtype=xyz.dtype)
+        return torch.addcmul(bins_min, xyz / (self.num_bins - 1), bins_range)
+
     def encode(
         self,
         hist_xyz: torch.Tensor,
@@ -71,11 +97,7 @@ class DeltaTrajectoryTokenizer:
         del hist_xyz, hist_rot, hist_tstamp, fut_tstamp
         xyz = torch.nn.functional.pad(fut_xyz, [0, 0, 1, 0, 0, 0])
         xyz = xyz[:, 1:] - xyz[:, :-1]
-        ego_xyz_max = torch.tensor(self.ego_xyz_max, dtype=xyz.dtype, device=xyz.device)
-        ego_xyz_min = torch.tensor(self.ego_xyz_min, dtype=xyz.dtype, device=xyz.device)
-        xyz = (xyz - ego_xyz_min) / (ego_xyz_max - ego_xyz_min)
-        xyz = (xyz * (self.num_bins - 1)).round().long()
-        xyz = xyz.clamp(0, self.num_bins - 1)
+        xyz = self._quantize_xyz(xyz)
         if not self._predict_yaw:
             return einops.rearrange(xyz, "b n m -> b (n m)")
         # Extract yaw angles from rotation matrices
@@ -121,16 +143,10 @@ class DeltaTrajectoryTokenizer:
         del hist_tstamp
         m = 4 if self._predict_yaw else 3
         xyzw = einops.rearrange(tokens, "b (n m) -> b n m", m=m).to(hist_xyz.dtype)
-        xyz = xyzw[..., :3]
-        xyz = xyz / (self.num_bins - 1)
-        ego_xyz_max = torch.tensor(self.ego_xyz_max, dtype=xyz.dtype, device=xyz.device)
-        ego_xyz_min = torch.tensor(self.ego_xyz_min, dtype=xyz.dtype, device=xyz.device)
-        xyz = xyz * (ego_xyz_max - ego_xyz_min) + ego_xyz_min
+        xyz = self._dequantize_xyz(xyzw[..., :3])
         fut_xyz = torch.cumsum(xyz, dim=1)
         if not self._predict_yaw:
-            xyz_cpu = fut_xyz.cpu().numpy().astype(float)
-            fut_rot = get_yaw_rotation_matrices(xyz_cpu)
-            fut_rot = torch.tensor(fut_rot, device=fut_xyz.device, dtype=fut_xyz.dtype)
+            fut_rot = get_yaw_rotation_matrices_torch(fut_xyz).to(fut_xyz.dtype)
             return fut_xyz, fut_rot, None
         yaw_tokens = xyzw[..., 3]
         yaw = yaw_tokens.float() / (self.num_bins - 1)
@@ -154,63 +170,83 @@ class DeltaTrajectoryTokenizer:
         return fut_xyz, fut_rot, None
 
 
-def get_yaw_rotation_matrices(trajectory, window_size=10, poly_order=3):
-    """Calculate yaw rotation matrices using polynomial fitting for both x(t) and y(t)
+@functools.lru_cache(maxsize=16)
+def _yaw_derivative_weights(
+    N: int,
+    window_size: int,
+    poly_order: int,
+    device: torch.device,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Linear weights of the sliding-window polynomial derivatives of a sequence of length N.
+
+    The derivative of the least-squares polynomial fitted to the window of point i, evaluated at
+    point i, is a linear function of the points in the window. Row i of the returned matrix holds
+    its weights, so that the derivatives of a sequence x of length N are `weights @ x`.
 
     Args:
-        trajectory: np.array of shape (B, N, 3) for batch of x,y,z coordinates
+        N: length of the sequence
         window_size: size of window for polynomial fitting
         poly_order: order of polynomial to fit
+        device: device of the weights
+        dtype: dtype of the weights, they are computed in float64
 
     Returns:
-        rotation_matrices: rotation matrices at each point, shape (B, N, 3, 3)
+        weights: tensor of shape (N, N)
     """
-    B, N = trajectory.shape[:2]
-    rotation_matrices = []
-
-    for b in range(B):
-        traj_batch = trajectory[b]  # (N, 3)
-        batch_matrices = []
-        batch_yaws = []
-
-        for i in range(N):
-            # Get window indices with padding for edges
-            start_idx = max(0, i - window_size // 2)
-            end_idx = min(N, start_idx + window_size)
-
-            # Adjust window if at edges
-            if end_idx - start_idx < window_size:
-                start_idx = max(0, end_idx - window_size)
-
-            # Get points in window
-            window_points = traj_batch[start_idx:end_idx]
-
-            # Use time parameter t
-            t = np.arange(len(window_points))
-
-            # Fit polynomials to both x(t) and y(t)
-            x_coeffs = np.polyfit(t, window_points[:, 0], poly_order)
-            y_coeffs = np.polyfit(t, window_points[:, 1], poly_order)
+    weights = torch.zeros(N, N, dtype=torch.float64)
+    powers = torch.arange(poly_order + 1, dtype=torch.float64)
+    for i in range(N):
+        # same windows as in the original per-point fit, shifted inwards at the edges
+        start_idx = max(0, i - window_size // 2)
+        end_idx = min(N, start_idx + window_size)
+        if end_idx - start_idx < window_size:
+            start_idx = max(0, end_idx - window_size)
+        t = torch.arange(end_idx - start_idx, dtype=torch.float64)
+        center_t = min(i - start_idx, window_size - 1)
+
+        # coeffs = pinv(V) @ points, derivative = d/dt [1, t, t^2, ...] at center_t @ coeffs
+        vandermonde = t[:, None] ** powers
+        deriv = powers * float(center_t) ** (powers - 1).clamp(min=0)
+        weights[i, start_idx:end_idx] = deriv @ torch.linalg.pinv(vandermonde)
+    return weights.to(device=device, dtype=dtype)
+
+
+def get_yaw_rotation_matrices_torch(
+    trajectory: torch.Tensor, window_size: int = 10, poly_order: int = 3
+) -> torch.Tensor:
+    """Calculate yaw rotation matrices using polynomial fitting for both x(t) and y(t).
+
+    Batched torch version of `get_yaw_rotation_matrices` that stays on the device of the
+    trajectory: the polynomial fits of all the windows reduce to one precomputed linear map.
 
-            # Calculate derivatives at center point
-            center_t = min(i - start_idx, window_size - 1)
-            x_deriv = np.polyder(x_coeffs)
-            y_deriv = np.polyder(y_coeffs)
-
-            dx = np.polyval(x_deriv, center_t)
-            dy = np.polyval(y_deriv, center_t)
+    Args:
+        trajectory: tensor of shape (B, N, 3) for batch of x,y,z coordinates
+        window_size: size of window for polynomial fitting
+        poly_order: order of polynomial to fit
 
-            # Calculate yaw angle from dx, dy
-            yaw = np.arctan2(dy, dx)
-            batch_yaws.append(yaw)
+    Returns:
+        rotation_matrices: rotation matrices at each point, shape (B, N, 3, 3)
+    """
+    dtype = torch.promote_types(trajectory.dtype, torch.float32)
+    weights = _yaw_derivative_weights(
+        trajectory.shape[-2], window_size, poly_order, trajectory.device, dtype
+    )
+    dxy = weights @ trajectory[..., :2].to(dtype)  # (B, N, 2)
+    yaw = torch.atan2(dxy[..., 1], dxy[..., 0])
+    return rot_2d_to_3d(rotation_matrix_torch(yaw)).to(dtype)
 
-            # Create 3x3 rotation matrix for yaw
-            cos_yaw = np.cos(yaw)
-            sin_yaw = np.sin(yaw)
-            rotation_matrix = np.array([[cos_yaw, -sin_yaw, 0], [sin_yaw, cos_yaw, 0], [0, 0, 1]])
 
-            batch_matrices.append(rotation_matrix)
+def get_yaw_rotation_matrices(trajectory, window_size=10, poly_order=3):
+    """Calculate yaw rotation matrices using polynomial fitting for both x(t) and y(t)
 
-        rotation_matrices.append(batch_matrices)
+    Args:
+        trajectory: np.array of shape (B, N, 3) for batch of x,y,z coordinates
+        window_size: size of window for polynomial fitting
+        poly_order: order of polynomial to fit
 
-    return np.array(rotation_matrices)
+    Returns:
+        rotation_matrices: rotation matrices at each point, shape (B, N, 3, 3)
+    """
+    trajectory = torch.from_numpy(np.asarray(trajectory, dtype=np.float64))
+    return get_yaw_rotation_matrices_torch(trajectory, window_size, poly_order).numpy()
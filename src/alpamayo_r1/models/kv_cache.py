@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""KV caches whose prompt prefix is shared by several rollouts."""
+
+from typing import Any
+
+import torch
+from transformers.cache_utils import Cache, DynamicCache, DynamicLayer
+
+
+class SharedPrefixLayer(DynamicLayer):
+    """Dynamic cache layer whose leading segments are shared by groups of consecutive rows.
+
+    The layer keeps a list of shared segments, each of shape [b_k, num_heads, seq_len_k, head_dim]
+    where b_k divides the current batch size, followed by the per-row keys/values appended since
+    the last fork. Row i of the batch reads row i // (batch_size // b_k) of segment k, i.e. the
+    segments behave as if they were `repeat_interleave`-d along the batch dimension. They are only
+    expanded transiently when the layer is read, so forking a cache into many rollouts neither
+    copies the prefix nor keeps the copies alive.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.shared: list[tuple[torch.Tensor, torch.Tensor]] = []
+
+    @classmethod
+    def from_layer(cls, layer: DynamicLayer) -> "SharedPrefixLayer":
+        """Wrap the keys/values of an existing layer without copying them."""
+        shared_layer = cls()
+        if layer.is_initialized:
+            shared_layer.lazy_initialization(layer.keys)
+            shared_layer.keys, shared_layer.values = layer.keys, layer.values
+        return shared_layer
+
+    @property
+    def batch_size(self) -> int:
+        """The number of rows seen by the attention."""
+        return self.keys.shape[0]
+
+    def get_shared_length(self) -> int:
+        """Returns the number of tokens held by the shared segments."""
+        return sum(keys.shape[-2] for keys, _ in self.shared)
+
+    def get_seq_length(self) -> int:
+        """Returns the sequence length of the cached states."""
+        if not self.is_initialized:
+            return 0
+        return self.get_shared_length() + self.keys.shape[-2]
+
+    def _expand(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Broadcast a shared segment to the full batch as a view."""
+        repeats = self.batch_size // tensor.shape[0]
+        if repeats == 1:
+            return tensor
+        return tensor.unsqueeze(1).expand(-1, repeats, *tensor.shape[1:]).flatten(0, 1)
+
+    def materialize(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """Return the full [batch_size, num_heads, seq_len, head_dim] keys and values."""
+        if not self.shared:
+            return self.keys, self.values
+        keys = torch.cat([self._expand(k) for k, _ in self.shared] + [self.keys], dim=-2)
+        values = torch.cat([self._expand(v) for _, v in self.shared] + [self.values], dim=-2)
+        return keys, values
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        cache_kwargs: dict[str, Any] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Append the new states to the per-row keys/values and return the full states."""
+        if not self.is_initialized:
+            self.lazy_initialization(key_states)
+            self.keys = key_states[..., :0, :]
+            self.values = value_states[..., :0, :]
+        self.keys = torch.cat([self.keys, key_states], dim=-2)
+        self.values = torch.cat([self.values, value_states], dim=-2)
+        return self.materialize()
+
+    def fork(self, repeats: int) -> None:
+        """Share the current states across `repeats` consecutive copies of every row."""
+        if not self.is_initialized or repeats == 1:
+            return
+        if self.keys.shape[-2] > 0:
+            self.shared.append((self.keys, self.values))
+        self.keys = self.keys[..., :0, :].repeat_interleave(repeats, dim=0)
+        self.values = self.values[..., :0, :].repeat_interleave(repeats, dim=0)
+
+    def crop(self, max_length: int) -> None:
+        """Crop the cache to `max_length` tokens (negative values remove tokens from the end)."""
+        if max_length < 0:
+            max_length = self.get_seq_length() - abs(max_length)
+        if self.get_seq_length() <= max_length:
+            return
+        shared_length = self.get_shared_length()
+        if max_length >= shared_length:
+            self.keys = self.keys[..., : max_length - shared_length, :]
+            self.values = self.values[..., : max_length - shared_length, :]
+            return
+        # cropping into the shared prefix drops the per-row states altogether
+        shared, remaining = [], max_length
+        for keys, values in self.shared:
+            if remaining <= 0:
+                break
+            shared.append((keys[..., :remaining, :], values[..., :remaining, :]))
+            remaining -= keys.shape[-2]
+        self.shared = shared
+        self.keys = self.keys[..., :0, :]
+        self.values = self.values[..., :0, :]
+
+    def batch_repeat_interleave(self, repeats: int) -> None:
+        """Repeat the cache `repeats` times in the batch dimension without copying it."""
+        self.fork(repeats)
+
+    def batch_select_indices(self, indices: torch.Tensor) -> None:
+        """Only keep the `indices` in the batch dimension of the cache."""
+        if self.get_seq_length() > 0:
+            keys, values = self.materialize()
+            self.shared = []
+            self.keys = keys[indices, ...]
+            self.values = values[indices, ...]
+
+    def reorder_cache(self, beam_idx: torch.LongTensor) -> None:
+        """Reorders this layer's cache for beam search."""
+        self.batch_select_indices(beam_idx.to(self.keys.device))
+
+
+class SharedPrefixCache(DynamicCache):
+    """A `DynamicCache` made of `SharedPrefixLayer`s.
+
+    Example:
+        >>> cache = SharedPrefixCache()
+        >>> vlm(input_ids=prompt_ids, past_key_values=cache, use_cache=True)  # prefill B rows once
+        >>> cache.fork(num_samples)  # B * num_samples rows sharing the prompt
+    """
+
+    def __init__(self) -> None:
+        Cache.__init__(self, layer_class_to_replicate=SharedPrefixLayer)
+
+    @classmethod
+    def from_cache(cls, cache: DynamicCache) -> "SharedPrefixCache":
+        """Wrap the layers of an existing dynamic cache without copying their states."""
+        if isinstance(cache, cls):
+            return cache
+        shared_cache = cls()
+        shared_cache.layers = [SharedPrefixLayer.from_layer(layer) for layer in cache.layers]
+        return shared_cache
+
+    def fork(self, repeats: int) -> None:
+        """Share the current states across `repeats` consecutive copies of every row."""
+        for layer in self.layers:
+            layer.fork(repeats)
+
+
+class PaddedBatchCache(DynamicCache):
+    """A `DynamicCache` whose rows are left-padded to a common length and can join and leave.
+
+    Rows of different lengths are aligned on their last token by left-padding the shorter rows
+    with zero keys/values, which the attention mask of the batch must mask out. The caller keeps
+    the mask and the position offsets of the rows in sync with `append_rows` and `trim_left`,
+    and with `gather_tokens`, which drops masked-out tokens from the middle of the rows.
+
+    Example:
+        >>> cache = PaddedBatchCache()
+        >>> cache.append_rows(prompt_cache)  # prefilled prompts of new requests
+        >>> cache.batch_select_indices(running)  # drop the finished rows
+        >>> cache.trim_left(num_padding)  # drop the padding shared by all the remaining rows
+    """
+
+    def append_rows(self, cache: DynamicCache) -> tuple[int, int]:
+        """Append the rows of another cache, left-padding the shorter of the two caches.
+
+        Args:
+            cache: The cache of the new rows.
+
+        Returns:
+            The number of padding tokens added to the left of the current rows and of the new
+            rows, respectively.
+        """
+        if not self.layers:
+            self.layers = [DynamicLayer() for _ in cache.layers]
+        length, new_length = self.get_seq_length(), cache.get_seq_length()
+        padding, new_padding = max(new_length - length, 0), max(length - new_length, 0)
+        for layer, new_layer in zip(self.layers, cache.layers):
+            new_keys = _left_pad(new_layer.keys, new_padding)
+            new_values = _left_pad(new_layer.values, new_padding)
+            if not layer.is_initialized:
+                layer.lazy_initialization(new_keys)
+                layer.keys, layer.values = new_keys, new_values
+                continue
+            layer.keys = torch.cat([_left_pad(layer.keys, padding), new_keys])
+            layer.values = torch.cat([_left_pad(layer.values, padding), new_values])
+        return padding, new_padding
+
+    def trim_left(self, num_tokens: int) -> None:
+        """Drop the first `num_tokens` tokens of every row, e.g. padding shared by all rows."""
+        for layer in self.layers:
+            if layer.is_initialized:
+                layer.keys = layer.keys[..., num_tokens:, :]
+                layer.values = layer.values[..., num_tokens:, :]
+
+    def gather_tokens(self, indices: torch.Tensor) -> None:
+        """Only keep the tokens at `indices[i]` of every row i, in that order.
+
+        Args:
+            indices: The token indices of every row, of shape [batch_size, new_seq_len].
+        """
+        for layer in self.layers:
+            if layer.is_initialized:
+                index = indices[:, None, :, None].expand(
+                    -1, layer.keys.shape[1], -1, layer.keys.shape[-1]
+                )
+                layer.keys = layer.keys.gather(2, index.to(layer.keys.device))
+                layer.values = layer.values.gather(2, index.to(layer.values.device))
+
+    def select_rows(self, indices: torch.Tensor) -> DynamicCache:
+        """Returns a `DynamicCache` with the rows at `indices`, leaving this cache unchanged."""
+        rows = DynamicCache()
+        rows.layers = []
+        for layer in self.layers:
+            row_layer = DynamicLayer()
+            row_layer.lazy_initialization(layer.keys)
+            row_layer.keys, row_layer.values = layer.keys[indices], layer.values[indices]
+            rows.layers.append(row_layer)
+        return rows
+
+
+def _left_pad(states: torch.Tensor, num_tokens: int) -> torch.Tensor:
+    """Left-pad [batch_size, num_heads, seq_len, head_dim] states with zeros along seq_len."""
+    if num_tokens == 0:
+        return states
+    return torch.nn.functional.pad(states, (0, 0, num_tokens, 0))
@@ -0,0 +1,154 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Two-stage pipeline overlapping the VLM and diffusion stages of consecutive rollouts."""
+
+import collections
+import contextlib
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import torch
+from alpamayo_r1.models.alpamayo_r1 import AlpamayoR1, RolloutHandoff
+
+
+class RolloutPipeline:
+    """Runs the diffusion stage of a batch while the VLM stage of the next batch decodes.
+
+    `sample_trajectories_from_data_with_vlm_rollout` runs the prefill, the reasoning decoding and
+    the expert denoising of a batch back to back. The decoding is bound by memory bandwidth and
+    kernel launches, the denoising by compute, so the two can share the GPU. Here the VLM stage
+    (`rollout_vlm`) runs on the calling thread and on its own CUDA stream, and the diffusion stage
+    (`sample_trajectories_from_handoff`) on a worker thread and on a second stream.
+
+    The handoff of a batch (KV cache, prefix mask and diffusion positions) is passed with a CUDA
+    event recorded after its VLM stage, so the expert stream only waits for that batch. Its tensors
+    are recorded on the expert stream, so that the caching allocator does not hand them to the next
+    VLM stage while the expert reads them.
+
+    The sampling of both stages draws from the same random generator, so with overlapping stages
+    the samples are not reproducible from a seed, unlike the sequential rollout.
+
+    `capture_mode="cuda_graph"` is not supported on CUDA: capturing the denoising step of a new
+    bucket on the worker thread would overlap the allocations and synchronizations of the VLM
+    stage, which are not allowed during a capture. `capture_mode="compile"` can be used instead.
+
+    Example:
+        >>> pipeline = RolloutPipeline(model, num_traj_samples=1, return_extra=True)
+        >>> for pred_xyz, pred_rot, extra in pipeline.run(batches):
+        ...     ...
+    """
+
+    def __init__(self, model: AlpamayoR1, max_pending: int = 1, **rollout_kwargs: Any):
+        """Initialize the RolloutPipeline.
+
+        Args:
+            model: The AlpamayoR1 model.
+            max_pending: The maximum number of batches in the diffusion stage, or waiting for it,
+                while the VLM stage of the next batch runs. Every pending batch keeps its KV cache.
+            **rollout_kwargs: Keyword arguments of `sample_trajectories_from_data_with_vlm_rollout`,
+                e.g. `top_p`, `num_traj_samples`, `num_traj_sets` or `return_extra`.
+        """
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be positive, got {max_pending}")
+        self.device = model.device
+        if self.device.type == "cuda" and rollout_kwargs.get("capture_mode") == "cuda_graph":
+            raise ValueError(
+                "capture_mode='cuda_graph' is not supported by RolloutPipeline: the CUDA graphs "
+                "would be captured while the VLM stage runs on another thread, use "
+                "capture_mode='compile' instead"
+            )
+        self.model = model
+        self.max_pending = max_pending
+        self.rollout_kwargs = rollout_kwargs
+        if self.device.type == "cuda":
+            self.vlm_stream = torch.cuda.Stream(self.device)
+            self.expert_stream = torch.cuda.Stream(self.device)
+        else:
+            self.vlm_stream = self.expert_stream = None
+
+    def _stream(self, stream: torch.cuda.Stream | None) -> contextlib.AbstractContextManager:
+        return torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+
+    def run(self, batches: Iterable[dict[str, Any]]) -> Iterator[Any]:
+        """Roll out the batches, overlapping the stages of consecutive batches.
+
+        Args:
+            batches: The model inputs of every batch, on the device of the model, see
+                `sample_trajectories_from_data_with_vlm_rollout`.
+
+        Yields:
+            The outputs of `sample_trajectories_from_data_with_vlm_rollout` for every batch, in
+            order, usable on the stream that was current when calling `run`.
+        """
+        # the grad mode and autocast state are thread-local, they are forwarded to the worker
+        autocast_enabled = torch.is_autocast_enabled(self.device.type)
+        autocast_dtype = torch.get_autocast_dtype(self.device.type)
+        pending: collections.deque[Future] = collections.deque()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="expert") as executor:
+            for data in batches:
+                if self.vlm_stream is not None:
+                    self.vlm_stream.wait_stream(torch.cuda.current_stream(self.device))
+                with self._stream(self.vlm_stream):
+                    handoff = self.model.rollout_vlm(data, **self.rollout_kwargs)
+                    ready = self.vlm_stream.record_event() if self.vlm_stream is not None else None
+                pending.append(
+                    executor.submit(
+                        self._diffusion_stage,
+                        handoff,
+                        ready,
+                        torch.is_grad_enabled(),
+                        autocast_enabled,
+                        autocast_dtype,
+                    )
+                )
+                del handoff
+                while len(pending) > self.max_pending:
+                    yield self._result(pending.popleft())
+            while pending:
+                yield self._result(pending.popleft())
+
+    def _diffusion_stage(
+        self,
+        handoff: RolloutHandoff,
+        ready: torch.cuda.Event | None,
+        grad_enabled: bool,
+        autocast_enabled: bool,
+        autocast_dtype: torch.dtype,
+    ) -> tuple[Any, torch.cuda.Event | None]:
+        """Run the diffusion stage of a batch on the expert stream, on the worker thread."""
+        with (
+            torch.set_grad_enabled(grad_enabled),
+            torch.autocast(self.device.type, dtype=autocast_dtype, enabled=autocast_enabled),
+            self._stream(self.expert_stream),
+        ):
+            if self.expert_stream is not None:
+                self.expert_stream.wait_event(ready)
+                for tensor in handoff.tensors():
+                    tensor.record_stream(self.expert_stream)
+            outputs = self.model.sample_trajectories_from_handoff(handoff, **self.rollout_kwargs)
+            done = self.expert_stream.record_event() if self.expert_stream is not None else None
+        return outputs, done
+
+    def _result(self, future: Future) -> Any:
+        """Wait for the diffusion stage of a batch and hand its outputs to the current stream."""
+        outputs, done = future.result()
+        if done is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(done)
+            for tensor in outputs[:2]:
+                tensor.record_stream(stream)
+        return outputs
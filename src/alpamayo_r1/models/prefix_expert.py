@@ -0,0 +1,281 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Expert forward pass over a read-only prefix KV cache."""
+
+import torch
+import torch.nn.functional as F
+from transformers.cache_utils import Cache
+from transformers.models.qwen3_vl.modeling_qwen3_vl import apply_rotary_pos_emb
+
+from alpamayo_r1.models.kv_cache import SharedPrefixLayer
+
+
+class PrefixMask:
+    """Valid prefix keys of every row, stored compactly as one [start, end) range per row.
+
+    Batched prompts are left-padded and the generated tokens after <traj_future_start> are
+    dropped, so the keys a row attends to in the prefix are contiguous. The dense mask is built
+    on device with a single broadcasted comparison, once per `PrefixCachedExpert.load`.
+    """
+
+    def __init__(self, start: torch.Tensor, end: torch.Tensor, length: int):
+        """Initialize the PrefixMask.
+
+        Args:
+            start: The first valid key of each row, of shape (B,).
+            end: One past the last valid key of each row, of shape (B,). It is clamped to
+                `length`, e.g. for the rows without <traj_future_start> whose last generated
+                token is not in the cache.
+            length: The prefix length.
+        """
+        self.start = start
+        self.end = end.clamp(max=length)
+        self.length = length
+
+    def to_bool(self) -> torch.Tensor:
+        """Returns the mask as a bool tensor of shape (B, length), True for the valid keys."""
+        key_idx = torch.arange(self.length, device=self.start.device)
+        return (key_idx >= self.start[:, None]) & (key_idx < self.end[:, None])
+
+
+class PrefixCachedExpert:
+    """Runs the expert on a fixed number of tokens attending to a prefilled prompt cache.
+
+    The denoising loop calls the expert many times with the same prefix, positions and mask, and
+    only the action token embeddings change. Instead of appending the action tokens to the cache
+    and cropping them again on every call, the prefix keys/values of every layer are laid out
+    once in a buffer followed by a scratch region for the action tokens, which is overwritten in
+    place on every call. Rotary embeddings and the attention mask are computed once as well.
+
+    The cache holds one row per prompt, and the `num_groups` consecutive rows of the expert batch
+    that share a prompt (e.g. the trajectory sets of a reasoning trace) are stacked along the
+    sequence dimension of that prompt's row, each group only attending to the prefix and to its
+    own action tokens. The prefix is therefore never repeated across the groups.
+
+    Buffers are allocated for a given capacity and can be reloaded with other prompts that fit
+    in it, e.g. to reuse the buffers of a captured denoising step across rollouts. Rows and
+    prefix positions beyond the loaded prompts are masked out.
+
+    Example:
+        >>> prefix_mask = PrefixMask(prompt_start, traj_future_start + 1, prefix_len)
+        >>> expert_fn = PrefixCachedExpert.from_cache(expert, cache, prefix_mask, position_ids)
+        >>> last_hidden = expert_fn(future_token_embeds)  # (b*, n_tokens, hidden_size)
+    """
+
+    def __init__(
+        self,
+        expert: torch.nn.Module,
+        batch_size: int,
+        prefix_len: int,
+        n_tokens: int,
+        num_groups: int = 1,
+        is_causal: bool = False,
+    ):
+        """Initialize the PrefixCachedExpert.
+
+        Args:
+            expert: The expert text model, a `Qwen3VLTextModel`.
+            batch_size: The maximum number of prompt rows.
+            prefix_len: The maximum prefix length.
+            n_tokens: The number of expert tokens of each row.
+            num_groups: The number of consecutive expert rows that share a prompt row.
+            is_causal: Whether the expert tokens attend causally to each other.
+        """
+        self.expert = expert
+        self.batch_size = batch_size
+        self.prefix_len = prefix_len
+        self.n_tokens = n_tokens
+        self.num_groups = num_groups
+        scratch_len = num_groups * n_tokens
+
+        attn = expert.layers[0].self_attn
+        self.head_dim = attn.head_dim
+        self.num_kv_heads = expert.config.num_key_value_heads
+        self.num_kv_groups = attn.num_key_value_groups
+        self.scaling = attn.scaling
+
+        # [B, num_kv_heads, prefix_len + scratch_len, head_dim] per layer, zero-initialized since
+        # masked keys still enter the attention matmul
+        buffer_kwargs = {"dtype": expert.dtype, "device": expert.device}
+        buffer_shape = (batch_size, self.num_kv_heads, prefix_len + scratch_len, self.head_dim)
+        self.keys = [torch.zeros(buffer_shape, **buffer_kwargs) for _ in expert.layers]
+        self.values = [torch.zeros(buffer_shape, **buffer_kwargs) for _ in expert.layers]
+
+        # every group attends to the valid prefix and to its own block of the scratch region
+        group_ids = torch.arange(num_groups, device=expert.device).repeat_interleave(n_tokens)
+        self.scratch_mask = group_ids[:, None] == group_ids[None, :]
+        if is_causal:
+            self.scratch_mask &= torch.ones_like(self.scratch_mask).tril()
+        # the query heads sharing a kv head are folded into the query length, see `_attend`
+        self.attention_mask = torch.zeros(
+            (batch_size, 1, self.num_kv_groups * scratch_len, prefix_len + scratch_len),
+            dtype=torch.bool,
+            device=expert.device,
+        )
+        self.position_embeddings = (
+            torch.zeros((batch_size, scratch_len, self.head_dim), **buffer_kwargs),
+            torch.zeros((batch_size, scratch_len, self.head_dim), **buffer_kwargs),
+        )
+
+    @classmethod
+    def from_cache(
+        cls,
+        expert: torch.nn.Module,
+        prefix_cache: Cache,
+        prefix_mask: PrefixMask,
+        position_ids: torch.Tensor,
+        num_groups: int = 1,
+        is_causal: bool = False,
+    ) -> "PrefixCachedExpert":
+        """Create a PrefixCachedExpert sized for and loaded with the given prompts.
+
+        Args:
+            expert: The expert text model, a `Qwen3VLTextModel`.
+            prefix_cache: See `load`.
+            prefix_mask: See `load`.
+            position_ids: See `load`.
+            num_groups: The number of consecutive expert rows that share a prompt row.
+            is_causal: Whether the expert tokens attend causally to each other.
+        """
+        expert_fn = cls(
+            expert,
+            batch_size=prefix_mask.start.shape[0],
+            prefix_len=prefix_mask.length,
+            n_tokens=position_ids.shape[-1],
+            num_groups=num_groups,
+            is_causal=is_causal,
+        )
+        expert_fn.load(prefix_cache, prefix_mask, position_ids)
+        return expert_fn
+
+    def load(
+        self, prefix_cache: Cache, prefix_mask: PrefixMask, position_ids: torch.Tensor
+    ) -> None:
+        """Copy the prompts into the buffers.
+
+        Args:
+            prefix_cache: The prompt cache, of shape (B, num_kv_heads, prefix_len, head_dim) in
+                every layer. It is only read.
+            prefix_mask: The valid prefix keys of each row.
+            position_ids: The positions of the expert tokens of each row, of shape (3, B, n_tokens).
+        """
+        batch_size, prefix_len = prefix_mask.start.shape[0], prefix_mask.length
+        assert batch_size <= self.batch_size and prefix_len <= self.prefix_len, (
+            f"{batch_size=}, {prefix_len=} exceed ({self.batch_size}, {self.prefix_len})"
+        )
+        assert position_ids.shape[-1] == self.n_tokens, f"{position_ids.shape=}"
+        for layer, key_buffer, value_buffer in zip(prefix_cache.layers, self.keys, self.values):
+            if isinstance(layer, SharedPrefixLayer):
+                keys, values = layer.materialize()
+            else:
+                keys, values = layer.keys, layer.values
+            assert keys.shape[0] == batch_size and keys.shape[-2] == prefix_len, (
+                f"{keys.shape=}, expected ({batch_size}, *, {prefix_len}, *)"
+            )
+            key_buffer[:batch_size, :, :prefix_len].copy_(keys)
+            value_buffer[:batch_size, :, :prefix_len].copy_(values)
+
+        prefix_valid = torch.zeros(
+            (self.batch_size, self.prefix_len), dtype=torch.bool, device=self.scratch_mask.device
+        )
+        prefix_valid[:batch_size, :prefix_len] = prefix_mask.to_bool()
+        scratch_len = self.scratch_mask.shape[0]
+        attention_mask = torch.cat(
+            [
+                prefix_valid[:, None, :].expand(-1, scratch_len, -1),
+                self.scratch_mask[None].expand(self.batch_size, -1, -1),
+            ],
+            dim=-1,
+        )
+        self.attention_mask.copy_(attention_mask[:, None].repeat(1, 1, self.num_kv_groups, 1))
+
+        cos, sin = self.expert.rotary_emb(
+            self.keys[0].new_empty(0), position_ids.repeat(1, 1, self.num_groups)
+        )
+        self.position_embeddings[0][:batch_size].copy_(cos)
+        self.position_embeddings[1][:batch_size].copy_(sin)
+
+    def _attend(
+        self, query_states: torch.Tensor, keys: torch.Tensor, values: torch.Tensor
+    ) -> torch.Tensor:
+        """Grouped-query attention without repeating the keys/values for every query head.
+
+        Args:
+            query_states: The queries of shape (B, L, num_heads, head_dim).
+            keys: The keys of shape (B, num_kv_heads, S, head_dim).
+            values: The values of shape (B, num_kv_heads, S, head_dim).
+
+        Returns:
+            The attention output of shape (B, L, num_heads * head_dim).
+        """
+        b, q_len = query_states.shape[:2]
+        query_states = query_states.view(
+            b, q_len, self.num_kv_heads, self.num_kv_groups, self.head_dim
+        ).permute(0, 2, 3, 1, 4)
+        attn_output = F.scaled_dot_product_attention(
+            query_states.reshape(b, self.num_kv_heads, self.num_kv_groups * q_len, self.head_dim),
+            keys,
+            values,
+            attn_mask=self.attention_mask,
+            scale=self.scaling,
+        )
+        attn_output = attn_output.view(
+            b, self.num_kv_heads, self.num_kv_groups, q_len, self.head_dim
+        ).permute(0, 3, 1, 2, 4)
+        return attn_output.reshape(b, q_len, -1)
+
+    def __call__(self, inputs_embeds: torch.Tensor) -> torch.Tensor:
+        """Run the expert.
+
+        Args:
+            inputs_embeds: The expert token embeddings, of shape
+                (B * num_groups, n_tokens, hidden_size).
+
+        Returns:
+            The last hidden states of shape (B * num_groups, n_tokens, hidden_size).
+        """
+        b_star = inputs_embeds.shape[0]
+        assert b_star == self.batch_size * self.num_groups, (
+            f"{b_star=}, expected {self.batch_size * self.num_groups}"
+        )
+        hidden_states = inputs_embeds.reshape(self.batch_size, self.num_groups * self.n_tokens, -1)
+        cos, sin = self.position_embeddings
+        hidden_shape = (*hidden_states.shape[:-1], -1, self.head_dim)
+        for layer, keys, values in zip(self.expert.layers, self.keys, self.values):
+            attn = layer.self_attn
+            residual = hidden_states
+            hidden_states = layer.input_layernorm(hidden_states)
+
+            query_states = attn.q_norm(attn.q_proj(hidden_states).view(hidden_shape))
+            key_states = attn.k_norm(attn.k_proj(hidden_states).view(hidden_shape))
+            value_states = attn.v_proj(hidden_states).view(hidden_shape)
+            # rotary embeddings are applied on (B, L, heads, head_dim) with unsqueeze_dim=2
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states, key_states, cos, sin, unsqueeze_dim=2
+            )
+            keys[..., self.prefix_len :, :].copy_(key_states.transpose(1, 2))
+            values[..., self.prefix_len :, :].copy_(value_states.transpose(1, 2))
+
+            hidden_states = attn.o_proj(self._attend(query_states, keys, values))
+            hidden_states = residual + hidden_states
+
+            residual = hidden_states
+            hidden_states = layer.post_attention_layernorm(hidden_states)
+            hidden_states = layer.mlp(hidden_states)
+            hidden_states = residual + hidden_states
+
+        hidden_states = self.expert.norm(hidden_states)
+        return hidden_states.view(b_star, self.n_tokens, -1)
@@ -0,0 +1,165 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""N-gram drafter proposing the reasoning tokens verified by speculative decoding."""
+
+from collections.abc import Iterable
+from typing import Any
+
+import yaml
+
+
+class NGramDrafter:
+    """Proposes draft tokens by looking up the last n-gram of a reasoning trace.
+
+    Chain-of-causation traces are templated: they reuse the phrases of the closed set of driving
+    decisions and repeat their own words, e.g. the meta action restates the reasoning. The last
+    `max_ngram_size` tokens of a trace (then shorter suffixes) are looked up first in the trace
+    itself, as prompt-lookup decoding does, and then in a corpus of tokenized phrases, down to
+    `min_ngram_size` tokens. The tokens that followed the match are proposed as the draft, which
+    the VLM verifies in one forward pass.
+
+    `start` resets the traces of a rollout; `num_proposed`/`num_accepted` count the draft tokens
+    across rollouts.
+
+    Example:
+        >>> drafter = NGramDrafter.from_yaml(
+        ...     model.tokenizer, "scenario_framework/driving_decisions.yaml"
+        ... )
+        >>> model.sample_trajectories_from_data_with_vlm_rollout(data, drafter=drafter)
+        >>> drafter.acceptance_rate
+    """
+
+    def __init__(
+        self,
+        phrases: Iterable[list[int]] = (),
+        num_draft_tokens: int = 8,
+        max_ngram_size: int = 3,
+        min_ngram_size: int = 2,
+    ):
+        """Initialize the NGramDrafter.
+
+        Args:
+            phrases: The token IDs of the corpus phrases.
+            num_draft_tokens: The maximum number of tokens proposed per decoding step.
+            max_ngram_size: The length of the longest suffix looked up.
+            min_ngram_size: The length of the shortest suffix looked up, shorter suffixes match
+                too often to predict the next tokens.
+        """
+        if num_draft_tokens < 1 or not 1 <= min_ngram_size <= max_ngram_size:
+            raise ValueError(
+                f"num_draft_tokens must be positive and 1 <= min_ngram_size <= max_ngram_size, got "
+                f"{num_draft_tokens}, {min_ngram_size} and {max_ngram_size}"
+            )
+        self.num_draft_tokens = num_draft_tokens
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+        # n-gram -> the tokens following its first occurrence in the corpus
+        self._corpus: dict[tuple[int, ...], tuple[int, ...]] = {}
+        for phrase in phrases:
+            for end in range(1, len(phrase)):
+                for n in range(min_ngram_size, min(max_ngram_size, end) + 1):
+                    self._corpus.setdefault(
+                        tuple(phrase[end - n : end]), tuple(phrase[end : end + num_draft_tokens])
+                    )
+        self._traces: list[list[int]] = []
+        # per trace: n-gram -> the index following its last occurrence, excluding the suffix
+        self._positions: list[dict[tuple[int, ...], int]] = []
+        self.num_proposed = 0
+        self.num_accepted = 0
+
+    @classmethod
+    def from_yaml(cls, tokenizer: Any, path: str, **kwargs: Any) -> "NGramDrafter":
+        """Build the corpus from the strings of a YAML file, e.g. the closed set of decisions.
+
+        Every string of the file except its `metadata` is tokenized as is and after a space, as
+        it reads at the start of a trace and within a sentence.
+
+        Args:
+            tokenizer: The tokenizer of the VLM.
+            path: The path of the YAML file, e.g. `scenario_framework/driving_decisions.yaml`.
+            **kwargs: Keyword arguments of `NGramDrafter`.
+
+        Returns:
+            The drafter.
+        """
+        with open(path, encoding="utf-8") as f:
+            content = yaml.safe_load(f)
+        if isinstance(content, dict):
+            content.pop("metadata", None)
+        texts = sorted(set(_strings(content)))
+        phrases = [
+            tokenizer.encode(prefix + text, add_special_tokens=False)
+            for text in texts
+            for prefix in ("", " ")
+        ]
+        return cls(phrases, **kwargs)
+
+    @property
+    def acceptance_rate(self) -> float:
+        """The fraction of the proposed draft tokens accepted by the VLM."""
+        return self.num_accepted / self.num_proposed if self.num_proposed else 0.0
+
+    def start(self, num_traces: int) -> None:
+        """Start drafting for new reasoning traces, e.g. the rows of a rollout."""
+        self._traces = [[] for _ in range(num_traces)]
+        self._positions = [{} for _ in range(num_traces)]
+
+    def extend(self, trace: int, tokens: list[int]) -> None:
+        """Append the generated (accepted or sampled) tokens of a trace."""
+        tokens_so_far, positions = self._traces[trace], self._positions[trace]
+        for token in tokens:
+            # the n-grams ending at the previous token get a known continuation
+            end = len(tokens_so_far)
+            for n in range(self.min_ngram_size, min(self.max_ngram_size, end) + 1):
+                positions[tuple(tokens_so_far[end - n : end])] = end
+            tokens_so_far.append(token)
+
+    def propose(self, trace: int, max_tokens: int) -> list[int]:
+        """Propose the tokens following a trace.
+
+        Args:
+            trace: The index of the trace.
+            max_tokens: The maximum number of proposed tokens, capped by `num_draft_tokens`.
+
+        Returns:
+            The draft tokens, possibly none.
+        """
+        max_tokens = min(max_tokens, self.num_draft_tokens)
+        tokens, positions = self._traces[trace], self._positions[trace]
+        if max_tokens <= 0 or not tokens:
+            return []
+        for n in range(min(self.max_ngram_size, len(tokens)), self.min_ngram_size - 1, -1):
+            suffix = tuple(tokens[-n:])
+            position = positions.get(suffix)
+            if position is not None:
+                draft = tokens[position : position + max_tokens]
+            else:
+                draft = list(self._corpus.get(suffix, ())[:max_tokens])
+            if draft:
+                return draft
+        return []
+
+
+def _strings(content: Any) -> Iterable[str]:
+    """Yield the strings nested in parsed YAML content."""
+    if isinstance(content, str):
+        yield content
+    elif isinstance(content, dict):
+        for value in content.values():
+            yield from _strings(value)
+    elif isinstance(content, list):
+        for value in content:
+            yield from _strings(value)
@@ -20,6 +20,9 @@ from transformers import AutoTokenizer, StoppingCriteria
 
 logger = logging.getLogger(__name__)
 
+# the texts between <|{token}_start|> and <|{token}_end|> returned by `extract_text_tokens`
+TEXT_TOKENS = ("cot", "meta_action", "answer")
+
 
 def to_special_token(token: str) -> str:
     """Convert a token to a special token."""
@@ -162,9 +165,8 @@ def extract_text_tokens(
     # decode the batch of tokens into strings
     decoded_batch = tokenizer.batch_decode(output_tokens, skip_special_tokens=False)
 
-    extract_tokens = ["cot", "meta_action", "answer"]
     extracted_text = {}
-    for token in extract_tokens:
+    for token in TEXT_TOKENS:
         extracted_text[token] = extract_between_special_tokens(decoded_batch, token)
     return extracted_text
 
@@ -191,22 +193,45 @@ class StopAfterEOS(StoppingCriteria):
         Returns:
             bool: Whether to stop the generation.
         """
-        batch_size = input_ids.shape[0]
+        return bool(self.update(input_ids).all())
+
+    def update(self, input_ids: torch.LongTensor) -> torch.Tensor:
+        """Track the EOS tokens among the last generated tokens.
+
+        Args:
+            input_ids (torch.LongTensor): The input IDs of shape [B, L].
 
+        Returns:
+            torch.Tensor: [B] bool, the sequences whose EOS token was generated before the last
+                token, i.e. whose EOS token is in the KV cache.
+        """
         # Initialize tracking on first call
         if self.eos_found is None:
-            self.eos_found = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+            self.eos_found = torch.zeros(
+                input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+            )
+        finished = self.eos_found
 
-        if self.eos_found.all():
-            return True
+        # Update which sequences just found EOS
+        self.eos_found = self.eos_found | (input_ids[:, -1] == self.eos_token_id)
+        return finished
 
-        # Check which sequences have EOS in the last generated token
-        last_tokens = input_ids[:, -1]
-        current_has_eos = last_tokens == self.eos_token_id
+    def add_rows(self, input_ids: torch.LongTensor) -> None:
+        """Start tracking new sequences, e.g. joining a running batch.
 
-        # Update which sequences just found EOS
-        self.eos_found = self.eos_found | current_has_eos
-        return False
+        Args:
+            input_ids (torch.LongTensor): The first generated tokens of the new sequences, of
+                shape [B_new, L].
+        """
+        eos_found = input_ids[:, -1] == self.eos_token_id
+        if self.eos_found is not None:
+            eos_found = torch.cat([self.eos_found, eos_found])
+        self.eos_found = eos_found
+
+    def batch_select_indices(self, indices: torch.Tensor) -> None:
+        """Only keep tracking the sequences at `indices`, e.g. after the others retired."""
+        if self.eos_found is not None:
+            self.eos_found = self.eos_found[indices]
 
 
 def replace_padding_after_eos(
@@ -0,0 +1,553 @@
+# SPDX-FileCopyrightText: Copyright (c) 2025 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived local inference server that keeps the model resident and batches requests.
+
+Start it with `python -m alpamayo_r1.server --model-path /data/models/Alpamayo-R1-10B` and send
+requests with `predict`:
+
+    >>> data = load_physical_aiavdataset(clip_id)
+    >>> result = predict("http://127.0.0.1:8000", data)
+    >>> result["pred_xyz"].shape  # (num_traj_sets, num_traj_samples, num_future_steps, 3)
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import numpy as np
+import torch
+from alpamayo_r1 import helper
+from alpamayo_r1.image_processor import TensorImageProcessor
+from alpamayo_r1.load_physical_aiavdataset import load_physical_aiavdataset
+from alpamayo_r1.models.alpamayo_r1 import AlpamayoR1
+from alpamayo_r1.models.continuous_batching import ContinuousBatchScheduler
+
+logger = logging.getLogger(__name__)
+
+# the entries of a sample sent to the server, see `load_physical_aiavdataset`
+SAMPLE_KEYS = ("image_frames", "ego_history_xyz", "ego_history_rot")
+
+
+def encode_array(array: np.ndarray | torch.Tensor) -> str:
+    """Serialize an array as base64-encoded `.npy` bytes."""
+    if isinstance(array, torch.Tensor):
+        array = array.cpu().numpy()
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def decode_array(data: str) -> np.ndarray:
+    """Deserialize an array serialized with `encode_array`."""
+    return np.load(io.BytesIO(base64.b64decode(data)), allow_pickle=False)
+
+
+def validate_sample(sample: dict[str, torch.Tensor]) -> None:
+    """Check the shapes and dtypes of the `SAMPLE_KEYS` entries of a sample.
+
+    Raises:
+        ValueError: If an entry does not have the layout of `load_physical_aiavdataset`.
+    """
+    frames, xyz, rot = (sample[key] for key in SAMPLE_KEYS)
+    if frames.dtype != torch.uint8 or frames.ndim != 5 or frames.shape[2] != 3:
+        raise ValueError(
+            f"image_frames must be uint8 of shape (N_cameras, num_frames, 3, H, W), got "
+            f"{frames.dtype} of shape {tuple(frames.shape)}"
+        )
+    if not xyz.is_floating_point() or xyz.ndim != 4 or xyz.shape[:2] != (1, 1) or xyz.shape[3] != 3:
+        raise ValueError(
+            f"ego_history_xyz must be floating point of shape (1, 1, num_history_steps, 3), got "
+            f"{xyz.dtype} of shape {tuple(xyz.shape)}"
+        )
+    if not rot.is_floating_point() or rot.shape != (*xyz.shape, 3):
+        raise ValueError(
+            f"ego_history_rot must be floating point of shape {(*xyz.shape, 3)}, got {rot.dtype} "
+            f"of shape {tuple(rot.shape)}"
+        )
+
+
+class DynamicBatcher:
+    """Accumulates the submitted samples into batches and runs one rollout per batch.
+
+    A batch is closed when it holds `max_batch_size` samples or when its first sample has waited
+    `max_wait_ms`, so that a lone request is delayed by at most `max_wait_ms` while concurrent
+    requests share the prefill and decoding steps of one rollout. The rollouts run on a single
+    background thread, in the order of arrival. If the rollout of a batch fails, e.g. because its
+    samples cannot be batched together, its samples are rolled out one at a time, so that only
+    the faulty samples fail.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        processor: Any,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20.0,
+        device: str | torch.device = "cuda",
+        image_processor: TensorImageProcessor | None = None,
+        **sampling_kwargs: Any,
+    ):
+        """Initialize the DynamicBatcher.
+
+        Args:
+            model: The AlpamayoR1 model, on `device`.
+            processor: The processor returned by `helper.get_processor`.
+            max_batch_size: The maximum number of samples per rollout.
+            max_wait_ms: The maximum time a sample waits for other samples to join its batch.
+            device: The device of the model.
+            image_processor: Optional `TensorImageProcessor` preprocessing the frames on `device`.
+            **sampling_kwargs: Keyword arguments of the rollout, e.g. `top_p`, `temperature`,
+                `num_traj_samples` or `max_generation_length`.
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        self.model = model
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.device = torch.device(device)
+        self.image_processor = image_processor
+        self.sampling_kwargs = sampling_kwargs
+        self.num_batches = 0
+        self.num_samples = 0
+        # (enqueue time, sample, future), None stops the worker
+        self._queue: queue.Queue[tuple[float, dict[str, Any], Future] | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Start the rollout thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the rollout thread after the samples already submitted."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, sample: dict[str, Any]) -> Future:
+        """Submit a sample for the next batch.
+
+        Args:
+            sample: A dict with the `image_frames`, `ego_history_xyz` and `ego_history_rot`
+                entries of `load_physical_aiavdataset`.
+
+        Returns:
+            A future of the prediction dict, see `_run_batch`.
+        """
+        future = Future()
+        self._queue.put((time.monotonic(), sample, future))
+        return future
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the number of rollouts and of samples processed, and the queue length."""
+        return {
+            "batches": self.num_batches,
+            "samples": self.num_samples,
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_s * 1000,
+        }
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[0] + self.max_wait_s
+            while len(batch) < self.max_batch_size:
+                timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list[tuple[float, dict[str, Any], Future]]) -> None:
+        """Run one rollout over the batch and resolve the futures of its samples.
+
+        Every future resolves to a dict with:
+            - pred_xyz: np.ndarray of shape (num_traj_sets, num_traj_samples, T, 3)
+            - pred_rot: np.ndarray of shape (num_traj_sets, num_traj_samples, T, 3, 3)
+            - cot: the chain-of-causation texts, of shape (num_traj_sets, num_traj_samples)
+        """
+        # skip the samples whose requests were cancelled while queued
+        batch = [(s, future) for _, s, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        samples, futures = zip(*batch)
+        try:
+            results = self._rollout(list(samples))
+        except Exception as e:
+            logger.exception(f"Rollout of a batch of {len(samples)} samples failed")
+            if len(samples) == 1:
+                futures[0].set_exception(e)
+                return
+            # retry the samples one at a time, so that a faulty sample does not fail the others
+            results = []
+            for sample, future in zip(samples, futures):
+                try:
+                    results.append(self._rollout([sample])[0])
+                except Exception as sample_error:
+                    future.set_exception(sample_error)
+                    results.append(None)
+        for result, future in zip(results, futures):
+            if result is not None:
+                future.set_result(result)
+
+    def _rollout(self, samples: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Run one rollout over the samples and return their prediction dicts."""
+        data = helper.create_batch_inputs(
+            self.processor, samples, self.image_processor, self.device
+        )
+        data = helper.to_device(data, self.device, non_blocking=True)
+        rollout = self.model.sample_trajectories_from_data_with_vlm_rollout
+        with (
+            torch.no_grad(),
+            torch.autocast(self.device.type, dtype=torch.bfloat16),
+        ):
+            pred_xyz, pred_rot, extra = rollout(
+                data=data, return_extra=True, **self.sampling_kwargs
+            )
+        pred_xyz = pred_xyz.float().cpu().numpy()
+        pred_rot = pred_rot.float().cpu().numpy()
+        self.num_batches += 1
+        self.num_samples += len(samples)
+        return [
+            {"pred_xyz": pred_xyz[i], "pred_rot": pred_rot[i], "cot": np.asarray(extra["cot"][i])}
+            for i in range(len(samples))
+        ]
+
+
+class ContinuousBatcher(DynamicBatcher):
+    """Decodes the submitted samples with a `ContinuousBatchScheduler` on a background thread.
+
+    Instead of closing batches, the samples join the running decoding batch as soon as rows are
+    free, and every sample is resolved as soon as its own reasoning traces are done. Up to
+    `max_batch_size` samples are decoded together.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        processor: Any,
+        max_batch_size: int = 8,
+        device: str | torch.device = "cuda",
+        image_processor: TensorImageProcessor | None = None,
+        **sampling_kwargs: Any,
+    ):
+        """Initialize the ContinuousBatcher.
+
+        Args:
+            model: The AlpamayoR1 model, on `device`.
+            processor: The processor returned by `helper.get_processor`.
+            max_batch_size: The maximum number of samples decoded together.
+            device: The device of the model.
+            image_processor: Optional `TensorImageProcessor` preprocessing the frames on `device`.
+            **sampling_kwargs: Keyword arguments of `ContinuousBatchScheduler`, e.g. `top_p`,
+                `temperature`, `num_traj_samples` or `max_generation_length`.
+        """
+        super().__init__(
+            model, processor, max_batch_size, device=device, image_processor=image_processor
+        )
+        self.scheduler = ContinuousBatchScheduler(model, **sampling_kwargs)
+        self.scheduler.max_rows = max_batch_size * self.scheduler.num_traj_samples
+        self._futures: dict[Any, Future] = {}
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the number of samples processed, the queue length and the scheduler stats."""
+        return {
+            "samples": self.num_samples,
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            **self.scheduler.stats(),
+        }
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping or self._futures:
+            # block for new samples only when nothing is being decoded
+            idle = not self._futures and not stopping
+            items = [self._queue.get()] if idle else []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item is None:
+                    stopping = True
+                else:
+                    self._submit(item[1], item[2])
+            if self._futures:
+                self._step()
+
+    def _submit(self, sample: dict[str, Any], future: Future) -> None:
+        """Preprocess a sample and submit it to the scheduler."""
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            data = helper.create_batch_inputs(
+                self.processor, [sample], self.image_processor, self.device
+            )
+            data = helper.to_device(data, self.device, non_blocking=True)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self._futures[self.scheduler.submit(data)] = future
+
+    def _step(self) -> None:
+        """Run one scheduler step and resolve the futures of the completed samples.
+
+        Every future resolves to a dict with the entries described in `_run_batch`.
+        """
+        try:
+            with (
+                torch.no_grad(),
+                torch.autocast(self.device.type, dtype=torch.bfloat16),
+            ):
+                completed = self.scheduler.step()
+        except Exception as e:
+            logger.exception("Continuous batching step failed")
+            for request in self.scheduler.clear():
+                self._futures.pop(request).set_exception(e)
+            return
+        for request in completed:
+            pred_xyz, pred_rot, extra = request.result
+            self.num_samples += 1
+            self._futures.pop(request).set_result(
+                {
+                    "pred_xyz": pred_xyz[0].float().cpu().numpy(),
+                    "pred_rot": pred_rot[0].float().cpu().numpy(),
+                    "cot": np.asarray(extra["cot"][0]),
+                }
+            )
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP handler of the server.
+
+    - `POST /predict` with a JSON body holding either the `encode_array`-serialized
+      `image_frames`, `ego_history_xyz` and `ego_history_rot` of a sample, or a `clip_id` (and
+      optionally `t0_us`) to load from the dataset. Returns the `encode_array`-serialized
+      `pred_xyz` and `pred_rot` and the `cot` texts.
+    - `GET /health` returns the statistics of the batcher.
+
+    The requests are decoded on the threads of the server, concurrently with the rollouts.
+    """
+
+    server: "InferenceServer"
+
+    def do_GET(self) -> None:
+        if self.path != "/health":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self._send_json(200, {"status": "ok", **self.server.batcher.stats()})
+
+    def do_POST(self) -> None:
+        if self.path != "/predict":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if "clip_id" in body:
+                sample = load_physical_aiavdataset(
+                    body["clip_id"], **({"t0_us": int(body["t0_us"])} if "t0_us" in body else {})
+                )
+            else:
+                sample = {key: torch.from_numpy(decode_array(body[key])) for key in SAMPLE_KEYS}
+                validate_sample(sample)
+        except (KeyError, ValueError, TypeError, AssertionError) as e:
+            # e.g. missing keys, malformed arrays or a t0_us out of the range of the clip
+            self._send_json(400, {"error": f"invalid request: {e!r}"})
+            return
+        except Exception as e:
+            # e.g. I/O errors of the dataset interface
+            self._send_json(500, {"error": repr(e)})
+            return
+        try:
+            result = self.server.batcher.submit(sample).result()
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(
+            200,
+            {
+                "pred_xyz": encode_array(result["pred_xyz"]),
+                "pred_rot": encode_array(result["pred_rot"]),
+                "cot": result["cot"].tolist(),
+            },
+        )
+
+    def _send_json(self, status: int, payload: dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """Threaded HTTP server forwarding the requests to a `DynamicBatcher` or `ContinuousBatcher`."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], batcher: DynamicBatcher):
+        """Initialize the InferenceServer.
+
+        Args:
+            address: The (host, port) to listen on.
+            batcher: The batcher running the rollouts, started with the server.
+        """
+        super().__init__(address, InferenceRequestHandler)
+        self.batcher = batcher
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        self.batcher.start()
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.batcher.stop()
+
+
+def predict(url: str, sample: dict[str, Any], timeout: float | None = None) -> dict[str, Any]:
+    """Send a sample to a running server and wait for its prediction.
+
+    Args:
+        url: The URL of the server, e.g. "http://127.0.0.1:8000".
+        sample: A dict with the `image_frames`, `ego_history_xyz` and `ego_history_rot` entries
+            of `load_physical_aiavdataset`.
+        timeout: Optional timeout of the request in seconds.
+
+    Returns:
+        A dict with the pred_xyz and pred_rot arrays and the cot texts of the sample.
+    """
+    body = json.dumps({key: encode_array(sample[key]) for key in SAMPLE_KEYS}).encode("utf-8")
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/predict", data=body, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        result = json.loads(response.read())
+    return {
+        "pred_xyz": decode_array(result["pred_xyz"]),
+        "pred_rot": decode_array(result["pred_rot"]),
+        "cot": np.asarray(result["cot"]),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve AlpamayoR1 over HTTP on localhost.")
+    parser.add_argument("--model-path", default="nvidia/Alpamayo-R1-10B")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--attn-implementation", default="flash_attention_2")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20.0)
+    parser.add_argument("--num-traj-samples", type=int, default=1)
+    parser.add_argument("--top-p", type=float, default=0.98)
+    parser.add_argument("--temperature", type=float, default=0.6)
+    parser.add_argument("--max-generation-length", type=int, default=256)
+    parser.add_argument(
+        "--tensor-image-processor",
+        action="store_true",
+        help="preprocess the frames on the GPU with TensorImageProcessor",
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="let the samples join and leave the decoding batch with ContinuousBatcher",
+    )
+    parser.add_argument(
+        "--cot-budget",
+        type=int,
+        default=None,
+        help="cap the reasoning at this many tokens, 0 returns trajectories without reasoning",
+    )
+    args = parser.parse_args()
+    if args.cot_budget is not None and args.continuous_batching:
+        parser.error("--cot-budget is not supported with --continuous-batching")
+    logging.basicConfig(level=logging.INFO)
+
+    device = "cuda"
+    logger.info(f"Loading {args.model_path}...")
+    model = AlpamayoR1.from_pretrained(
+        args.model_path, dtype=torch.bfloat16, attn_implementation=args.attn_implementation
+    ).to(device)
+    model.eval()
+    processor = helper.get_processor(model.tokenizer)
+    image_processor = (
+        TensorImageProcessor.from_processor(processor) if args.tensor_image_processor else None
+    )
+    sampling_kwargs = {
+        "top_p": args.top_p,
+        "temperature": args.temperature,
+        "num_traj_samples": args.num_traj_samples,
+        "max_generation_length": args.max_generation_length,
+    }
+    if args.cot_budget is not None:
+        sampling_kwargs["cot_budget"] = args.cot_budget
+    if args.continuous_batching:
+        batcher = ContinuousBatcher(
+            model,
+            processor,
+            max_batch_size=args.max_batch_size,
+            device=device,
+            image_processor=image_processor,
+            **sampling_kwargs,
+        )
+    else:
+        batcher = DynamicBatcher(
+            model,
+            processor,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+            device=device,
+            image_processor=image_processor,
+            **sampling_kwargs,
+        )
+    server = InferenceServer((args.host, args.port), batcher)
+    logger.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()